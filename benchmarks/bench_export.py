@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : bench_export
+#  DESCRIPTION : Headless benchmark of the KMZ / MIF export engines on synthetic
+#                layers (offscreen QgsApplication, no QGIS window needed)
+# ==============================================================================
+#
+#  python benchmarks/bench_export.py                        # full matrix -> bench-<version>.json
+#  python benchmarks/bench_export.py --sizes 10000 --engines kmz --geometries point
+#  python benchmarks/bench_export.py --compare bench-6.9.0.json
+#
+#  Every case runs in its own process, so peak RSS is the peak of that case
+#  alone (synthetic layer included; ``export_rss_mb`` is the growth during the
+#  export itself). ``--tracemalloc`` adds the Python heap peak of the export,
+#  at a noticeable cost in throughput.
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_PACKAGE = "embed_legend_bench"
+
+SIZES = (10000, 100000, 1000000)
+ENGINES = ("kmz", "mif")
+GEOMETRIES = ("point", "sector", "grid", "line")
+RENDERERS = ("categorized", "graduated", "rule")
+
+# Synthetic data is spread over this lon/lat box (roughly West Java)
+EXTENT = (106.5, -7.2, 108.0, -6.0)
+CLASSES = ("LTE900", "LTE1800", "LTE2100", "LTE2300", "NR")
+RSRP_BREAKS = (-140, -110, -100, -90, -80, -40)
+SECTORS_PER_SITE = 3
+GRID_CELL_DEG = 0.0005 # ~50 m bins
+BATCH_FEATURES = 50000
+
+# A case is slower than the baseline when its throughput drops by more than this
+DEFAULT_REGRESSION = 0.10
+
+
+# ==============================================================================
+#  SYNTHETIC LAYERS
+# ==============================================================================
+def load_plugin():
+    """Imports the plugin directory as a package, whatever the folder is called."""
+    spec = importlib.util.spec_from_file_location(
+        PLUGIN_PACKAGE, os.path.join(PLUGIN_DIR, "__init__.py"), submodule_search_locations=[PLUGIN_DIR]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[PLUGIN_PACKAGE] = module
+    spec.loader.exec_module(module)
+    return importlib.import_module(f"{PLUGIN_PACKAGE}.export_tasks")
+
+
+def iter_geometries(kind, count, rnd):
+    """Yields (geometry, site id) pairs for a synthetic layer of ``count`` features."""
+    from qgis.core import QgsGeometry, QgsPointXY, QgsRectangle
+    x0, y0, x1, y1 = EXTENT
+    if kind == "point":
+        for i in range(count):
+            yield QgsGeometry.fromPointXY(QgsPointXY(rnd.uniform(x0, x1), rnd.uniform(y0, y1))), f"S{i // 500:05d}"
+    elif kind == "sector":
+        # 3 wedges of 65 degrees per site, 12 arc vertices each
+        radius = 0.004
+        for i in range(count):
+            site, sector = divmod(i, SECTORS_PER_SITE)
+            if sector == 0: cx, cy = rnd.uniform(x0, x1), rnd.uniform(y0, y1)
+            azimuth = sector * 120.0
+            ring = [QgsPointXY(cx, cy)]
+            for k in range(13):
+                a = math.radians(azimuth - 32.5 + k * 65.0 / 12)
+                ring.append(QgsPointXY(cx + radius * math.sin(a), cy + radius * math.cos(a)))
+            ring.append(QgsPointXY(cx, cy))
+            yield QgsGeometry.fromPolygonXY([ring]), f"S{site:06d}"
+    elif kind == "grid":
+        cols = int(math.ceil(math.sqrt(count)))
+        for i in range(count):
+            r, c = divmod(i, cols)
+            gx, gy = x0 + c * GRID_CELL_DEG, y0 + r * GRID_CELL_DEG
+            yield QgsGeometry.fromRect(QgsRectangle(gx, gy, gx + GRID_CELL_DEG, gy + GRID_CELL_DEG)), None
+    else:
+        # Drive-test style routes: a 10 vertex random walk per feature
+        for i in range(count):
+            x, y = rnd.uniform(x0, x1), rnd.uniform(y0, y1)
+            points = [QgsPointXY(x, y)]
+            for k in range(9):
+                x += rnd.uniform(-0.0005, 0.0005); y += rnd.uniform(-0.0005, 0.0005)
+                points.append(QgsPointXY(x, y))
+            yield QgsGeometry.fromPolylineXY(points), f"S{i // 500:05d}"
+
+
+def build_layer(kind, count, seed=0):
+    """Memory layer with a SiteID, a class (string) and an RSRP (double) column."""
+    from qgis.core import QgsVectorLayer, QgsFeature
+    wkb = {"point": "Point", "sector": "Polygon", "grid": "Polygon", "line": "LineString"}[kind]
+    layer = QgsVectorLayer(
+        f"{wkb}?crs=EPSG:4326&field=SiteID:string(12)&field=band:string(10)&field=rsrp:double",
+        f"bench_{kind}_{count}", "memory"
+    )
+    provider = layer.dataProvider()
+    rnd = random.Random(seed)
+    fields = layer.fields()
+    batch = []
+    for geom, site in iter_geometries(kind, count, rnd):
+        feat = QgsFeature(fields)
+        feat.setGeometry(geom)
+        feat.setAttributes([site, rnd.choice(CLASSES), rnd.uniform(-135.0, -45.0)])
+        batch.append(feat)
+        if len(batch) >= BATCH_FEATURES:
+            provider.addFeatures(batch); batch = []
+    if batch: provider.addFeatures(batch)
+    layer.updateExtents()
+    return layer
+
+
+def apply_renderer(layer, kind):
+    from qgis.core import (
+        QgsSymbol, QgsCategorizedSymbolRenderer, QgsRendererCategory, QgsGraduatedSymbolRenderer,
+        QgsRendererRange, QgsRuleBasedRenderer
+    )
+    from qgis.PyQt.QtGui import QColor
+
+    def symbol(n):
+        sym = QgsSymbol.defaultSymbol(layer.geometryType())
+        sym.setColor(QColor.fromHsv((n * 67) % 360, 200, 220))
+        return sym
+
+    if kind == "categorized":
+        categories = [QgsRendererCategory(value, symbol(n), value) for n, value in enumerate(CLASSES)]
+        renderer = QgsCategorizedSymbolRenderer("band", categories)
+    elif kind == "graduated":
+        ranges = [
+            QgsRendererRange(lo, hi, symbol(n), f"{lo} to {hi}")
+            for n, (lo, hi) in enumerate(zip(RSRP_BREAKS, RSRP_BREAKS[1:]))
+        ]
+        renderer = QgsGraduatedSymbolRenderer("rsrp", ranges)
+    else:
+        root = QgsRuleBasedRenderer.Rule(None)
+        for n, (label, expression) in enumerate((
+            ("Good", '"rsrp" >= -90'),
+            ("Fair", '"rsrp" >= -105 AND "rsrp" < -90'),
+            ("Bad", '"rsrp" < -105'),
+        )):
+            root.appendChild(QgsRuleBasedRenderer.Rule(symbol(n), 0, 0, expression, label))
+        renderer = QgsRuleBasedRenderer(root)
+    layer.setRenderer(renderer)
+
+
+# ==============================================================================
+#  ONE CASE (child process)
+# ==============================================================================
+def peak_rss_mb():
+    """Peak resident set size of this process, or None where ``resource`` is unavailable."""
+    try: import resource
+    except ImportError: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1) # bytes on macOS, KiB elsewhere
+
+
+def run_case(case, workers, use_tracemalloc, keep_dir=None):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from qgis.core import QgsApplication, QgsProject
+    app = QgsApplication([], False)
+    app.initQgis()
+    try:
+        export_tasks = load_plugin()
+        layer = build_layer(case["geometry"], case["features"])
+        apply_renderer(layer, case["renderer"])
+        QgsProject.instance().addMapLayer(layer)
+        rss_before = peak_rss_mb()
+
+        out_dir = keep_dir or tempfile.mkdtemp(prefix="embed_legend_bench_")
+        stem = os.path.join(out_dir, f"{case['geometry']}_{case['renderer']}_{case['features']}")
+        if case["engine"] == "kmz":
+            outputs = [stem + ".kmz"]
+            task = export_tasks.KmzExportTask([layer], outputs[0], None, "table", 0, workers)
+        else:
+            outputs = [stem + ".mif", stem + ".mid"]
+            task = export_tasks.MifExportTask(layer, outputs[0], outputs[1], workers)
+
+        if use_tracemalloc:
+            import tracemalloc
+            tracemalloc.start()
+        start = time.perf_counter()
+        ok = task.run() # Synchronous: the QgsTask body, without the task manager
+        wall = time.perf_counter() - start
+        heap_peak = None
+        if use_tracemalloc:
+            heap_peak = round(tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0), 1)
+            tracemalloc.stop()
+
+        size = sum(os.path.getsize(p) for p in outputs if os.path.exists(p))
+        if keep_dir is None:
+            for p in outputs:
+                try: os.remove(p)
+                except OSError: pass
+            try: os.rmdir(out_dir)
+            except OSError: pass
+
+        rss_after = peak_rss_mb()
+        result = dict(case)
+        result.update({
+            "ok": bool(ok),
+            "error": repr(task.exception) if task.exception else None,
+            "workers": workers,
+            "wall_s": round(wall, 3),
+            "features_per_s": round(case["features"] / wall, 1) if wall > 0 else None,
+            "peak_rss_mb": rss_after,
+            "export_rss_mb": round(rss_after - rss_before, 1) if rss_after is not None else None,
+            "tracemalloc_peak_mb": heap_peak,
+            "output_bytes": size,
+        })
+        return result
+    finally:
+        QgsProject.instance().removeAllMapLayers()
+        app.exitQgis()
+
+
+# ==============================================================================
+#  MATRIX, REPORT, COMPARISON
+# ==============================================================================
+def case_key(result):
+    return f"{result['engine']}/{result['geometry']}/{result['renderer']}/{result['features']}"
+
+
+def plugin_version():
+    try:
+        with open(os.path.join(PLUGIN_DIR, "metadata.txt"), encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("version="): return line.split("=", 1)[1].strip()
+    except OSError: pass
+    return "unknown"
+
+
+def spawn_case(case, args):
+    """Runs one case in a fresh interpreter and returns its result dict."""
+    cmd = [sys.executable, os.path.abspath(__file__), "--case", json.dumps(case), "--workers", str(args.workers)]
+    if args.tracemalloc: cmd.append("--tracemalloc")
+    if args.keep: cmd += ["--keep", args.keep]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith("{"): return json.loads(line)
+    result = dict(case)
+    result.update({"ok": False, "error": (proc.stderr.strip().splitlines() or ["no output"])[-1]})
+    return result
+
+
+def print_row(result):
+    if not result.get("ok"):
+        print(f"{case_key(result):<40} FAILED  {result.get('error')}")
+        return
+    print(
+        f"{case_key(result):<40} {result['wall_s']:>9.2f} s {result['features_per_s']:>12,.0f} f/s "
+        f"{result['peak_rss_mb'] or 0:>8.1f} MB {result['output_bytes'] / 1048576.0:>9.1f} MB out"
+    )
+
+
+def compare(results, baseline_path, threshold):
+    """Prints the throughput change per case against a previous run; returns the regressed keys."""
+    with open(baseline_path, encoding="utf-8") as f: baseline = json.load(f)
+    previous = {case_key(r): r for r in baseline.get("results", []) if r.get("ok")}
+    regressions = []
+    print(f"\nCompared with {baseline.get('plugin_version', '?')} ({baseline_path}):")
+    for result in results:
+        key = case_key(result)
+        old = previous.get(key)
+        if not old or not result.get("ok"): continue
+        change = result["features_per_s"] / old["features_per_s"] - 1.0
+        flag = ""
+        if change < -threshold:
+            flag = "  << REGRESSION"
+            regressions.append(key)
+        print(f"{key:<40} {old['features_per_s']:>12,.0f} -> {result['features_per_s']:>12,.0f} f/s {change:>+8.1%}{flag}")
+    return regressions
+
+
+def parse_list(value, allowed=None):
+    items = [v.strip() for v in value.split(",") if v.strip()]
+    if allowed:
+        unknown = [v for v in items if v not in allowed]
+        if unknown: raise argparse.ArgumentTypeError(f"unknown value(s): {', '.join(unknown)}")
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Embed Legend KMZ / MIF export engines.")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="feature counts (comma separated)")
+    parser.add_argument("--engines", default=",".join(ENGINES), type=lambda v: parse_list(v, ENGINES))
+    parser.add_argument("--geometries", default=",".join(GEOMETRIES), type=lambda v: parse_list(v, GEOMETRIES))
+    parser.add_argument("--renderers", default=",".join(RENDERERS), type=lambda v: parse_list(v, RENDERERS))
+    parser.add_argument("--workers", type=int, default=1, help="export worker threads (plugin default: 1)")
+    parser.add_argument("--tracemalloc", action="store_true", help="also record the Python heap peak (slower)")
+    parser.add_argument("--output", help="result file (default: bench-<plugin version>.json)")
+    parser.add_argument("--compare", help="previous result file to compare throughput against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION, help="regression threshold (0.10 = 10%%)")
+    parser.add_argument("--keep", help="keep the exported files in this directory")
+    parser.add_argument("--case", help=argparse.SUPPRESS) # Internal: run one case in this process
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case), args.workers, args.tracemalloc, args.keep)))
+        return 0
+
+    sizes = [int(v) for v in parse_list(args.sizes)]
+
+    results = []
+    for size in sizes:
+        for engine in args.engines:
+            for geometry in args.geometries:
+                for renderer in args.renderers:
+                    case = {"engine": engine, "geometry": geometry, "renderer": renderer, "features": size}
+                    result = spawn_case(case, args)
+                    print_row(result)
+                    results.append(result)
+
+    version = plugin_version()
+    report = {
+        "plugin_version": version,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "workers": args.workers,
+        "results": results,
+    }
+    try:
+        from qgis.core import Qgis
+        report["qgis"] = Qgis.QGIS_VERSION
+    except ImportError: pass
+    output = args.output or f"bench-{version}.json"
+    with open(output, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+    print(f"\nSaved {len(results)} results to {output}")
+
+    failed = [case_key(r) for r in results if not r.get("ok")]
+    regressions = compare(results, args.compare, args.threshold) if args.compare else []
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
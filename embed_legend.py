@@ -20,30 +20,36 @@ please download directly from the Official QGIS Repository.
 """
 
 import os
-import csv
-import re
-import zipfile
-import shutil
-import tempfile
-import sip 
+import sip
 
 # GUI & Core Imports
-from qgis.PyQt.QtCore import Qt, QUrl, QVariant
+from qgis.PyQt.QtCore import Qt, QUrl, QTimer
 from qgis.PyQt.QtGui import (
-    QColor, QIcon, QFont, QCursor, QFontMetrics, QDesktopServices, QBrush
+    QColor, QIcon, QFont, QCursor, QDesktopServices, QBrush
 )
 from qgis.PyQt.QtWidgets import (
-    QAction, QDockWidget, QListWidget, QListWidgetItem, 
+    QAction, QDockWidget, QListView, QLineEdit, 
     QVBoxLayout, QWidget, QLabel, QFileDialog, QMenu, 
-    QColorDialog, QFontDialog, QMessageBox, QProgressDialog
+    QColorDialog, QFontDialog, QMessageBox, QInputDialog
 )
 from qgis.core import (
-    QgsProject, QgsVectorLayer, QgsCoordinateReferenceSystem, 
-    QgsCoordinateTransform, QgsRenderContext, QgsWkbTypes,
-    QgsGeometry, QgsSettings
+    QgsProject, QgsVectorLayer, QgsSettings, QgsApplication, QgsGeometry
 )
 from qgis.utils import iface
 
+from .export_tasks import KmzExportTask, MifExportTask, OgrExportTask, OGR_DRIVERS
+from .kml_regions import DEFAULT_TILE_FEATURES
+from .export_chunks import default_workers
+from .field_picker import ExportFieldsDialog, set_export_field_names
+from .export_scope import ExportScope, SpatialIndexCache, SCOPES, SCOPE_FULL, SCOPE_EXTENT, SCOPE_SELECTED, SCOPE_POLYGON
+from .polygon_tool import PolygonCaptureTool
+from .site_labels import DEFAULT_LABEL_SPACING
+from .feature_counts import FeatureCountCache
+from .legend_model import LegendLayerRows, LegendListModel, LegendNodeIndex
+from .export_profile import ExportProfiler, REPORT_SUFFIX
+from .processing_provider import EmbedLegendProvider
+from .legend_image import LegendImageCache, LegendSection, LegendStyle, DEFAULT_LEGEND_DPI
+
 # ==============================================================================
 #  CONFIGURATION & CONSTANTS
 # ==============================================================================
@@ -54,6 +60,8 @@ LANG_DICT = {
         "header": "Layer Info",
         "header_multi": "{} Legend",
         "menu_config": "--- CONFIGURATION ---",
+        "menu_solo": "👁 Show Only This Class",
+        "menu_toggle_all": "🔁 Toggle All Classes",
         "menu_font": "🔠 Change Font",
         "menu_text_color": "🎨 Text Color",
         "menu_bg_color": "⬜ Background Color",
@@ -63,8 +71,41 @@ LANG_DICT = {
         "style_mini": "✨ Minimalist (Clean)",
         "show_count": "🔢 Show Count",
         "show_percent": "％ Show Percentage",
+        "show_filter": "🔍 Show Filter Box",
+        "filter_hint": "Filter classes...",
         "export_mif": "📝 Export MIF (Hardcode Thematic)",
         "export_kmz": "🌏 Export KMZ (Google Earth)",
+        "export_ogr": "🗃️ Export GeoPackage / FlatGeobuf (Thematic Columns)",
+        "menu_export_opts": "⚙️ Export Options",
+        "opt_kmz_schema": "🧾 KMZ Popup: Schema (Compact)",
+        "opt_kmz_regionated": "🧩 KMZ Regionated (LOD Tiles)",
+        "opt_tile_size": "Max features per tile:",
+        "opt_threads": "🧵 Worker Threads: {}",
+        "opt_fields": "📋 Export Fields...",
+        "opt_full": "Full",
+        "opt_precision": "🎚️ Coordinate Decimals: {}",
+        "opt_precision_prompt": "Decimals kept in exported coordinates (-1 = full precision):",
+        "opt_simplify": "〰️ Simplify Tolerance: {} m",
+        "opt_simplify_prompt": "Simplify lines/polygons with this tolerance (m, 0 = off):",
+        "opt_simplify_zoom": "🔭 Zoom-Dependent Simplify (Regionated)",
+        "opt_spatial_index": "🗂️ Spatial Index (GPKG/FGB)",
+        "opt_kmz_legend": "🖼️ Embed Legend Image (KMZ)",
+        "opt_legend_dpi": "🔍 Legend Image DPI: {}",
+        "opt_legend_dpi_prompt": "Resolution of the KMZ legend image (DPI):",
+        "opt_profile": "⏱️ Log Export Timings",
+        "opt_profile_report": "🧾 Save Timing Report (JSON)",
+        "opt_label_spacing": "🏷️ Site Label Spacing: {} m",
+        "opt_label_spacing_prompt": "Minimum distance between site labels (m, 0 = keep all):",
+        "opt_scope": "🎯 Export Scope",
+        "scope_full": "Whole Layer",
+        "scope_extent": "Canvas Extent",
+        "scope_selected": "Selected Features",
+        "scope_polygon": "Custom Polygon (Draw)...",
+        "scope_draw_hint": "Click to add vertices, right click to finish, Esc to cancel.",
+        "scope_no_selection": "No features are selected in the layer(s) to export.",
+        "scope_no_polygon": "Draw the export polygon on the map first.",
+        "fields_hint": "Fields written to the KMZ popup and MID columns. Fields used by the style are always read. Classes hidden in the legend are not exported.",
+        "opt_threads_prompt": "Threads used to serialize large layers:",
         "about": "ℹ️ About & Help",
         "lang": "🌐 Language / Bahasa",
         "success": "Success",
@@ -77,6 +118,8 @@ LANG_DICT = {
         "header": "Info Layer",
         "header_multi": "{} Legend",
         "menu_config": "--- KONFIGURASI ---",
+        "menu_solo": "👁 Tampilkan Hanya Kelas Ini",
+        "menu_toggle_all": "🔁 Balik Semua Kelas",
         "menu_font": "🔠 Ganti Font",
         "menu_text_color": "🎨 Warna Teks",
         "menu_bg_color": "⬜ Warna Background",
@@ -86,8 +129,41 @@ LANG_DICT = {
         "style_mini": "✨ Minimalis (Clean)",
         "show_count": "🔢 Tampilkan Jumlah",
         "show_percent": "％ Tampilkan Persentase",
+        "show_filter": "🔍 Tampilkan Kotak Filter",
+        "filter_hint": "Saring kelas...",
         "export_mif": "📝 Export MIF (Hardcode Thematic)",
         "export_kmz": "🌏 Export KMZ (Google Earth)",
+        "export_ogr": "🗃️ Export GeoPackage / FlatGeobuf (Kolom Tematik)",
+        "menu_export_opts": "⚙️ Opsi Export",
+        "opt_kmz_schema": "🧾 Popup KMZ: Schema (Ringkas)",
+        "opt_kmz_regionated": "🧩 KMZ Regionated (Tile LOD)",
+        "opt_tile_size": "Maks fitur per tile:",
+        "opt_threads": "🧵 Thread Pekerja: {}",
+        "opt_fields": "📋 Kolom Export...",
+        "opt_full": "Penuh",
+        "opt_precision": "🎚️ Desimal Koordinat: {}",
+        "opt_precision_prompt": "Jumlah desimal koordinat yang diekspor (-1 = presisi penuh):",
+        "opt_simplify": "〰️ Toleransi Simplifikasi: {} m",
+        "opt_simplify_prompt": "Sederhanakan garis/poligon dengan toleransi ini (m, 0 = mati):",
+        "opt_simplify_zoom": "🔭 Simplifikasi Sesuai Zoom (Regionated)",
+        "opt_spatial_index": "🗂️ Indeks Spasial (GPKG/FGB)",
+        "opt_kmz_legend": "🖼️ Sertakan Gambar Legenda (KMZ)",
+        "opt_legend_dpi": "🔍 DPI Gambar Legenda: {}",
+        "opt_legend_dpi_prompt": "Resolusi gambar legenda KMZ (DPI):",
+        "opt_profile": "⏱️ Catat Waktu Export",
+        "opt_profile_report": "🧾 Simpan Laporan Waktu (JSON)",
+        "opt_label_spacing": "🏷️ Jarak Label Site: {} m",
+        "opt_label_spacing_prompt": "Jarak minimum antar label site (m, 0 = tampilkan semua):",
+        "opt_scope": "🎯 Cakupan Export",
+        "scope_full": "Seluruh Layer",
+        "scope_extent": "Tampilan Kanvas",
+        "scope_selected": "Fitur Terpilih",
+        "scope_polygon": "Poligon Kustom (Gambar)...",
+        "scope_draw_hint": "Klik untuk menambah titik, klik kanan untuk selesai, Esc untuk batal.",
+        "scope_no_selection": "Tidak ada fitur terpilih pada layer yang diekspor.",
+        "scope_no_polygon": "Gambar dulu poligon export di peta.",
+        "fields_hint": "Kolom yang ditulis ke popup KMZ dan kolom MID. Kolom yang dipakai style selalu dibaca. Kelas yang disembunyikan di legenda tidak diekspor.",
+        "opt_threads_prompt": "Thread untuk serialisasi layer besar:",
         "about": "ℹ️ Tentang & Bantuan",
         "lang": "🌐 Bahasa / Language",
         "success": "Sukses",
@@ -98,6 +174,12 @@ LANG_DICT = {
     }
 }
 
+# Legend refresh debounce (ms)
+LEGEND_REFRESH_DELAY_MS = 150
+
+# Default coordinate decimals for exports (6 decimals of a degree ~ 0.1 m)
+DEFAULT_COORD_PRECISION = 6
+
 # Stylesheets
 STYLE_STANDARD_LBL = """
     QLabel {
@@ -179,8 +261,29 @@ class EmbedLegendPlugin:
     def __init__(self, iface):
         self.iface = iface
         self.dock_widget = None
-        self.list_widget = None
+        self.list_view = None
+        self.legend_model = None
+        self.filter_box = None
         self.settings = QgsSettings()
+        self.active_tasks = set() # Keeps running export tasks alive
+        self.provider = None # Processing provider (also loaded headless by qgis_process)
+        
+        # Refresh Scheduler (coalesces canvas/selection signal bursts)
+        self.refresh_timer = QTimer()
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(LEGEND_REFRESH_DELAY_MS)
+        self.refresh_timer.timeout.connect(self.run_scheduled_refresh)
+        self.refresh_dirty = False
+        self.refresh_force = False
+        self.legend_signature = None
+        
+        # Per-class feature counts (filled in the background, keyed by layer id + rule key)
+        self.count_cache = FeatureCountCache()
+        self.count_cache.countsChanged.connect(lambda layer_id: self.schedule_legend_refresh(force=True))
+        
+        # Rule key -> legend node lookup used by the visibility toggles
+        self.node_index = LegendNodeIndex()
+        
         
         # UI Properties
         self.bg_color = QColor(255, 255, 255)
@@ -191,13 +294,45 @@ class EmbedLegendPlugin:
         self.show_percent = True
         self.style_mode = "minimalist" 
         self.lang_code = self.settings.value("EmbedLegend/Lang", "en")
+        self.show_filter = self.settings.value("EmbedLegend/ShowFilter", False, type=bool)
+        
+        # Export Options (persisted)
+        self.kmz_schema_popup = self.settings.value("EmbedLegend/KmzSchemaPopup", False, type=bool)
+        self.kmz_tile_size = self.settings.value("EmbedLegend/KmzTileSize", 0, type=int)
+        self.export_workers = self.settings.value("EmbedLegend/ExportThreads", default_workers(), type=int)
+        self.label_spacing = self.settings.value("EmbedLegend/LabelSpacing", DEFAULT_LABEL_SPACING, type=int)
+        # Geometry Output: decimals (-1 = full precision) and simplify tolerance in metres
+        self.coord_precision = self.settings.value("EmbedLegend/CoordPrecision", DEFAULT_COORD_PRECISION, type=int)
+        self.simplify_tolerance = self.settings.value("EmbedLegend/SimplifyTolerance", 0.0, type=float)
+        self.simplify_by_zoom = self.settings.value("EmbedLegend/SimplifyByZoom", False, type=bool)
+        # Instrumentation: per-phase timings in the message log, optionally a JSON report
+        self.profile_exports = self.settings.value("EmbedLegend/ProfileExports", False, type=bool)
+        self.ogr_spatial_index = self.settings.value("EmbedLegend/OgrSpatialIndex", True, type=bool)
+        # KMZ legend overlay: drawn offscreen from the renderers, cached per style
+        self.kmz_legend = self.settings.value("EmbedLegend/KmzLegend", True, type=bool)
+        self.legend_dpi = self.settings.value("EmbedLegend/LegendDpi", DEFAULT_LEGEND_DPI, type=int)
+        self.legend_images = LegendImageCache()
+        self.profile_report = self.settings.value("EmbedLegend/ProfileReport", False, type=bool)
+        
+        # Export Scope (the custom polygon lives for the session only)
+        self.export_scope = self.settings.value("EmbedLegend/ExportScope", SCOPE_FULL)
+        if self.export_scope not in SCOPES: self.export_scope = SCOPE_FULL
+        self.scope_polygon = None
+        self.polygon_tool = None
+        self.previous_map_tool = None
+        self.index_cache = SpatialIndexCache()
 
     # --- Utilities ---
     def tr(self, key):
         """Translates text based on current language setting."""
         return LANG_DICT.get(self.lang_code, LANG_DICT["en"]).get(key, key)
 
+    def initProcessing(self):
+        self.provider = EmbedLegendProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
     def initGui(self):
+        self.initProcessing()
         icon_path = os.path.join(os.path.dirname(__file__), 'icon.png')
         self.action_toggle = QAction(QIcon(icon_path), 'Embed Legend Panel', self.iface.mainWindow())
         self.action_toggle.setCheckable(True)
@@ -207,14 +342,24 @@ class EmbedLegendPlugin:
 
     def unload(self):
         self.disconnect_signals()
+        self.refresh_timer.stop()
+        self.count_cache.clear()
+        self.legend_images.clear()
+        self.node_index.clear()
+        self.index_cache.clear()
+        if self.polygon_tool: self.stop_polygon_tool()
+        for task in list(self.active_tasks): task.cancel()
+        if self.provider:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
+            self.provider = None
         self.iface.removePluginMenu('&Embed Legend', self.action_toggle)
         self.iface.removeToolBarIcon(self.action_toggle)
         self.cleanup_widget()
 
     def disconnect_signals(self):
-        try: self.iface.layerTreeView().selectionModel().selectionChanged.disconnect(self.update_legend)
+        try: self.iface.layerTreeView().selectionModel().selectionChanged.disconnect(self.on_layer_selection_changed)
         except: pass
-        try: self.iface.mapCanvas().mapCanvasRefreshed.disconnect(self.update_legend)
+        try: self.iface.mapCanvas().mapCanvasRefreshed.disconnect(self.schedule_legend_refresh)
         except: pass
 
     def cleanup_widget(self):
@@ -260,13 +405,27 @@ class EmbedLegendPlugin:
         self.header_widget = DraggableHeader(self.dock_widget, self)
         layout.addWidget(self.header_widget)
         
-        self.list_widget = QListWidget()
-        self.list_widget.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff) 
-        self.list_widget.setContextMenuPolicy(Qt.CustomContextMenu)
-        self.list_widget.customContextMenuRequested.connect(self.show_context_menu)
-        self.list_widget.itemClicked.connect(self.on_item_clicked)
+        # Optional Filter Box (handy for renderers with thousands of classes)
+        self.filter_box = QLineEdit()
+        self.filter_box.setPlaceholderText(self.tr("filter_hint"))
+        self.filter_box.setClearButtonEnabled(True)
+        self.filter_box.setVisible(self.show_filter)
+        layout.addWidget(self.filter_box)
+        
+        # Virtualized Legend: model/view with lazy row fetching
+        self.legend_model = LegendListModel(self.panel)
+        self.legend_model.set_appearance(self.font_item, self.text_color, self.style_mode)
+        self.list_view = QListView()
+        self.list_view.setModel(self.legend_model)
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff) 
+        self.list_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.list_view.customContextMenuRequested.connect(self.show_context_menu)
+        self.list_view.clicked.connect(self.on_item_clicked)
+        self.filter_box.textChanged.connect(self.legend_model.set_filter)
+        self.legend_model.rowsInserted.connect(self.fit_legend_panel)
         
-        layout.addWidget(self.list_widget)
+        layout.addWidget(self.list_view)
         self.panel.setLayout(layout)
         self.dock_widget.setWidget(self.panel)
         
@@ -274,39 +433,123 @@ class EmbedLegendPlugin:
         self.iface.addDockWidget(Qt.LeftDockWidgetArea, self.dock_widget)
         
         self.disconnect_signals()
-        self.iface.layerTreeView().selectionModel().selectionChanged.connect(self.update_legend)
-        self.iface.mapCanvas().mapCanvasRefreshed.connect(self.update_legend)
+        self.iface.layerTreeView().selectionModel().selectionChanged.connect(self.on_layer_selection_changed)
+        self.iface.mapCanvas().mapCanvasRefreshed.connect(self.schedule_legend_refresh)
+
+    # --- Refresh Scheduler ---
+    def on_layer_selection_changed(self, *args):
+        self.schedule_legend_refresh(force=True)
+
+    def schedule_legend_refresh(self, force=False):
+        """Marks the legend dirty; bursts of signals collapse into one deferred rebuild."""
+        self.refresh_dirty = True
+        self.refresh_force = self.refresh_force or force
+        if not self.refresh_timer.isActive(): self.refresh_timer.start()
+
+    def run_scheduled_refresh(self):
+        if not self.refresh_dirty: return
+        force = self.refresh_force
+        self.refresh_dirty = False
+        self.refresh_force = False
+        if not self.dock_widget or sip.isdeleted(self.dock_widget) or not self.dock_widget.isVisible(): return
+        # Skip the rebuild if renderer and legend-node state are unchanged
+        if not force and self.compute_legend_signature() == self.legend_signature: return
+        self.update_legend()
+
+    def selected_vector_layers(self):
+        selected_layers = self.iface.layerTreeView().selectedLayers()
+        return [l for l in selected_layers if isinstance(l, QgsVectorLayer)]
+
+    def compute_legend_signature(self):
+        """Cheap fingerprint of what the panel shows: selected layers + their legend change counters.
+
+        The counters are bumped by the renderer/legend/style signals (see
+        LegendNodeIndex), so a canvas refresh never reads the classes.
+        """
+        try:
+            return tuple(
+                (layer.id(), layer.name(), self.node_index.version(layer.id())) for layer in self.selected_vector_layers()
+            )
+        except RuntimeError:
+            return None
 
     # --- Core Logic: Visibility Toggle ---
-    def on_item_clicked(self, item):
+    def on_item_clicked(self, index):
         """Toggles visibility of the selected legend item (Strikethrough effect)."""
-        if item.flags() & Qt.NoItemFlags: return # Ignore Header Items
+        if not index.flags() & Qt.ItemIsEnabled: return # Ignore Header Items
+        layer = index.data(Qt.UserRole)
+        rule_key = index.data(Qt.UserRole + 1)
+        self.toggle_class(layer, rule_key)
 
+    def toggle_class(self, layer, rule_key):
+        """Flips one class with a single index lookup (no scan of the layer's nodes)."""
         try:
-            layer = item.data(Qt.UserRole)
-            rule_key = item.data(Qt.UserRole + 1)
-            if not layer or not layer.isValid(): return
-            
-            model = self.iface.layerTreeView().layerTreeModel()
-            tree_layer = QgsProject.instance().layerTreeRoot().findLayer(layer.id())
-            if not tree_layer: return
-            
-            # Find matching node and toggle check state
-            nodes = model.layerLegendNodes(tree_layer)
-            for node in nodes:
-                node_key = node.data(Qt.UserRole)
-                if node_key == rule_key or str(node_key) == str(rule_key):
-                    current_state = node.data(Qt.CheckStateRole)
-                    new_state = Qt.Unchecked if current_state == Qt.Checked else Qt.Checked
-                    node.setData(new_state, Qt.CheckStateRole)
-                    break
-            
-            layer.triggerRepaint()
-            self.iface.mapCanvas().refresh()
-            self.update_legend()
+            found = self.class_nodes(layer)
+            if not found: return
+            renderer, nodes = found
+            node = nodes.get(rule_key)
+            if node is None or not node.flags() & Qt.ItemIsUserCheckable: return
+            self.apply_class_states(layer, renderer, [(rule_key, node, node.data(Qt.CheckStateRole) != Qt.Checked)])
         except Exception:
             pass
 
+    def solo_class(self, layer, rule_key):
+        """Shows only the given class of the layer."""
+        self.set_class_states(layer, lambda key, checked: key == rule_key)
+
+    def toggle_all_classes(self, layer):
+        """Inverts the visibility of every class of the layer."""
+        self.set_class_states(layer, lambda key, checked: not checked)
+
+    def class_nodes(self, layer):
+        """(renderer, {rule key: legend node}) of a layer, or None when it has no legend."""
+        if not layer or not layer.isValid(): return None
+        renderer = layer.renderer()
+        tree_layer = QgsProject.instance().layerTreeRoot().findLayer(layer.id())
+        if not renderer or not tree_layer: return None
+        model = self.iface.layerTreeView().layerTreeModel()
+        return renderer, self.node_index.nodes(layer, model, tree_layer)
+
+    def set_class_states(self, layer, decide):
+        """Applies new check states to many classes of a layer (solo, toggle all).
+
+        ``decide(rule_key, checked)`` returns the wanted state or None to keep it.
+        Nodes come from the per-layer index; every class is visited once, the
+        changes are then applied by ``apply_class_states``.
+        """
+        try:
+            found = self.class_nodes(layer)
+            if not found: return
+            renderer, nodes = found
+            changes = []
+            for rule_key, node in nodes.items():
+                if not node.flags() & Qt.ItemIsUserCheckable: continue
+                checked = node.data(Qt.CheckStateRole) == Qt.Checked
+                wanted = decide(rule_key, checked)
+                if wanted is None or wanted == checked: continue
+                changes.append((rule_key, node, wanted))
+            self.apply_class_states(layer, renderer, changes)
+        except Exception:
+            pass
+
+    def apply_class_states(self, layer, renderer, changes):
+        """Sets [(rule key, node, checked), ...] with a single repaint.
+
+        The renderer is updated directly so many classes cost one style change
+        and one repaint of this layer only, and only the affected legend rows
+        are redrawn. The style change does not expire the count cache, so
+        toggles never trigger a recount or a full legend rebuild.
+        """
+        if not changes: return
+        for rule_key, node, wanted in changes:
+            renderer.checkLegendSymbolItem(rule_key, wanted)
+            node.dataChanged.emit() # Keep the layer tree check box in sync
+        layer.emitStyleChanged()
+        layer.triggerRepaint()
+        if self.legend_model:
+            self.legend_model.set_checked(layer.id(), [(rule_key, wanted) for rule_key, node, wanted in changes])
+            self.legend_signature = self.compute_legend_signature()
+
     # --- Styles & Render ---
     def set_style_mode(self, mode):
         self.style_mode = mode
@@ -326,6 +569,7 @@ class EmbedLegendPlugin:
         if not self.dock_widget or sip.isdeleted(self.dock_widget): return
         
         self.header_widget.set_mode(self.style_mode)
+        self.legend_model.set_appearance(self.font_item, self.text_color, self.style_mode)
 
         if self.style_mode == "standard":
             self.dock_widget.setAttribute(Qt.WA_TranslucentBackground, False)
@@ -338,27 +582,28 @@ class EmbedLegendPlugin:
             panel_style = STYLE_PANEL_MINIMAL
             list_border = "none"; list_bg = "transparent"
 
-        self.list_widget.setStyleSheet(f"""
-            QListWidget {{ background-color: {list_bg}; border: {list_border}; outline: none; spacing: 1px; }}
-            QListWidget::item {{ height: 22px; padding-left: 8px; color: {self.text_color.name()}; }}
-            QListWidget::item:selected {{ background-color: transparent; color: #3498db; font-weight: bold; }}
-            QListWidget::item:hover {{ background-color: rgba(0,0,0,10); border-radius: 4px; }}
+        self.list_view.setStyleSheet(f"""
+            QListView {{ background-color: {list_bg}; border: {list_border}; outline: none; spacing: 1px; }}
+            QListView::item {{ height: 22px; padding-left: 8px; color: {self.text_color.name()}; }}
+            QListView::item:selected {{ background-color: transparent; color: #3498db; font-weight: bold; }}
+            QListView::item:hover {{ background-color: rgba(0,0,0,10); border-radius: 4px; }}
         """)
         self.panel.setStyleSheet(panel_style)
 
     def update_legend(self):
-        """Refreshes the legend list based on ALL selected layers."""
+        """Refreshes the legend list based on ALL selected layers (diffed against the current rows)."""
         if not self.dock_widget or sip.isdeleted(self.dock_widget): return
         try:
             if not self.dock_widget.isVisible(): return
             
-            self.list_widget.clear()
+            self.legend_signature = self.compute_legend_signature()
             
             # [FIX v6.9] Multi-Select Support
-            selected_layers = self.iface.layerTreeView().selectedLayers()
-            valid_layers = [l for l in selected_layers if isinstance(l, QgsVectorLayer)]
+            valid_layers = self.selected_vector_layers()
             
-            if not valid_layers: return
+            if not valid_layers:
+                self.apply_legend_sections([])
+                return
             
             # Update Header Title
             if len(valid_layers) > 1:
@@ -367,94 +612,70 @@ class EmbedLegendPlugin:
                 if not sip.isdeleted(self.header_widget):
                     self.header_widget.setText(valid_layers[0].name())
             
-            fm = QFontMetrics(self.font_item)
-            max_width = 0
-            total_items_count = 0
+            sections = []
+            model = self.iface.layerTreeView().layerTreeModel()
             
             # Loop through ALL valid selected layers
             for layer in valid_layers:
                 renderer = layer.renderer()
                 if not renderer: continue
                 
-                model = self.iface.layerTreeView().layerTreeModel()
                 tree_layer = QgsProject.instance().layerTreeRoot().findLayer(layer.id())
                 if not tree_layer: continue
                 
-                nodes = model.layerLegendNodes(tree_layer) if tree_layer else []
-                r_items = renderer.legendSymbolItems()
+                # Legend nodes, items and rule keys are cached until the renderer/legend changes
+                state = self.node_index.state(layer, model, tree_layer)
                 
-                # Add Layer Separator (If multiple layers)
-                if len(valid_layers) > 1:
-                    sep_item = QListWidgetItem(f"◆ {layer.name()}")
-                    sep_font = QFont(self.font_item)
-                    sep_font.setBold(True)
-                    sep_item.setFont(sep_font)
-                    sep_item.setFlags(Qt.NoItemFlags) # Non-selectable
-                    
-                    # Styling Separator
-                    if self.style_mode == "standard":
-                        sep_item.setBackground(QColor("#dfe6e9"))
-                        sep_item.setForeground(QColor("#2d3436"))
-                    else:
-                        sep_item.setForeground(QColor("#000000"))
-                        
-                    self.list_widget.addItem(sep_item)
-                    total_items_count += 1
-                    max_width = max(max_width, fm.horizontalAdvance(layer.name()) + 30)
-
-                # Calculate totals for percentage (Per Layer)
-                total_f = 0
-                for n in nodes:
-                    m = re.search(r"\[([\d\.,]+)\]", n.data(Qt.DisplayRole))
-                    if m: total_f += int(m.group(1).replace('.', '').replace(',', ''))
+                # Per-class counts from the background counter cache (None while counting)
+                counts = self.count_cache.counts(layer) if (self.show_count or self.show_percent) else None
                 
-                count = min(len(nodes), len(r_items))
-                
-                for i in range(count):
-                    node = nodes[i]
-                    raw = node.data(Qt.DisplayRole)
-                    is_checked = node.data(Qt.CheckStateRole) == Qt.Checked
-                    
-                    # Format Text
-                    match = re.search(r"\[([\d\.,]+)\]", raw)
-                    cnt = int(match.group(1).replace('.', '').replace(',', '')) if match else 0
-                    txt = raw if self.show_count else re.sub(r"\s*\[[\d\.,]+\]", "", raw)
-                    if self.show_percent and total_f > 0: txt += f" ({(cnt/total_f)*100:.1f}%)"
-                    
-                    # Calc width for resizing
-                    w = fm.horizontalAdvance(txt)
-                    max_width = max(max_width, w)
-                    
-                    # Create Item
-                    item = QListWidgetItem(QIcon(nodes[i].data(Qt.DecorationRole)), txt)
-                    item.setData(Qt.UserRole, layer)
-                    item.setData(Qt.UserRole + 1, r_items[i].ruleKey()) 
-                    
-                    # Apply Visual State (Strikethrough if unchecked)
-                    current_font = QFont(self.font_item)
-                    if not is_checked:
-                        current_font.setStrikeOut(True)
-                        item.setForeground(QColor("gray"))
-                    else:
-                        item.setForeground(self.text_color)
-                    
-                    item.setFont(current_font)
-                    self.list_widget.addItem(item)
-                    total_items_count += 1
+                # Rows are built by the model when fetched (layer separator if multiple layers)
+                sections.append(LegendLayerRows(
+                    layer, state, counts, self.show_count, self.show_percent, separator=len(valid_layers) > 1
+                ))
             
-            # Resize Panel Logic
-            final_width = max(125, max_width + 55)
-            # Dynamic Height based on items count
-            self.dock_widget.setFixedWidth(final_width)
-            self.dock_widget.resize(final_width, min(60 + (total_items_count * 22), 700))
+            self.apply_legend_sections(sections)
             
         except RuntimeError: pass
         except Exception: pass
 
+    def reset_legend_items(self):
+        """Re-applies fonts/colors to the model (drops cached widths) and rebuilds."""
+        if self.legend_model: self.legend_model.set_appearance(self.font_item, self.text_color, self.style_mode)
+        self.update_legend()
+
+    def apply_legend_sections(self, sections):
+        """Hands the layer rows to the virtualized model, which applies only the differences."""
+        self.legend_model.set_sections(sections)
+        if sections: self.fit_legend_panel()
+
+    def fit_legend_panel(self, *args):
+        """Sizes the panel to the rows fetched so far (called again when the view fetches more)."""
+        if not self.legend_model.visible_count() or not self.dock_widget or sip.isdeleted(self.dock_widget): return
+        
+        # Resize Panel Logic
+        max_width = self.legend_model.max_text_width()
+        final_width = max(125, max_width + 55)
+        # Dynamic Height based on items count
+        extra = self.filter_box.sizeHint().height() if self.show_filter else 0
+        self.dock_widget.setFixedWidth(final_width)
+        self.dock_widget.resize(final_width, min(60 + extra + (self.legend_model.visible_count() * 22), 700))
+
     # --- Menu & Interactions ---
     def show_context_menu(self, pos):
         if not self.dock_widget or sip.isdeleted(self.dock_widget): return
         menu = QMenu()
+        
+        # Class Visibility (row under the cursor)
+        index = self.list_view.indexAt(pos)
+        layer = index.data(Qt.UserRole) if index.isValid() else None
+        if layer:
+            rule_key = index.data(Qt.UserRole + 1)
+            if index.flags() & Qt.ItemIsEnabled:
+                menu.addAction(self.tr("menu_solo")).triggered.connect(lambda: self.solo_class(layer, rule_key))
+            menu.addAction(self.tr("menu_toggle_all")).triggered.connect(lambda: self.toggle_all_classes(layer))
+            menu.addSeparator()
+        
         menu.addAction(self.tr("menu_config")).setEnabled(False)
         menu.addAction(self.tr("menu_font")).triggered.connect(self.change_font)
         menu.addAction(self.tr("menu_text_color")).triggered.connect(self.change_text_color)
@@ -508,9 +729,70 @@ class EmbedLegendPlugin:
         act_pct.setChecked(self.show_percent)
         act_pct.triggered.connect(lambda: self.update_data_state("percent"))
         
+        act_filter = menu.addAction(self.tr("show_filter"))
+        act_filter.setCheckable(True)
+        act_filter.setChecked(self.show_filter)
+        act_filter.triggered.connect(self.toggle_filter_box)
+        
         menu.addSeparator()
         menu.addAction(self.tr("export_mif")).triggered.connect(self.export_manual_mif)
         menu.addAction(self.tr("export_kmz")).triggered.connect(self.export_kmz)
+        menu.addAction(self.tr("export_ogr")).triggered.connect(self.export_ogr)
+        
+        # Export Options Submenu
+        submenu_export = menu.addMenu(self.tr("menu_export_opts"))
+        act_schema = submenu_export.addAction(self.tr("opt_kmz_schema"))
+        act_schema.setCheckable(True)
+        act_schema.setChecked(self.kmz_schema_popup)
+        act_schema.triggered.connect(lambda checked: self.set_export_option("KmzSchemaPopup", "kmz_schema_popup", checked))
+        act_region = submenu_export.addAction(self.tr("opt_kmz_regionated"))
+        act_region.setCheckable(True)
+        act_region.setChecked(self.kmz_tile_size > 0)
+        act_region.triggered.connect(self.set_kmz_regionated)
+        act_fields = submenu_export.addAction(self.tr("opt_fields"))
+        act_fields.triggered.connect(self.choose_export_fields)
+        
+        # Export Scope Submenu
+        submenu_scope = submenu_export.addMenu(self.tr("opt_scope"))
+        for kind in SCOPES:
+            act_scope = submenu_scope.addAction(self.tr(f"scope_{kind}"))
+            act_scope.setCheckable(True)
+            act_scope.setChecked(self.export_scope == kind)
+            act_scope.triggered.connect(lambda checked, k=kind: self.set_export_scope(k))
+        act_spacing = submenu_export.addAction(self.tr("opt_label_spacing").format(self.label_spacing))
+        act_spacing.triggered.connect(self.set_label_spacing)
+        precision_txt = self.coord_precision if self.coord_precision >= 0 else self.tr("opt_full")
+        act_precision = submenu_export.addAction(self.tr("opt_precision").format(precision_txt))
+        act_precision.triggered.connect(self.set_coord_precision)
+        act_simplify = submenu_export.addAction(self.tr("opt_simplify").format(self.simplify_tolerance))
+        act_simplify.triggered.connect(self.set_simplify_tolerance)
+        act_zoom = submenu_export.addAction(self.tr("opt_simplify_zoom"))
+        act_zoom.setCheckable(True)
+        act_zoom.setChecked(self.simplify_by_zoom)
+        act_zoom.triggered.connect(lambda checked: self.set_export_option("SimplifyByZoom", "simplify_by_zoom", checked))
+        act_index = submenu_export.addAction(self.tr("opt_spatial_index"))
+        act_index.setCheckable(True)
+        act_index.setChecked(self.ogr_spatial_index)
+        act_index.triggered.connect(lambda checked: self.set_export_option("OgrSpatialIndex", "ogr_spatial_index", checked))
+        act_legend = submenu_export.addAction(self.tr("opt_kmz_legend"))
+        act_legend.setCheckable(True)
+        act_legend.setChecked(self.kmz_legend)
+        act_legend.triggered.connect(lambda checked: self.set_export_option("KmzLegend", "kmz_legend", checked))
+        act_dpi = submenu_export.addAction(self.tr("opt_legend_dpi").format(self.legend_dpi))
+        act_dpi.setEnabled(self.kmz_legend)
+        act_dpi.triggered.connect(self.set_legend_dpi)
+        act_threads = submenu_export.addAction(self.tr("opt_threads").format(self.export_workers))
+        act_threads.triggered.connect(self.set_export_workers)
+        submenu_export.addSeparator()
+        act_profile = submenu_export.addAction(self.tr("opt_profile"))
+        act_profile.setCheckable(True)
+        act_profile.setChecked(self.profile_exports)
+        act_profile.triggered.connect(lambda checked: self.set_export_option("ProfileExports", "profile_exports", checked))
+        act_report = submenu_export.addAction(self.tr("opt_profile_report"))
+        act_report.setCheckable(True)
+        act_report.setChecked(self.profile_report)
+        act_report.setEnabled(self.profile_exports)
+        act_report.triggered.connect(lambda checked: self.set_export_option("ProfileReport", "profile_report", checked))
         menu.addSeparator()
         menu.addAction(self.tr("about")).triggered.connect(self.show_about)
         menu.exec_(QCursor.pos())
@@ -521,6 +803,128 @@ class EmbedLegendPlugin:
         self.settings.setValue("EmbedLegend/Lang", code)
         self.update_legend()
 
+    def set_export_option(self, setting_key, attr, value):
+        setattr(self, attr, value)
+        self.settings.setValue(f"EmbedLegend/{setting_key}", value)
+
+    def set_kmz_regionated(self, checked):
+        size = 0
+        if checked:
+            size, ok = QInputDialog.getInt(
+                self.iface.mainWindow(), self.tr("opt_kmz_regionated"), self.tr("opt_tile_size"),
+                self.kmz_tile_size or DEFAULT_TILE_FEATURES, 100, 1000000, 500
+            )
+            if not ok: return
+        self.set_export_option("KmzTileSize", "kmz_tile_size", size)
+
+    def choose_export_fields(self):
+        """Picks the attributes written to popups / MID columns for the active layer."""
+        layer = self.iface.activeLayer()
+        if not layer or not isinstance(layer, QgsVectorLayer): return
+        dlg = ExportFieldsDialog(layer, f"{self.tr('opt_fields')} - {layer.name()}", self.tr("fields_hint"), self.iface.mainWindow())
+        if dlg.exec_(): set_export_field_names(layer, dlg.selected_fields())
+
+    def set_export_scope(self, kind):
+        # Picking "Custom Polygon" always (re)draws the polygon
+        if kind == SCOPE_POLYGON:
+            self.start_polygon_tool()
+            return
+        self.set_export_option("ExportScope", "export_scope", kind)
+
+    def start_polygon_tool(self):
+        canvas = self.iface.mapCanvas()
+        if self.polygon_tool is None:
+            self.polygon_tool = PolygonCaptureTool(canvas)
+            self.polygon_tool.captured.connect(self.on_polygon_captured)
+            self.polygon_tool.canceled.connect(self.stop_polygon_tool)
+        if canvas.mapTool() is not self.polygon_tool: self.previous_map_tool = canvas.mapTool()
+        canvas.setMapTool(self.polygon_tool)
+        self.iface.messageBar().pushInfo("Embed Legend", self.tr("scope_draw_hint"))
+
+    def stop_polygon_tool(self):
+        canvas = self.iface.mapCanvas()
+        if self.polygon_tool and canvas.mapTool() is self.polygon_tool:
+            if self.previous_map_tool and not sip.isdeleted(self.previous_map_tool): canvas.setMapTool(self.previous_map_tool)
+            else: canvas.unsetMapTool(self.polygon_tool)
+        self.previous_map_tool = None
+
+    def on_polygon_captured(self, geom):
+        self.scope_polygon = (geom, self.iface.mapCanvas().mapSettings().destinationCrs())
+        self.set_export_option("ExportScope", "export_scope", SCOPE_POLYGON)
+        self.stop_polygon_tool()
+
+    def current_export_scope(self, layers):
+        """ExportScope for the chosen scope, or False (after warning) when it cannot be used."""
+        kind = self.export_scope
+        canvas = self.iface.mapCanvas()
+        if kind == SCOPE_FULL: return None
+        if kind == SCOPE_SELECTED:
+            if not any(layer.selectedFeatureCount() for layer in layers):
+                QMessageBox.warning(None, self.tr("warning"), self.tr("scope_no_selection"))
+                return False
+            return ExportScope(SCOPE_SELECTED)
+        if kind == SCOPE_EXTENT:
+            return ExportScope(SCOPE_EXTENT, QgsGeometry.fromRect(canvas.extent()),
+                               canvas.mapSettings().destinationCrs(), self.index_cache)
+        if self.scope_polygon is None:
+            QMessageBox.warning(None, self.tr("warning"), self.tr("scope_no_polygon"))
+            self.start_polygon_tool()
+            return False
+        geom, crs = self.scope_polygon
+        return ExportScope(SCOPE_POLYGON, geom, crs, self.index_cache)
+
+    def set_label_spacing(self):
+        spacing, ok = QInputDialog.getInt(
+            self.iface.mainWindow(), self.tr("menu_export_opts"), self.tr("opt_label_spacing_prompt"),
+            self.label_spacing, 0, 100000, 50
+        )
+        if ok: self.set_export_option("LabelSpacing", "label_spacing", spacing)
+
+    def set_coord_precision(self):
+        decimals, ok = QInputDialog.getInt(
+            self.iface.mainWindow(), self.tr("menu_export_opts"), self.tr("opt_precision_prompt"),
+            self.coord_precision, -1, 12, 1
+        )
+        if ok: self.set_export_option("CoordPrecision", "coord_precision", decimals)
+
+    def set_simplify_tolerance(self):
+        tolerance, ok = QInputDialog.getDouble(
+            self.iface.mainWindow(), self.tr("menu_export_opts"), self.tr("opt_simplify_prompt"),
+            self.simplify_tolerance, 0.0, 100000.0, 1
+        )
+        if ok: self.set_export_option("SimplifyTolerance", "simplify_tolerance", tolerance)
+
+    def export_geometry_options(self):
+        """(precision, simplify) arguments shared by the export tasks."""
+        return (self.coord_precision if self.coord_precision >= 0 else None), self.simplify_tolerance
+
+    def set_legend_dpi(self):
+        dpi, ok = QInputDialog.getInt(
+            self.iface.mainWindow(), self.tr("menu_export_opts"), self.tr("opt_legend_dpi_prompt"),
+            self.legend_dpi, 48, 600, 24
+        )
+        if ok: self.set_export_option("LegendDpi", "legend_dpi", dpi)
+
+    def export_profiler(self, path):
+        """ExportProfiler for an export to ``path`` (JSON report next to it), or None when timings are off."""
+        if not self.profile_exports: return None
+        return ExportProfiler(path + REPORT_SUFFIX if self.profile_report else None)
+
+    def set_export_workers(self):
+        workers, ok = QInputDialog.getInt(
+            self.iface.mainWindow(), self.tr("menu_export_opts"), self.tr("opt_threads_prompt"),
+            self.export_workers, 1, 64, 1
+        )
+        if ok: self.set_export_option("ExportThreads", "export_workers", workers)
+
+    def toggle_filter_box(self, checked):
+        self.show_filter = checked
+        self.settings.setValue("EmbedLegend/ShowFilter", checked)
+        if self.filter_box and not sip.isdeleted(self.filter_box):
+            if not checked: self.filter_box.clear()
+            self.filter_box.setVisible(checked)
+        self.update_legend()
+
     def update_data_state(self, key):
         if key == "count": self.show_count = not self.show_count
         else: self.show_percent = not self.show_percent
@@ -528,11 +932,11 @@ class EmbedLegendPlugin:
 
     def change_font(self):
         f, ok = QFontDialog.getFont(self.font_item)
-        if ok: self.font_item = f; self.update_legend()
+        if ok: self.font_item = f; self.reset_legend_items()
 
     def change_text_color(self):
         c = QColorDialog.getColor(self.text_color)
-        if c.isValid(): self.text_color = c; self.apply_styles(); self.update_legend()
+        if c.isValid(): self.text_color = c; self.apply_styles(); self.reset_legend_items()
 
     def change_bg(self):
         c = QColorDialog.getColor(self.bg_color)
@@ -589,255 +993,106 @@ class EmbedLegendPlugin:
         if not layer or not isinstance(layer, QgsVectorLayer):
             QMessageBox.warning(None, self.tr("warning"), self.tr("select_layer"))
             return
+        scope = self.current_export_scope([layer])
+        if scope is False: return
             
         mif_path, _ = QFileDialog.getSaveFileName(None, self.tr("export_mif"), "", "MapInfo Interchange (*.mif)")
         if not mif_path: return
         mid_path = os.path.splitext(mif_path)[0] + ".mid"
         
-        total_feat = layer.featureCount()
-        progress = QProgressDialog("Exporting MIF...", "Abort", 0, total_feat, self.iface.mainWindow())
-        progress.setWindowModality(Qt.WindowModal); progress.setMinimumDuration(0)
-        
         try:
-            source_crs = layer.crs()
-            dest_crs = QgsCoordinateReferenceSystem("EPSG:4326")
-            tr = QgsCoordinateTransform(source_crs, dest_crs, QgsProject.instance())
-            context = QgsRenderContext()
-            renderer = layer.renderer()
-            renderer.startRender(context, layer.fields())
-            
-            with open(mif_path, 'w', encoding='latin-1', errors='replace') as f_mif, \
-                 open(mid_path, 'w', encoding='latin-1', errors='replace', newline='') as f_mid:
-                
-                # Header MIF
-                f_mif.write("Version 300\nCharset \"WindowsLatin1\"\nDelimiter \",\"\nCoordSys Earth Projection 1, 104\n")
-                fields = layer.fields()
-                f_mif.write(f"Columns {len(fields)}\n")
-                
-                for field in fields:
-                    col_name = "".join(x for x in field.name() if x.isalnum() or x == "_")[:10]
-                    if not col_name: col_name = f"Col_{fields.indexOf(field)}"
-                    f_type = "Char(254)"
-                    if field.isNumeric():
-                        if field.type() == QVariant.Int: f_type = "Integer"
-                        elif field.type() == QVariant.Double: f_type = "Float"
-                    f_mif.write(f"  {col_name} {f_type}\n")
-                
-                f_mif.write("Data\n\n")
-                writer = csv.writer(f_mid, quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                
-                for i, feat in enumerate(layer.getFeatures()):
-                    if progress.wasCanceled(): break
-                    progress.setValue(i)
-                    try:
-                        attrs = [str(a) if a != None else "" for a in feat.attributes()]
-                        writer.writerow(attrs)
-                        
-                        geom = QgsGeometry(feat.geometry())
-                        if not geom or geom.isEmpty(): f_mif.write("None\n"); continue
-                        try: geom.transform(tr) 
-                        except: pass 
-                        
-                        wkb_type = geom.wkbType()
-                        sym = renderer.symbolForFeature(feat, context)
-                        color_int = 0
-                        if sym: 
-                            c = sym.color()
-                            color_int = (c.red() * 65536) + (c.green() * 256) + c.blue()
-                            
-                        # Geometry Handling
-                        if QgsWkbTypes.geometryType(wkb_type) == QgsWkbTypes.PointGeometry:
-                            pt = geom.asMultiPoint()[0] if geom.isMultipart() else geom.asPoint()
-                            f_mif.write(f"Point {pt.x()} {pt.y()}\n")
-                            f_mif.write(f'    Symbol (108, {color_int}, 8, "Wingdings", 0, 0)\n')
-                        elif QgsWkbTypes.geometryType(wkb_type) == QgsWkbTypes.LineGeometry:
-                            lines = geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
-                            for line in lines:
-                                f_mif.write(f"Pline {len(line)}\n")
-                                for p in line: f_mif.write(f"{p.x()} {p.y()}\n")
-                                f_mif.write(f"    Pen (2, 2, {color_int})\n")
-                        elif QgsWkbTypes.geometryType(wkb_type) == QgsWkbTypes.PolygonGeometry:
-                            all_rings = []
-                            if geom.isMultipart():
-                                for poly in geom.asMultiPolygon():
-                                    for ring in poly: all_rings.append(ring)
-                            else:
-                                for ring in geom.asPolygon(): all_rings.append(ring)
-                            f_mif.write(f"Region {len(all_rings)}\n")
-                            for ring in all_rings:
-                                f_mif.write(f"  {len(ring)}\n"); 
-                                for p in ring: f_mif.write(f"    {p.x()} {p.y()}\n")
-                            f_mif.write(f"    Pen (1, 2, {color_int})\n"); f_mif.write(f"    Brush (2, {color_int})\n")
-                    except Exception: 
-                        f_mif.write("None\n")
-            
-            renderer.stopRender(context)
-            progress.setValue(total_feat)
-            
-            folder_path = os.path.dirname(mif_path)
-            msg = QMessageBox()
-            msg.setIcon(QMessageBox.Information)
-            msg.setWindowTitle(self.tr("success"))
-            msg.setText(self.tr("export_success"))
-            msg.setInformativeText(self.tr("file_saved").format(mif_path))
-            btn_open = msg.addButton("Open Folder", QMessageBox.ActionRole)
-            msg.addButton("Close", QMessageBox.RejectRole)
-            msg.exec_()
-            if msg.clickedButton() == btn_open: 
-                QDesktopServices.openUrl(QUrl.fromLocalFile(folder_path))
+            precision, simplify = self.export_geometry_options()
+            task = MifExportTask(layer, mif_path, mid_path, self.export_workers, scope, precision, simplify,
+                                 self.export_profiler(mif_path))
+            self.start_export_task(task, "Critical Error")
         except Exception as e: 
             QMessageBox.critical(None, "Critical Error", str(e))
 
     def export_kmz(self, mode="auto"):
-        layer = self.iface.activeLayer()
-        if not layer: return
+        # All layers selected in the Layers panel go into one KMZ (one folder each)
+        layers = self.selected_vector_layers()
+        if not layers:
+            layer = self.iface.activeLayer()
+            if not layer or not isinstance(layer, QgsVectorLayer): return
+            layers = [layer]
+        scope = self.current_export_scope(layers)
+        if scope is False: return
         
         path, _ = QFileDialog.getSaveFileName(None, self.tr("export_kmz"), "", "Google Earth (*.kmz)")
         if not path: return
         
-        # STRICT IDENTIFIER DETECTION
-        target_cols = ["SiteID", "Site_ID", "SITEID", "SITE_ID", "EnodeB", "eNB", "Site", "SiteName"]
-        fields = layer.fields()
-        field_names = [f.name() for f in fields]
-        label_col = None
-        
-        for p in target_cols:
-            for f in field_names:
-                if f.lower() == p.lower():
-                    label_col = f
-                    break
-            if label_col: break
-
-        total_feat = layer.featureCount()
-        progress = QProgressDialog("Exporting KMZ...", "Abort", 0, total_feat, self.iface.mainWindow())
-        progress.setWindowModality(Qt.WindowModal); progress.setMinimumDuration(0)
-        
         try:
-            temp_dir = tempfile.mkdtemp()
-            kml_path = os.path.join(temp_dir, "doc.kml")
-            img_path = os.path.join(temp_dir, "legend.png")
-            
-            if self.dock_widget and self.dock_widget.isVisible():
-                self.list_widget.clearSelection()
-                self.dock_widget.grab().save(img_path, "PNG")
+            legend_png = self.render_legend_png(layers) if self.kmz_legend else None
             
-            context = QgsRenderContext()
-            renderer = layer.renderer()
-            renderer.startRender(context, layer.fields())
-            tr = QgsCoordinateTransform(layer.crs(), QgsCoordinateReferenceSystem("EPSG:4326"), QgsProject.instance())
-            
-            kml_parts = ['<?xml version="1.0" encoding="UTF-8"?>', '<kml xmlns="http://www.opengis.net/kml/2.2">', '<Document>']
-            labeled_sites = set() # Anti-overlap tracker
-
-            for i, feat in enumerate(layer.getFeatures()):
-                if progress.wasCanceled(): break
-                progress.setValue(i)
-                try: 
-                    if not feat.hasGeometry(): continue
-                    geom = feat.geometry()
-                    sym = renderer.symbolForFeature(feat, context)
-                    if not sym: continue
-                    
-                    color = sym.color()
-                    kml_color = f"ff{color.blue():02x}{color.green():02x}{color.red():02x}"
-                    poly_color = f"bf{color.blue():02x}{color.green():02x}{color.red():02x}"
-                    
-                    try: geom.transform(tr)
-                    except: pass
-                    
-                    wkb_type = geom.wkbType()
-                    
-                    # Common Description Table
-                    desc_table = "<table border='1' width='300'>"
-                    for idx, val in enumerate(feat.attributes()): 
-                        val_str = str(val) if val is not None else "-"
-                        desc_table += f"<tr><td>{field_names[idx]}</td><td>{val_str}</td></tr>"
-                    desc_table += "</table>"
-                    
-                    # Point Processing (Clean: No Name Label)
-                    if QgsWkbTypes.geometryType(wkb_type) == QgsWkbTypes.PointGeometry:
-                        p = geom.centroid(); pt = p.asPoint()
-                        kml_parts.append('<Placemark>')
-                        kml_parts.append('<name></name>') # Force Empty Name
-                        kml_parts.append(f'<description><![CDATA[{desc_table}]]></description>')
-                        kml_parts.append(f'<Style><IconStyle><color>{kml_color}</color><scale>0.7</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/shaded_dot.png</href></Icon></IconStyle></Style>')
-                        kml_parts.append(f'<Point><coordinates>{pt.x()},{pt.y()},0</coordinates></Point></Placemark>')
-                    
-                    # Polygon Processing (Clean Grid: No Name Label)
-                    elif QgsWkbTypes.geometryType(wkb_type) == QgsWkbTypes.PolygonGeometry:
-                        kml_parts.append(f'<Placemark><name></name><description><![CDATA[{desc_table}]]></description>')
-                        kml_parts.append(f'<Style><LineStyle><color>{kml_color}</color><width>1</width></LineStyle><PolyStyle><color>{poly_color}</color><fill>1</fill><outline>1</outline></PolyStyle></Style>')
-                        
-                        polys = geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
-                        kml_parts.append('<MultiGeometry>')
-                        for poly in polys:
-                            outer_coords = " ".join([f"{p.x()},{p.y()},0" for p in poly[0]])
-                            kml_parts.append(f'<Polygon><outerBoundaryIs><LinearRing><coordinates>{outer_coords}</coordinates></LinearRing></outerBoundaryIs>')
-                            for i in range(1, len(poly)): 
-                                inner_coords = " ".join([f"{p.x()},{p.y()},0" for p in poly[i]])
-                                kml_parts.append(f'<innerBoundaryIs><LinearRing><coordinates>{inner_coords}</coordinates></LinearRing></innerBoundaryIs>')
-                            kml_parts.append('</Polygon>')
-                        kml_parts.append('</MultiGeometry></Placemark>')
-                        
-                        # --- Smart Labeling Logic (Strictly for Sectoral/Polygons with SiteID) ---
-                        if label_col:
-                            site_id = str(feat[label_col])
-                            if site_id not in labeled_sites:
-                                center = geom.centroid().asPoint()
-                                kml_parts.append(f'''
-                                <Placemark>
-                                    <name>{site_id}</name>
-                                    <Style>
-                                        <IconStyle><scale>0</scale></IconStyle>
-                                        <LabelStyle><scale>0.9</scale><color>ff00ffff</color></LabelStyle>
-                                    </Style>
-                                    <Point><coordinates>{center.x()},{center.y()},0</coordinates></Point>
-                                </Placemark>
-                                ''')
-                                labeled_sites.add(site_id)
-
-                    # Line Processing (Clean: No Name Label)
-                    elif QgsWkbTypes.geometryType(wkb_type) == QgsWkbTypes.LineGeometry:
-                        kml_parts.append(f'<Placemark><name></name><description><![CDATA[{desc_table}]]></description>')
-                        kml_parts.append(f'<Style><LineStyle><color>{kml_color}</color><width>2</width></LineStyle></Style>')
-                        
-                        lines = geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
-                        kml_parts.append('<MultiGeometry>')
-                        for line in lines:
-                            coords = " ".join([f"{p.x()},{p.y()},0" for p in line])
-                            kml_parts.append(f'<LineString><coordinates>{coords}</coordinates></LineString>')
-                        kml_parts.append('</MultiGeometry></Placemark>')
-
-                except: continue 
-            
-            renderer.stopRender(context)
-            progress.setValue(total_feat)
-            
-            # Pack KML + Image
-            if os.path.exists(img_path): 
-                kml_parts.append('<ScreenOverlay><name>Legend</name><Icon><href>legend.png</href></Icon><overlayXY x="0" y="1" xunits="fraction" yunits="fraction"/><screenXY x="0.01" y="0.99" xunits="fraction" yunits="fraction"/></ScreenOverlay>')
-            kml_parts.append('</Document></kml>')
-            
-            with open(kml_path, "w", encoding="utf-8") as f: 
-                f.write("\n".join(kml_parts))
-            
-            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
-                z.write(kml_path, "doc.kml")
-                if os.path.exists(img_path): z.write(img_path, "legend.png")
-            
-            shutil.rmtree(temp_dir)
-            folder_path = os.path.dirname(path)
-            
-            msg = QMessageBox()
-            msg.setIcon(QMessageBox.Information)
-            msg.setWindowTitle(self.tr("success"))
-            msg.setText(self.tr("export_success"))
-            msg.setInformativeText(self.tr("file_saved").format(path))
-            btn_open = msg.addButton("Open Folder", QMessageBox.ActionRole)
-            msg.addButton("Close", QMessageBox.RejectRole)
-            msg.exec_()
-            if msg.clickedButton() == btn_open: 
-                QDesktopServices.openUrl(QUrl.fromLocalFile(folder_path))
-                
+            attribute_mode = "schema" if self.kmz_schema_popup else "table"
+            precision, simplify = self.export_geometry_options()
+            task = KmzExportTask(layers, path, legend_png, attribute_mode, self.kmz_tile_size, self.export_workers, scope,
+                                 self.label_spacing, precision, simplify, self.simplify_by_zoom, self.export_profiler(path))
+            self.start_export_task(task, "Error")
         except Exception as e: 
-            QMessageBox.critical(None, "Error", str(e))
\ No newline at end of file
+            QMessageBox.critical(None, "Error", str(e))
+
+    def export_ogr(self):
+        layer = self.iface.activeLayer()
+        if not layer or not isinstance(layer, QgsVectorLayer):
+            QMessageBox.warning(None, self.tr("warning"), self.tr("select_layer"))
+            return
+        scope = self.current_export_scope([layer])
+        if scope is False: return
+
+        path, selected = QFileDialog.getSaveFileName(
+            None, self.tr("export_ogr"), "", "GeoPackage (*.gpkg);;FlatGeobuf (*.fgb)"
+        )
+        if not path: return
+        if os.path.splitext(path)[1].lower() not in OGR_DRIVERS:
+            path += ".fgb" if "fgb" in selected else ".gpkg"
+
+        try:
+            task = OgrExportTask(layer, path, self.export_workers, scope, self.ogr_spatial_index, self.export_profiler(path))
+            self.start_export_task(task, "Critical Error")
+        except Exception as e:
+            QMessageBox.critical(None, "Critical Error", str(e))
+
+    def start_export_task(self, task, error_title):
+        """Hands an export over to the QGIS task manager (progress & cancel live there)."""
+        self.active_tasks.add(task)
+        # Throttled "done / total, features/s, ETA" line in the status bar
+        task.status.connect(lambda text: self.iface.statusBarIface().showMessage(f"{task.description()}: {text}"))
+        task.taskCompleted.connect(lambda: self.on_export_finished(task, True, error_title))
+        task.taskTerminated.connect(lambda: self.on_export_finished(task, False, error_title))
+        QgsApplication.taskManager().addTask(task)
+
+    def on_export_finished(self, task, ok, error_title):
+        self.active_tasks.discard(task)
+        self.iface.statusBarIface().clearMessage()
+        if ok:
+            self.show_export_success(task.path)
+        elif task.exception is not None:
+            QMessageBox.critical(None, error_title, str(task.exception))
+
+    def show_export_success(self, path):
+        folder_path = os.path.dirname(path)
+        
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Information)
+        msg.setWindowTitle(self.tr("success"))
+        msg.setText(self.tr("export_success"))
+        msg.setInformativeText(self.tr("file_saved").format(path))
+        btn_open = msg.addButton("Open Folder", QMessageBox.ActionRole)
+        msg.addButton("Close", QMessageBox.RejectRole)
+        msg.exec_()
+        if msg.clickedButton() == btn_open: 
+            QDesktopServices.openUrl(QUrl.fromLocalFile(folder_path))
+
+    def render_legend_png(self, layers):
+        """Draws the legend of the exported layers offscreen, in the panel's current style (cached PNG bytes)."""
+        style = LegendStyle(
+            self.font_item, self.text_color, self.bg_color, self.border_color, self.style_mode,
+            self.show_count, self.show_percent
+        )
+        counts = {}
+        if self.show_count or self.show_percent:
+            for layer in layers:
+                layer_counts = self.count_cache.counts(layer) # None while still counting
+                if layer_counts is not None: counts[layer.id()] = layer_counts
+        return self.legend_images.png([LegendSection(layer) for layer in layers], style, self.legend_dpi, counts)
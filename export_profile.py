@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : export_profile
+#  DESCRIPTION : Optional per-phase instrumentation of the export engines
+# ==============================================================================
+
+import json
+import os
+import sys
+import threading
+import time
+
+from qgis.core import QgsMessageLog, Qgis
+
+LOG_TAG = "Embed Legend"
+# Suffix of the JSON timing report written next to the exported file
+REPORT_SUFFIX = ".timing.json"
+
+# Phases in report order (anything else is listed after them)
+PHASES = ("fetch", "symbol", "geometry", "transform", "format", "write", "merge", "zip", "progress")
+
+
+def peak_rss_mb():
+    """Peak resident set size of the QGIS process, or None where ``resource`` is unavailable."""
+    try: import resource
+    except ImportError: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1) # bytes on macOS, KiB elsewhere
+
+
+class _ThreadStats:
+    def __init__(self):
+        self.phases = {}  # name -> [exclusive seconds, calls]
+        self.counters = {} # name -> int
+        self.stack = []   # [[start, child seconds], ...] of the open phases
+
+
+class _Phase:
+    __slots__ = ("profiler", "name")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler._exit(self.name)
+        return False
+
+
+class ExportProfiler:
+    """Accumulates wall time and call counts per export phase, plus counters.
+
+    Phase times are exclusive: a ``zip`` flush triggered while a placemark is
+    being formatted is charged to ``zip`` only, so the phases of one thread
+    add up to the time that thread spent in the export. Statistics are kept
+    per thread (no lock on the hot path) and merged by ``summary``; with chunk
+    workers the phase total is therefore thread time and can exceed the wall
+    time.
+    """
+
+    enabled = True
+
+    def __init__(self, report_path=None):
+        self.report_path = report_path
+        self._local = threading.local()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = None
+        self._wall = 0.0
+
+    # --- Collection ---------------------------------------------------------
+    def _stats(self):
+        stats = getattr(self._local, "stats", None)
+        if stats is None:
+            stats = self._local.stats = _ThreadStats()
+            with self._lock: self._threads.append(stats)
+        return stats
+
+    def _enter(self):
+        self._stats().stack.append([time.perf_counter(), 0.0])
+
+    def _exit(self, name):
+        stats = self._stats()
+        start, child = stats.stack.pop()
+        elapsed = time.perf_counter() - start
+        if stats.stack: stats.stack[-1][1] += elapsed
+        entry = stats.phases.get(name)
+        if entry is None: entry = stats.phases[name] = [0.0, 0]
+        entry[0] += elapsed - child
+        entry[1] += 1
+
+    def phase(self, name):
+        """Context manager timing one occurrence of a phase."""
+        return _Phase(self, name)
+
+    def timed(self, name, func):
+        """Wraps ``func`` so every call is timed as ``name``."""
+        def call(*args, **kwargs):
+            self._enter()
+            try: return func(*args, **kwargs)
+            finally: self._exit(name)
+        return call
+
+    def features(self, iterable, name="fetch", counter="features"):
+        """Iterates a feature iterator, timing each fetch as ``name`` and counting the features in ``counter``."""
+        iterator = iter(iterable)
+        stats = self._stats()
+        while True:
+            self._enter()
+            try: feat = next(iterator)
+            except StopIteration: return
+            finally: self._exit(name)
+            stats.counters[counter] = stats.counters.get(counter, 0) + 1
+            yield feat
+
+    def count(self, name, n=1):
+        counters = self._stats().counters
+        counters[name] = counters.get(name, 0) + n
+
+    def start(self):
+        self._started = time.perf_counter()
+
+    def stop(self):
+        if self._started is not None: self._wall = time.perf_counter() - self._started
+
+    # --- Report -------------------------------------------------------------
+    def summary(self, title="", output_paths=()):
+        phases, counters = {}, {}
+        with self._lock: threads = list(self._threads)
+        for stats in threads:
+            for name, (seconds, calls) in list(stats.phases.items()):
+                entry = phases.setdefault(name, [0.0, 0])
+                entry[0] += seconds; entry[1] += calls
+            for name, value in list(stats.counters.items()): counters[name] = counters.get(name, 0) + value
+        order = [p for p in PHASES if p in phases] + sorted(p for p in phases if p not in PHASES)
+        output_bytes = sum(os.path.getsize(p) for p in output_paths if p and os.path.exists(p))
+        return {
+            "title": title,
+            "outputs": [p for p in output_paths if p],
+            "wall_s": round(self._wall, 3),
+            "threads": len(threads),
+            "phases": {name: {"seconds": round(phases[name][0], 3), "calls": phases[name][1]} for name in order},
+            "counters": counters,
+            "output_bytes": output_bytes,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+    def report(self, title, output_paths=()):
+        """Logs the summary to the QGIS message log and writes the JSON report if requested."""
+        summary = self.summary(title, output_paths)
+        total = sum(p["seconds"] for p in summary["phases"].values()) or 1.0
+        features = summary["counters"].get("features", 0)
+        lines = [
+            f"{title}: {summary['wall_s']:.2f} s wall, {summary['threads']} thread(s), "
+            f"{features:,} features" + (f" ({features / summary['wall_s']:,.0f}/s)" if summary['wall_s'] > 0 else "")
+        ]
+        for name, p in summary["phases"].items():
+            lines.append(f"  {name:<10} {p['seconds']:>9.3f} s {100.0 * p['seconds'] / total:>5.1f}% {p['calls']:>12,} calls")
+        for name, value in summary["counters"].items():
+            if name != "features": lines.append(f"  {name:<10} {value:>,}")
+        lines.append(f"  output     {summary['output_bytes']:>,} bytes")
+        if summary["peak_rss_mb"] is not None: lines.append(f"  peak RSS   {summary['peak_rss_mb']:.1f} MB")
+
+        if self.report_path:
+            try:
+                with open(self.report_path, "w", encoding="utf-8") as f: json.dump(summary, f, indent=2)
+                lines.append(f"  report     {self.report_path}")
+            except OSError as e:
+                lines.append(f"  report     not written: {e}")
+        QgsMessageLog.logMessage("\n".join(lines), LOG_TAG, Qgis.Info)
+        return summary
+
+
+class NullProfiler:
+    """Stand-in used when instrumentation is off: every hook is a no-op."""
+
+    enabled = False
+    report_path = None
+
+    class _NoPhase:
+        __slots__ = ()
+        def __enter__(self): pass
+        def __exit__(self, exc_type, exc, tb): return False
+
+    _no_phase = _NoPhase()
+
+    def phase(self, name):
+        return self._no_phase
+
+    def timed(self, name, func):
+        return func
+
+    def features(self, iterable, name="fetch", counter="features"):
+        return iterable
+
+    def count(self, name, n=1): pass
+
+    def start(self): pass
+
+    def stop(self): pass
+
+    def report(self, title, output_paths=()):
+        return None
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : export_progress
+#  DESCRIPTION : Throttled progress, throughput / ETA and cheap cancel checks
+#                shared by the export engines
+# ==============================================================================
+
+import time
+
+# Minimum seconds between two progress updates sent to the task manager
+PROGRESS_INTERVAL = 0.1
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class ExportProgress:
+    """Progress and cancellation state of one export task.
+
+    The engines report after every feature; ``report`` only forwards to
+    ``task.setProgress`` (a cross-thread signal repainting the task manager)
+    and to the ``status`` callback once per ``interval``. Throughput is
+    measured in progress-weighted features (percent of the total), so
+    multi-pass exports (regionated KMZ) keep a steady rate and ETA.
+
+    ``canceled`` is a plain attribute set by the task's ``cancel``, so the
+    hot loops test it without a call into QgsTask.
+    """
+
+    def __init__(self, task, interval=PROGRESS_INTERVAL, status=None):
+        self.task = task
+        self.interval = interval
+        self.status = status # callable(text), e.g. the task's status signal
+        self.canceled = False
+        self.started = None
+        self.rate = 0.0  # features / s
+        self.eta = None  # seconds left, None until the first estimate
+        self._next = 0.0
+
+    def start(self):
+        self.started = time.monotonic()
+        self._next = self.started + self.interval
+
+    def due(self):
+        return time.monotonic() >= self._next
+
+    def report(self, percent, total):
+        """Forwards ``percent`` (0-100) of ``total`` features when the interval has elapsed."""
+        now = time.monotonic()
+        if now < self._next or self.started is None: return
+        self._next = now + self.interval
+        percent = max(0.0, min(100.0, percent))
+        elapsed = now - self.started
+        done = total * percent / 100.0
+        self.rate = done / elapsed if elapsed > 0 else 0.0
+        self.eta = elapsed * (100.0 - percent) / percent if percent > 0 else None
+        self.task.setProgress(percent)
+        if self.status: self.status(self.status_text(done, total))
+
+    def status_text(self, done, total):
+        text = f"{int(done):,} / {total:,} features, {self.rate:,.0f}/s"
+        if self.eta is not None: text += f", ETA {format_duration(self.eta)}"
+        return text
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : export_scope
+#  DESCRIPTION : Export scopes (canvas extent, selection, polygon) and their
+#                per-layer spatial index cache
+# ==============================================================================
+
+from array import array
+
+from qgis.PyQt.QtCore import QObject
+from qgis.core import (
+    QgsProject, QgsGeometry, QgsCoordinateTransform, QgsFeatureRequest,
+    QgsFeatureSource, QgsSpatialIndex, QgsExpression, QgsExpressionContext
+)
+
+SCOPE_FULL = "full"
+SCOPE_EXTENT = "extent"
+SCOPE_SELECTED = "selected"
+SCOPE_POLYGON = "polygon"
+SCOPES = (SCOPE_FULL, SCOPE_EXTENT, SCOPE_SELECTED, SCOPE_POLYGON)
+
+
+class SpatialIndexCache(QObject):
+    """QgsSpatialIndex per layer, for providers without a spatial index of their own.
+
+    An index is built once by the first scoped export (on its worker thread)
+    and reused until the layer's features or geometries change. ``watch`` runs
+    on the main thread and returns a generation number; an index built for an
+    older generation is discarded instead of being cached.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._indexes = {}     # layer id -> QgsSpatialIndex
+        self._generation = {}  # layer id -> int
+        self._watched = {}     # layer id -> [(signal, slot), ...]
+
+    def watch(self, layer):
+        layer_id = layer.id()
+        if layer_id not in self._watched:
+            expire = lambda *args: self.invalidate(layer_id)
+            forget = lambda *args: self._forget(layer_id)
+            connections = [
+                (layer.dataChanged, expire),
+                (layer.geometryChanged, expire),
+                (layer.featureAdded, expire),
+                (layer.featureDeleted, expire),
+                (layer.willBeDeleted, forget),
+            ]
+            for signal, slot in connections: signal.connect(slot)
+            self._watched[layer_id] = connections
+        return self._generation.setdefault(layer_id, 0)
+
+    def get(self, layer_id):
+        return self._indexes.get(layer_id)
+
+    def put(self, layer_id, generation, index):
+        if self._generation.get(layer_id) == generation: self._indexes[layer_id] = index
+
+    def invalidate(self, layer_id):
+        self._indexes.pop(layer_id, None)
+        self._generation[layer_id] = self._generation.get(layer_id, 0) + 1
+
+    def clear(self):
+        for connections in self._watched.values():
+            for signal, slot in connections:
+                try: signal.disconnect(slot)
+                except (TypeError, RuntimeError): pass
+        self._watched = {}
+        self._indexes = {}
+        self._generation = {}
+
+    def _forget(self, layer_id):
+        self._indexes.pop(layer_id, None)
+        self._generation.pop(layer_id, None)
+        self._watched.pop(layer_id, None)
+
+
+class ExportScope:
+    """What part of each layer an export covers.
+
+    ``geometry`` (extent rectangle as a polygon, or the custom polygon) is in
+    ``crs``, normally the canvas CRS. ``for_layer`` is called on the main
+    thread and returns the LayerScope a worker resolves to feature ids.
+    """
+
+    def __init__(self, kind=SCOPE_FULL, geometry=None, crs=None, index_cache=None):
+        self.kind = kind
+        self.geometry = geometry
+        self.crs = crs
+        self.index_cache = index_cache
+
+    @property
+    def is_full(self):
+        return self.kind == SCOPE_FULL
+
+    def for_layer(self, layer):
+        if self.is_full: return None
+        if self.kind == SCOPE_SELECTED:
+            return LayerScope(fids=layer.selectedFeatureIds())
+
+        geom = QgsGeometry(self.geometry)
+        if self.crs is not None and self.crs != layer.crs():
+            geom.transform(QgsCoordinateTransform(self.crs, layer.crs(), QgsProject.instance()))
+        scope = LayerScope(rect=geom.boundingBox(), geometry=geom if self.kind == SCOPE_POLYGON else None)
+
+        # Providers with their own index (GPKG, PostGIS, indexed SHP) take the rect directly
+        try: indexed = layer.hasSpatialIndex() != QgsFeatureSource.SpatialIndexNotPresent
+        except AttributeError: indexed = True
+        if not indexed and self.index_cache is not None:
+            scope.index_cache = self.index_cache
+            scope.layer_id = layer.id()
+            scope.generation = self.index_cache.watch(layer)
+        return scope
+
+
+class LayerScope:
+    """A scope expressed in one layer's CRS; ``resolve`` turns it into the exported fids."""
+
+    def __init__(self, fids=None, rect=None, geometry=None):
+        self.fids = fids
+        self.rect = rect
+        self.geometry = geometry
+        self.index_cache = None
+        self.layer_id = None
+        self.generation = 0
+
+    def candidates(self, source):
+        """Candidate fids from a (cached) QgsSpatialIndex, or None to let the provider filter the rect."""
+        if self.fids is not None: return self.fids
+        if self.index_cache is None: return None
+        index = self.index_cache.get(self.layer_id)
+        if index is None:
+            index = QgsSpatialIndex(source.getFeatures(QgsFeatureRequest().setNoAttributes()))
+            self.index_cache.put(self.layer_id, self.generation, index)
+        return index.intersects(self.rect)
+
+    def resolve(self, source, fields, filter_expression=None, expression_context=None):
+        """Returns the ids (in provider order) of the features inside the scope.
+
+        The class filter goes to the provider together with the rect; with
+        candidate fids (selection, cached index) it is evaluated here, as a
+        request only holds one filter type. Polygons get an exact prepared
+        intersects test after the bbox pass.
+        """
+        candidates = self.candidates(source)
+        request = QgsFeatureRequest()
+        expression = None
+        if candidates is not None:
+            request.setFilterFids(set(candidates))
+            if filter_expression:
+                expression = QgsExpression(filter_expression)
+                context = QgsExpressionContext(expression_context) if expression_context else QgsExpressionContext()
+                expression.prepare(context)
+        else:
+            request.setFilterRect(self.rect)
+            if filter_expression:
+                request.setFilterExpression(filter_expression)
+                if expression_context: request.setExpressionContext(expression_context)
+
+        engine = None
+        if self.geometry is not None:
+            engine = QgsGeometry.createGeometryEngine(self.geometry.constGet())
+            engine.prepareGeometry()
+        elif expression is None or not expression.needsGeometry():
+            request.setFlags(request.flags() | QgsFeatureRequest.NoGeometry)
+        if expression is None:
+            request.setNoAttributes()
+        elif QgsFeatureRequest.ALL_ATTRIBUTES not in expression.referencedColumns():
+            request.setSubsetOfAttributes(expression.referencedColumns(), fields)
+
+        fids = array('q')
+        for feat in source.getFeatures(request):
+            if expression is not None:
+                context.setFeature(feat)
+                if not expression.evaluate(context): continue
+            if engine is not None:
+                if not feat.hasGeometry() or not engine.intersects(feat.geometry().constGet()): continue
+            fids.append(feat.id())
+        return fids
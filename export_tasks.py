@@ -0,0 +1,832 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : export_tasks
+#  DESCRIPTION : Background (QgsTask) export engines for KMZ, MIF/MID and
+#                GeoPackage/FlatGeobuf
+# ==============================================================================
+
+import math
+import os
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from xml.sax.saxutils import escape
+
+from qgis.PyQt.QtCore import QVariant, pyqtSignal
+from qgis.core import (
+    QgsTask, QgsProject, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsUnitTypes,
+    QgsRenderContext, QgsWkbTypes, QgsVectorLayerFeatureSource, QgsFields, QgsField, QgsFeature,
+    QgsExpressionContext, QgsExpressionContextUtils, QgsFeatureRequest, QgsVectorFileWriter, QgsVectorLayer,
+    QgsTransaction, QgsFeatureSink
+)
+
+from .thematic import ThematicResolver
+from .geometry_batch import GeometryBatch
+from .mif_writer import MifWriter, MifChunk
+from .export_chunks import fid_chunks, run_chunks, PARALLEL_MIN_FEATURES
+from .field_picker import export_field_names
+from .kml_regions import build_tile_pyramid, region_xml, network_link_xml, MIN_LOD_PIXELS
+from .kmz_writer import (
+    KmzStreamWriter, KmlSpool, KmlStyleTable, KmlSchema, style_body, html_table, label_style
+)
+from .site_labels import SiteLabelIndex
+from .export_profile import NULL_PROFILER
+from .export_progress import ExportProgress
+
+# Upper bound of layers serialized at the same time by a multi-layer KMZ export
+MAX_LAYER_WORKERS = 4
+
+# Zoom-dependent simplification: tolerance of a tile = its width / this divisor
+ZOOM_TOLERANCE_DIVISOR = 4096
+# Metres per degree (equator) used to express tolerances in degrees
+METRES_PER_DEGREE = 111320.0
+
+# OGR engine: driver per file extension, features per batch (one GPKG transaction each)
+OGR_DRIVERS = {".gpkg": "GPKG", ".fgb": "FlatGeobuf"}
+OGR_BATCH_FEATURES = 10000
+# Baked thematic columns (rule key, legend label, #rrggbb, alpha 0-255)
+THEME_FIELDS = [
+    ("theme_key", QVariant.String),
+    ("theme_label", QVariant.String),
+    ("theme_color", QVariant.String),
+    ("theme_alpha", QVariant.Int),
+]
+
+# Geometry kind used for shared KML styles
+GEOMETRY_KINDS = {
+    QgsWkbTypes.PointGeometry: "point",
+    QgsWkbTypes.LineGeometry: "line",
+    QgsWkbTypes.PolygonGeometry: "poly",
+}
+
+# STRICT IDENTIFIER DETECTION (Smart Labeling)
+SITE_ID_COLUMNS = ["SiteID", "Site_ID", "SITEID", "SITE_ID", "EnodeB", "eNB", "Site", "SiteName"]
+
+
+def find_label_column(field_names):
+    """Returns the first field matching a known site identifier column, or None."""
+    lookup = {f.lower(): f for f in reversed(field_names)}
+    for p in SITE_ID_COLUMNS:
+        if p.lower() in lookup: return lookup[p.lower()]
+    return None
+
+
+def visible_classes_filter(layer, renderer):
+    """Filter expression keeping only the legend classes checked in the panel.
+
+    Returns None when every class is visible, or when a class cannot be
+    expressed (non-checkable legend, QGIS < 3.26 without legendKeyToExpression);
+    features are then filtered by the thematic resolver as before.
+    """
+    items = [item for item in renderer.legendSymbolItems() if item.isCheckable()]
+    if not items or all(renderer.legendSymbolItemChecked(item.ruleKey()) for item in items): return None
+    clauses = []
+    for item in items:
+        if not renderer.legendSymbolItemChecked(item.ruleKey()): continue
+        try: expression, ok = renderer.legendKeyToExpression(item.ruleKey(), layer)
+        except (AttributeError, TypeError): return None
+        if not ok or not expression: return None
+        clauses.append(f"({expression})")
+    return " OR ".join(clauses) if clauses else "FALSE"
+
+
+# ==============================================================================
+#  BASE TASK
+# ==============================================================================
+class LayerSnapshot:
+    """Everything a worker thread needs to read one layer.
+
+    Taken on the main thread: a QgsVectorLayerFeatureSource, a clone of the
+    renderer, the fields and the transform to EPSG:4326. The live layer is
+    never used from a worker. With ``workers`` > 1 (and a large enough layer)
+    independent replicas are taken as well, one per extra chunk worker.
+
+    Requests are shaped for the provider: only the exported fields plus the
+    ones the renderer (and the site label) need are fetched, and classes
+    unchecked in the legend are dropped by a filter expression. An
+    ExportScope limits the export to the features resolved by
+    ``resolve_scope`` (run on the worker before reading). ``precision``
+    (decimals) and ``simplify`` (tolerance in metres) go to every
+    GeometryBatch made by ``new_batch``.
+    """
+
+    def __init__(self, layer, workers=1, scope=None, precision=None, simplify=0.0):
+        self.layer_name = layer.name()
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.fields = layer.fields()
+        self.field_names = [f.name() for f in self.fields]
+        self.total_feat = layer.featureCount()
+        self.geometry_type = layer.geometryType()
+        self.renderer = layer.renderer().clone()
+        self.context = QgsRenderContext()
+        self.context.setExpressionContext(
+            QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
+        )
+        self.transform = QgsCoordinateTransform(
+            layer.crs(), QgsCoordinateReferenceSystem("EPSG:4326"), QgsProject.instance()
+        )
+        self.shape_requests(layer)
+        self.precision = precision
+        crs = layer.crs()
+        if crs.isGeographic(): self.units_per_metre = 1.0 / METRES_PER_DEGREE
+        else: self.units_per_metre = QgsUnitTypes.fromUnitToUnitFactor(QgsUnitTypes.DistanceMeters, crs.mapUnits())
+        self.simplify = simplify
+        self.scope = scope.for_layer(layer) if scope else None
+        self.scope_fids = None
+        if self.total_feat < PARALLEL_MIN_FEATURES: workers = 1
+        self.replicas = [LayerSnapshot(layer, 1, None, precision, simplify) for _ in range(workers - 1)]
+
+    def shape_requests(self, layer):
+        fields = self.fields
+        chosen = export_field_names(layer)
+        self.export_indexes = [i for i, name in enumerate(self.field_names) if chosen is None or name in chosen]
+        self.export_names = [self.field_names[i] for i in self.export_indexes]
+        self.export_fields = QgsFields()
+        for i in self.export_indexes: self.export_fields.append(fields.at(i))
+        self.all_exported = len(self.export_indexes) == len(self.field_names)
+
+        needed = set(self.export_indexes)
+        for name in self.renderer.usedAttributes(self.context): needed.add(fields.lookupField(name))
+        label_col = find_label_column(self.field_names)
+        if label_col: needed.add(fields.lookupField(label_col))
+        needed.discard(-1)
+        self.fetch_indexes = None if len(needed) == len(self.field_names) else sorted(needed)
+        self.filter_expression = visible_classes_filter(layer, layer.renderer())
+
+    def resolve_scope(self):
+        """Resolves the scope to feature ids (spatial index / rect / selection); no-op for full exports."""
+        if self.scope is None or self.scope_fids is not None: return
+        self.scope_fids = self.scope.resolve(
+            self.source, self.fields, self.filter_expression, self.context.expressionContext()
+        )
+        self.total_feat = len(self.scope_fids)
+
+    def request(self, fids=None):
+        """Feature request with the attribute subset; the class filter applies unless ``fids`` is given.
+
+        Fid chunks and tiles come from an already filtered id pass, and a
+        request only holds one filter type. A resolved scope is used as the
+        fid set (already class-filtered).
+        """
+        request = QgsFeatureRequest()
+        if fids is None: fids = self.scope_fids
+        if fids is not None:
+            request.setFilterFids(set(fids))
+        elif self.filter_expression:
+            request.setFilterExpression(self.filter_expression)
+            request.setExpressionContext(self.context.expressionContext())
+        if self.fetch_indexes is not None: request.setSubsetOfAttributes(self.fetch_indexes)
+        return request
+
+    def new_batch(self, simplify=None):
+        """GeometryBatch with the export precision; ``simplify`` (metres) overrides the default tolerance."""
+        metres = self.simplify if simplify is None else simplify
+        return GeometryBatch(self.transform, precision=self.precision, tolerance=metres * self.units_per_metre)
+
+    def export_values(self, feat):
+        """Attribute values of the exported fields, in export order."""
+        attrs = feat.attributes()
+        if self.all_exported: return attrs
+        return [attrs[i] for i in self.export_indexes]
+
+    @contextmanager
+    def rendering(self):
+        """Runs a render session on the cloned renderer, yielding its ThematicResolver."""
+        self.renderer.startRender(self.context, self.fields)
+        try:
+            yield ThematicResolver(self.renderer, self.context, self.fields)
+        finally:
+            self.renderer.stopRender(self.context)
+
+    @contextmanager
+    def rendering_workers(self):
+        """Render sessions for the snapshot and its replicas: yields [(snapshot, resolver), ...]."""
+        snaps = [self] + (self.replicas if self.total_feat >= PARALLEL_MIN_FEATURES else [])
+        with ExitStack() as stack:
+            yield [(snap, stack.enter_context(snap.rendering())) for snap in snaps]
+
+
+class ThematicExportTask(QgsTask):
+    """Base class for exports that run on a QgsTaskManager worker thread.
+
+    ``layers`` (one layer or a list) is snapshotted into LayerSnapshot objects
+    in the constructor, on the main thread. ``workers`` threads are shared
+    between the layers that are serialized at the same time. An
+    ExportProfiler (``profiler``) times the phases of the export and reports
+    them when it ends; by default instrumentation is off. Progress goes
+    through a throttled ExportProgress, which also emits ``status`` (done /
+    total, features/s, ETA) and holds the cancel flag tested by the loops.
+    """
+
+    status = pyqtSignal(str)
+
+    def __init__(self, description, layers, path, workers=1, scope=None, precision=None, simplify=0.0, profiler=None):
+        super().__init__(description, QgsTask.CanCancel)
+        self.path = path
+        self.profiler = profiler or NULL_PROFILER
+        self.progress = ExportProgress(self, status=self.status.emit)
+        if not isinstance(layers, (list, tuple)): layers = [layers]
+        per_layer = max(1, workers // min(len(layers), MAX_LAYER_WORKERS))
+        self.layers = [LayerSnapshot(layer, per_layer, scope, precision, simplify) for layer in layers]
+        self.total_feat = sum(snap.total_feat for snap in self.layers)
+        self.jobs = []
+        self.exception = None
+
+    def run(self):
+        self.progress.start()
+        self.profiler.start()
+        try:
+            self.export()
+            return not self.isCanceled()
+        except Exception as e:
+            self.exception = e
+            return False
+        finally:
+            self.profiler.stop()
+            try: self.profiler.report(self.description(), self.output_paths())
+            except: pass
+
+    def output_paths(self):
+        return [self.path]
+
+    def cancel(self):
+        self.progress.canceled = True
+        super().cancel()
+
+    def report_progress(self, i, base=0.0, span=100.0):
+        if self.total_feat > 0 and self.progress.due():
+            with self.profiler.phase("progress"): self.progress.report(base + i * span / self.total_feat, self.total_feat)
+
+    def export(self):
+        raise NotImplementedError
+
+
+# ==============================================================================
+#  MAPINFO MIF/MID ENGINE
+# ==============================================================================
+class MifExportTask(ThematicExportTask):
+    """Writes a MIF/MID pair with hardcoded thematic colors."""
+
+    def __init__(self, layer, mif_path, mid_path, workers=1, scope=None, precision=None, simplify=0.0, profiler=None):
+        super().__init__(f"Exporting MIF: {layer.name()}", layer, mif_path, workers, scope, precision, simplify, profiler)
+        self.mid_path = mid_path
+
+    def output_paths(self):
+        return [self.path, self.mid_path]
+
+    def export(self):
+        snap = self.layers[0]
+        snap.resolve_scope()
+        self.total_feat = snap.total_feat
+        columns = None if snap.all_exported else snap.export_indexes
+        with snap.rendering_workers() as workers, MifWriter(self.path, self.mid_path, snap.export_fields, columns) as mif:
+            if len(workers) > 1:
+                self.export_chunked(mif, workers)
+                return
+            prof = self.profiler
+            resolve = prof.timed("symbol", workers[0][1].resolve)
+            batch = snap.new_batch()
+            for i, feat in enumerate(prof.features(snap.source.getFeatures(snap.request()))):
+                if self.progress.canceled: break
+                self.report_progress(i)
+                if self.queue_feature(batch, feat, resolve): self.write_batch(mif, batch)
+            self.write_batch(mif, batch)
+
+    def export_chunked(self, mif, workers):
+        # Chunks are serialized in parallel and appended in fid order
+        done = 0
+        snap = self.layers[0]
+        for fids, chunk in run_chunks(workers, self.serialize_chunk, fid_chunks(snap.source, snap.request())):
+            try:
+                if not self.progress.canceled:
+                    with self.profiler.phase("merge"): mif.append(chunk)
+            finally:
+                chunk.close()
+            done += len(fids)
+            self.report_progress(done)
+
+    def serialize_chunk(self, snap, thematic, fids):
+        chunk = MifChunk(None if snap.all_exported else snap.export_indexes)
+        prof = self.profiler
+        resolve = prof.timed("symbol", thematic.resolve)
+        batch = snap.new_batch()
+        for feat in prof.features(snap.source.getFeatures(snap.request(fids))):
+            if self.progress.canceled: break
+            if self.queue_feature(batch, feat, resolve): self.write_batch(chunk, batch)
+        self.write_batch(chunk, batch)
+        return chunk
+
+    def queue_feature(self, batch, feat, resolve):
+        """Queues a feature (rows without geometry keep their MID line); returns True when the batch is full."""
+        geom = feat.geometry() if feat.hasGeometry() else None
+        thematic_class = resolve(feat) if geom else None
+        with self.profiler.phase("geometry"): return batch.add(feat, geom, thematic_class)
+
+    def write_batch(self, mif, batch):
+        """Transforms a batch in one call, then writes its MID rows and MIF objects in order."""
+        prof = self.profiler
+        with prof.phase("transform"): batch.transform_all()
+        prof.count("vertices", len(batch.xs))
+        with prof.phase("format"): mif.write_batch(batch)
+        batch.clear()
+
+
+# ==============================================================================
+#  GOOGLE EARTH KMZ ENGINE
+# ==============================================================================
+class KmzExportTask(ThematicExportTask):
+    """Streams a thematic KML document (plus optional legend PNG) into a KMZ.
+
+    Every layer is serialized by its own KmzLayerJob; with several layers the
+    jobs run on a thread pool, each spooling to a temp file, and are merged
+    in layer order into one <Folder> per layer.
+
+    With ``tile_size`` > 0 the output is regionated: doc.kml only links to a
+    pyramid of tiles/<n>.kml files (NetworkLink + Region/Lod), each holding at
+    most ``tile_size`` features, so Google Earth loads only what is in view.
+    """
+
+    def __init__(self, layers, path, legend_png=None, attribute_mode="table", tile_size=0, workers=1, scope=None,
+                 label_spacing=0, precision=None, simplify=0.0, simplify_by_zoom=False, profiler=None):
+        if not isinstance(layers, (list, tuple)): layers = [layers]
+        title = layers[0].name() if len(layers) == 1 else f"{len(layers)} layers"
+        super().__init__(f"Exporting KMZ: {title}", layers, path, workers, scope, precision, simplify, profiler)
+        self.simplify_by_zoom = simplify_by_zoom # Regionated: coarser tolerance for larger tiles
+        self.legend_png = legend_png
+        self.attribute_mode = attribute_mode # "table" (inline HTML) or "schema" (ExtendedData)
+        self.tile_size = tile_size
+        self.label_spacing = label_spacing # Metres between site labels (declutter)
+
+    def export(self):
+        multi = len(self.layers) > 1
+        self.jobs = jobs = [KmzLayerJob(self, snap, n, multi) for n, snap in enumerate(self.layers)]
+        try:
+            if not multi and self.tile_size <= 0:
+                # Single layer: stream placemarks straight into doc.kml (no spool)
+                with KmzStreamWriter(self.path, profiler=self.profiler) as kmz:
+                    if self.legend_png: kmz.add_resource("legend.png", self.legend_png)
+                    kmz.begin()
+                    jobs[0].run(kmz)
+                    kmz.end(with_legend=bool(self.legend_png))
+                return
+            if not multi:
+                jobs[0].run()
+            else:
+                with ThreadPoolExecutor(max_workers=min(len(jobs), MAX_LAYER_WORKERS)) as pool:
+                    futures = [pool.submit(job.run) for job in jobs]
+                    try:
+                        for future in futures: future.result()
+                    except Exception:
+                        self.cancel() # Stop the other layers, the export is lost anyway
+                        raise
+            if self.progress.canceled: return
+
+            with KmzStreamWriter(self.path, profiler=self.profiler) as kmz:
+                if self.tile_size > 0: self.merge_regionated(kmz, jobs)
+                else: self.merge_flat(kmz, jobs)
+        finally:
+            for job in jobs: job.close()
+
+    def update_progress(self):
+        if not self.progress.due(): return
+        # Totals shrink once scopes are resolved, so they are summed on the fly
+        total = sum(job.snap.total_feat for job in self.jobs)
+        if total > 0:
+            with self.profiler.phase("progress"):
+                self.progress.report(100.0 * sum(job.progress * job.snap.total_feat for job in self.jobs) / total, total)
+
+    def merge_flat(self, kmz, jobs):
+        if self.legend_png: kmz.add_resource("legend.png", self.legend_png)
+        kmz.begin()
+        # Shared styles/schemas must live at Document level, ahead of the folders
+        for job in jobs: job.write_document_header(kmz, with_labels=False)
+        if any(job.label_col for job in jobs): kmz.write(label_style())
+        for job in jobs:
+            if job.folder: kmz.write(f'<Folder><name>{escape(job.snap.layer_name)}</name>\n')
+            kmz.copy(job.spool)
+            if job.folder: kmz.write('</Folder>\n')
+        # Close KML (+ legend overlay) inside the archive
+        kmz.end(with_legend=bool(self.legend_png))
+
+    def merge_regionated(self, kmz, jobs):
+        # Root document: legend overlay + one link per layer to its root tile (no Lod threshold)
+        # Site labels stay in doc.kml (one folder per layer), outside the tiles
+        kmz.begin()
+        if any(job.labels_section for job in jobs): kmz.write(label_style())
+        for job in jobs:
+            if not job.tiles: continue
+            root = job.tiles[0]
+            if job.folder: kmz.write(f'<Folder><name>{escape(job.snap.layer_name)}</name>')
+            kmz.write(network_link_xml(root, f"{job.tile_dir}{root.href}", min_lod=0))
+            if job.labels_section: kmz.copy(job.spool, *job.labels_section)
+            if job.folder: kmz.write('</Folder>\n')
+        kmz.end(with_legend=bool(self.legend_png))
+        if self.legend_png: kmz.add_resource("legend.png", self.legend_png)
+
+        for job in jobs:
+            for arcname, start, end in job.entries:
+                kmz.begin(arcname)
+                kmz.copy(job.spool, start, end)
+                kmz.end()
+
+
+class KmzLayerJob:
+    """Serializes one layer of a KMZ export into a KmlSpool.
+
+    A job owns its LayerSnapshot and render session, so jobs for different
+    layers can run on worker threads at the same time. Style and schema ids
+    get a per-layer prefix when several layers share the document. A snapshot
+    with replicas is serialized in fid chunks (flat) or tiles (regionated) on
+    a thread pool, merged back in order.
+    """
+
+    def __init__(self, task, snap, index, multi):
+        self.task = task
+        self.prof = task.profiler
+        self.snap = snap
+        self.folder = multi
+        self.prefix = f"l{index}_" if multi else ""
+        self.tile_dir = f"tiles/{index}/" if multi else "tiles/"
+        self.label_col = find_label_column(snap.field_names)
+        self.spool = None
+        self.tiles = []
+        self.entries = [] # (arcname, start, end) sections of the spool, regionated mode
+        self.progress = 0.0
+        self.site_index = SiteLabelIndex() if self.label_col else None
+        self.labels_section = None # (start, end) of the labels folder in the spool, regionated mode
+
+    def run(self, out=None):
+        """Serializes the layer into ``out`` (a KMZ entry) or, by default, into a new spool."""
+        snap = self.snap
+        snap.resolve_scope()
+        with snap.rendering_workers() as workers:
+            self.workers = workers
+            self.thematic = thematic = workers[0][1]
+            self.schema = KmlSchema(snap.export_names, f"{self.prefix}attrs") if self.task.attribute_mode == "schema" else None
+            self.balloon = self.schema.balloon() if self.schema else ""
+            self.styles = KmlStyleTable.from_classes(
+                thematic.classes.values(), GEOMETRY_KINDS.get(snap.geometry_type, "line"), self.balloon, self.prefix
+            )
+            direct = out is not None
+            if not direct: self.spool = out = KmlSpool()
+            if self.task.tile_size > 0:
+                self.write_regionated(out)
+                if self.site_index and not self.is_canceled():
+                    start = out.tell()
+                    self.write_labels(out)
+                    self.labels_section = (start, out.tell())
+            else:
+                if direct: self.write_document_header(out)
+                self.write_flat(out)
+                if self.site_index and not self.is_canceled(): self.write_labels(out)
+            out.flush()
+
+    def write_labels(self, out):
+        """One decluttered label per site, in its own folder."""
+        if len(self.site_index): self.site_index.write_folder(out, self.task.label_spacing)
+
+    def close(self):
+        if self.spool: self.spool.close()
+
+    def is_canceled(self):
+        return self.task.progress.canceled
+
+    def report_progress(self, i, base=0.0, span=100.0):
+        total = self.snap.total_feat
+        if total > 0:
+            self.progress = min(1.0, (base + i * span / total) / 100.0)
+            self.task.update_progress()
+
+    def write_document_header(self, out, with_labels=None):
+        if self.schema: out.write(self.schema.header())
+        if with_labels is None: with_labels = bool(self.label_col)
+        self.styles.write(out, with_labels=with_labels)
+
+    def write_flat(self, out):
+        if len(self.workers) > 1:
+            # Fid chunks serialized in parallel, concatenated in order
+            done = 0
+            for fids, spool in run_chunks(self.workers, self.serialize_chunk, fid_chunks(self.snap.source, self.snap.request())):
+                try:
+                    if not self.is_canceled():
+                        with self.prof.phase("merge"): out.copy(spool)
+                finally:
+                    spool.close()
+                done += len(fids)
+                self.report_progress(done)
+            return
+        resolve = self.prof.timed("symbol", self.thematic.resolve)
+        batch = self.snap.new_batch()
+        for i, feat in enumerate(self.prof.features(self.snap.source.getFeatures(self.snap.request()))):
+            if self.is_canceled(): break
+            self.report_progress(i)
+            if self.queue_placemark(batch, feat, resolve): self.write_batch(out, batch)
+        self.write_batch(out, batch)
+
+    def serialize_chunk(self, snap, thematic, fids):
+        spool = KmlSpool()
+        resolve = self.prof.timed("symbol", thematic.resolve)
+        batch = snap.new_batch()
+        for feat in self.prof.features(snap.source.getFeatures(snap.request(fids))):
+            if self.is_canceled(): break
+            if self.queue_placemark(batch, feat, resolve): self.write_batch(spool, batch)
+        self.write_batch(spool, batch)
+        return spool
+
+    def write_regionated(self, out):
+        snap = self.snap
+        # Pass 1: one EPSG:4326 anchor per feature (geometry only, no attributes)
+        fids, xs, ys = array('q'), array('d'), array('d')
+        request = snap.request().setNoAttributes()
+        for i, feat in enumerate(self.prof.features(snap.source.getFeatures(request), counter="anchors")):
+            if self.is_canceled(): return
+            self.report_progress(i, 0.0, 20.0)
+            if not feat.hasGeometry(): continue
+            center = feat.geometry().boundingBox().center()
+            fids.append(feat.id()); xs.append(center.x()); ys.append(center.y())
+
+        # Anchors go through the same bulk transform as the placemarks
+        anchors = GeometryBatch(snap.transform)
+        anchors.xs, anchors.ys = xs, ys
+        with self.prof.phase("transform"): anchors.transform_all()
+        self.tiles = build_tile_pyramid(fids, anchors.xs, anchors.ys, self.task.tile_size)
+        del xs, ys, anchors
+
+        # Pass 2: serialize each tile from its own fid set (tiles in parallel with replicas)
+        done = 0
+        if len(self.workers) > 1:
+            for tile, spool in run_chunks(self.workers, self.serialize_tile, self.tiles):
+                try:
+                    if self.is_canceled(): return
+                    start = out.tell()
+                    with self.prof.phase("merge"): out.copy(spool)
+                    self.entries.append((f"{self.tile_dir}{tile.href}", start, out.tell()))
+                finally:
+                    spool.close()
+                done += len(tile.fids)
+                self.report_progress(done, 20.0, 80.0)
+            return
+        for tile in self.tiles:
+            if self.is_canceled(): return
+            start = out.tell()
+            self.write_tile(out, snap, self.thematic, tile)
+            self.entries.append((f"{self.tile_dir}{tile.href}", start, out.tell()))
+            done += len(tile.fids)
+            self.report_progress(done, 20.0, 80.0)
+
+    def serialize_tile(self, snap, thematic, tile):
+        spool = KmlSpool()
+        self.write_tile(spool, snap, thematic, tile)
+        return spool
+
+    def tile_tolerance(self, tile):
+        """Simplify tolerance (metres) of a tile: the export tolerance, or more for large tiles with zoom mode."""
+        if not self.task.simplify_by_zoom: return None
+        w, s, e, n = tile.bbox
+        width = (e - w) * METRES_PER_DEGREE * math.cos(math.radians((s + n) / 2.0))
+        return max(self.snap.simplify, width / ZOOM_TOLERANCE_DIVISOR)
+
+    def write_tile(self, out, snap, thematic, tile):
+        out.write(region_xml(tile.bbox, 0 if tile.depth == 0 else MIN_LOD_PIXELS))
+        self.write_document_header(out, with_labels=False)
+        if len(tile.fids):
+            resolve = self.prof.timed("symbol", thematic.resolve)
+            batch = snap.new_batch(self.tile_tolerance(tile))
+            for feat in self.prof.features(snap.source.getFeatures(snap.request(tile.fids))):
+                if self.is_canceled(): break
+                if self.queue_placemark(batch, feat, resolve): self.write_batch(out, batch)
+            self.write_batch(out, batch)
+        for child in tile.children:
+            out.write(network_link_xml(child, child.href))
+
+    def style_ref(self, thematic_class, kind):
+        style_id = self.styles.style_id(thematic_class.kml_color, kind)
+        if style_id: return f'<styleUrl>#{style_id}</styleUrl>'
+        return f'<Style>{style_body(kind, thematic_class.color, self.balloon)}</Style>'
+
+    def queue_placemark(self, batch, feat, resolve):
+        """Queues a feature with its thematic class; returns True when the batch is full."""
+        if not feat.hasGeometry(): return False
+        thematic_class = resolve(feat)
+        if not thematic_class: return False
+        geom = feat.geometry()
+        kind = QgsWkbTypes.geometryType(geom.wkbType())
+        # Points are placed on their centroid, sector polygons need it for the site label
+        anchor = kind == QgsWkbTypes.PointGeometry or (kind == QgsWkbTypes.PolygonGeometry and bool(self.label_col))
+        with self.prof.phase("geometry"): return batch.add(feat, geom, thematic_class, anchor)
+
+    def write_batch(self, out, batch):
+        prof = self.prof
+        with prof.phase("transform"): batch.transform_all()
+        prof.count("vertices", len(batch.xs))
+        with prof.phase("format"):
+            for rec in batch.records:
+                if rec.parts is not None: self.write_placemark(out, rec, batch.xs, batch.ys)
+        batch.clear()
+
+    def write_placemark(self, out, rec, xs, ys):
+        try:
+            feat = rec.feature
+            thematic_class = rec.payload
+
+            def coords(start, end):
+                return " ".join([f"{x},{y},0" for x, y in zip(xs[start:end], ys[start:end])])
+
+            # Popup: shared Schema/BalloonStyle or legacy description table
+            schema = self.schema
+            values = self.snap.export_values(feat)
+            popup = schema.extended_data(values) if schema else html_table(self.snap.export_names, values)
+
+            # Point Processing (Clean: No Name Label)
+            if rec.geom_type == QgsWkbTypes.PointGeometry:
+                a = rec.anchor
+                out.write(f'<Placemark><name></name>{popup}') # Force Empty Name
+                out.write(self.style_ref(thematic_class, "point"))
+                out.write(f'<Point><coordinates>{xs[a]},{ys[a]},0</coordinates></Point></Placemark>\n')
+
+            # Polygon Processing (Clean Grid: No Name Label)
+            elif rec.geom_type == QgsWkbTypes.PolygonGeometry:
+                out.write(f'<Placemark><name></name>{popup}')
+                out.write(self.style_ref(thematic_class, "poly"))
+
+                out.write('<MultiGeometry>')
+                for poly in rec.parts:
+                    out.write(f'<Polygon><outerBoundaryIs><LinearRing><coordinates>{coords(*poly[0])}</coordinates></LinearRing></outerBoundaryIs>')
+                    for ring in poly[1:]:
+                        out.write(f'<innerBoundaryIs><LinearRing><coordinates>{coords(*ring)}</coordinates></LinearRing></innerBoundaryIs>')
+                    out.write('</Polygon>')
+                out.write('</MultiGeometry></Placemark>\n')
+
+                # --- Smart Labeling: sector anchors are grouped per site, labels written at the end ---
+                if self.site_index is not None and rec.anchor >= 0:
+                    site_id = feat[self.label_col]
+                    if site_id is not None and site_id != "":
+                        a = rec.anchor
+                        self.site_index.add(str(site_id), xs[a], ys[a])
+
+            # Line Processing (Clean: No Name Label)
+            elif rec.geom_type == QgsWkbTypes.LineGeometry:
+                out.write(f'<Placemark><name></name>{popup}')
+                out.write(self.style_ref(thematic_class, "line"))
+
+                out.write('<MultiGeometry>')
+                for part in rec.parts:
+                    out.write(f'<LineString><coordinates>{coords(*part[0])}</coordinates></LineString>')
+                out.write('</MultiGeometry></Placemark>\n')
+
+        except: pass
+
+
+# ==============================================================================
+#  GEOPACKAGE / FLATGEOBUF ENGINE
+# ==============================================================================
+class OgrExportTask(ThematicExportTask):
+    """Writes the layer through OGR (GeoPackage or FlatGeobuf, from the extension) with baked style columns.
+
+    Geometries keep the layer CRS and are written untouched; the exported
+    fields are followed by the THEME_FIELDS columns of each feature's resolved
+    class. Features the renderer does not draw are skipped. QgsVectorFileWriter
+    creates the file; GeoPackage rows are then inserted by a GpkgBatchWriter,
+    one explicit transaction per OGR_BATCH_FEATURES batch, while FlatGeobuf
+    (a write-once format without transactions) is streamed through the file
+    writer. With ``spatial_index`` off the file is written without an R-tree /
+    packed index. Large layers are resolved in parallel fid chunks and
+    written in order by the task thread, the only one touching the writer.
+    """
+
+    def __init__(self, layer, path, workers=1, scope=None, spatial_index=True, profiler=None):
+        super().__init__(f"Exporting {os.path.basename(path)}: {layer.name()}", layer, path, workers, scope, profiler=profiler)
+        self.driver = OGR_DRIVERS.get(os.path.splitext(path)[1].lower(), "GPKG")
+        self.layer_name = os.path.splitext(os.path.basename(path))[0]
+        self.attr_pad = [] # Leading NULL attributes of the target table (GPKG fid column)
+        self.spatial_index = spatial_index
+        self.wkb_type = layer.wkbType()
+        self.crs = layer.crs()
+        self.transform_context = QgsProject.instance().transformContext()
+
+    def output_fields(self, snap):
+        """Exported fields plus the theme columns (renamed on a clash with a layer field)."""
+        fields = QgsFields(snap.export_fields)
+        taken = {name.lower() for name in snap.export_names}
+        for name, kind in THEME_FIELDS:
+            unique, n = name, 1
+            while unique.lower() in taken:
+                unique, n = f"{name}_{n}", n + 1
+            taken.add(unique.lower())
+            fields.append(QgsField(unique, kind))
+        return fields
+
+    def create_writer(self, fields):
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = self.driver
+        options.fileEncoding = "UTF-8"
+        options.layerName = self.layer_name
+        options.layerOptions = [f"SPATIAL_INDEX={'YES' if self.spatial_index else 'NO'}"]
+        writer = QgsVectorFileWriter.create(self.path, fields, self.wkb_type, self.crs, self.transform_context, options)
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            message = writer.errorMessage()
+            del writer
+            raise RuntimeError(message)
+        return writer
+
+    def open_writer(self, fields):
+        """Creates the file; GeoPackage tables are then filled through a GpkgBatchWriter."""
+        writer = self.create_writer(fields)
+        if self.driver != "GPKG": return writer
+        del writer # Closes the file: the empty table and its spatial index now exist
+        writer = GpkgBatchWriter(self.path, self.layer_name)
+        self.fields, self.attr_pad = writer.fields, writer.pad
+        return writer
+
+    def export(self):
+        snap = self.layers[0]
+        snap.resolve_scope()
+        self.total_feat = snap.total_feat
+        self.fields = self.output_fields(snap)
+        writer = self.open_writer(self.fields)
+        try:
+            with snap.rendering_workers() as workers:
+                if len(workers) > 1:
+                    done = 0
+                    for fids, batch in run_chunks(workers, self.serialize_chunk, fid_chunks(snap.source, snap.request())):
+                        if not self.progress.canceled: self.write_features(writer, batch)
+                        done += len(fids)
+                        self.report_progress(done)
+                    return
+                prof = self.profiler
+                resolve = prof.timed("symbol", workers[0][1].resolve)
+                batch = []
+                for i, feat in enumerate(prof.features(snap.source.getFeatures(snap.request()))):
+                    if self.progress.canceled: break
+                    self.report_progress(i)
+                    out = self.styled_feature(snap, feat, resolve)
+                    if out is None: continue
+                    batch.append(out)
+                    if len(batch) >= OGR_BATCH_FEATURES:
+                        self.write_features(writer, batch)
+                        batch = []
+                self.write_features(writer, batch)
+        finally:
+            del writer # Closes the file (GPKG batches are already committed)
+
+    def serialize_chunk(self, snap, thematic, fids):
+        prof = self.profiler
+        resolve = prof.timed("symbol", thematic.resolve)
+        batch = []
+        for feat in prof.features(snap.source.getFeatures(snap.request(fids))):
+            if self.progress.canceled: break
+            out = self.styled_feature(snap, feat, resolve)
+            if out is not None: batch.append(out)
+        return batch
+
+    def styled_feature(self, snap, feat, resolve):
+        """Output feature with the theme columns, or None when the renderer does not draw it."""
+        thematic_class = resolve(feat)
+        if not thematic_class: return None
+        with self.profiler.phase("format"):
+            color = thematic_class.color
+            out = QgsFeature(self.fields)
+            if feat.hasGeometry(): out.setGeometry(feat.geometry())
+            out.setAttributes(
+                self.attr_pad + list(snap.export_values(feat)) + [thematic_class.key, thematic_class.label, color.name(), color.alpha()]
+            )
+            return out
+
+    def write_features(self, writer, batch):
+        if not batch: return
+        with self.profiler.phase("write"):
+            if not writer.addFeatures(batch): raise RuntimeError(writer.errorMessage())
+
+
+class GpkgBatchWriter:
+    """Appends features to an existing GeoPackage table, one explicit transaction per batch.
+
+    The table is opened through the OGR provider and every ``addFeatures``
+    call runs between a BEGIN and a COMMIT on its datasource, instead of the
+    row-by-row inserts of QgsVectorFileWriter. The provider lists the fid
+    column first: ``pad`` is the NULL prefix that lets OGR number the rows.
+    """
+
+    def __init__(self, path, layer_name):
+        self.layer = QgsVectorLayer(f"{path}|layername={layer_name}", layer_name, "ogr")
+        if not self.layer.isValid(): raise RuntimeError(f"Cannot open {path}")
+        self.provider = self.layer.dataProvider()
+        self.fields = self.provider.fields()
+        self.pad = [None] * len(self.provider.pkAttributeIndexes())
+        self.transaction = QgsTransaction.create({self.layer})
+        if self.transaction is None: raise RuntimeError(f"Transactions are not supported by {path}")
+        self.error = ""
+
+    def addFeatures(self, batch):
+        ok, self.error = self.transaction.begin()
+        if not ok: return False
+        if self.provider.addFeatures(batch, QgsFeatureSink.FastInsert)[0]:
+            ok, self.error = self.transaction.commit()
+            return ok
+        self.error = "; ".join(self.provider.errors()) or f"Cannot write to {self.layer.source()}"
+        self.transaction.rollback()
+        return False
+
+    def errorMessage(self):
+        return self.error
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : feature_counts
+#  DESCRIPTION : Cached per-class feature counts filled by background counters
+# ==============================================================================
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.core import (
+    QgsApplication, QgsVectorLayerFeatureCounter,
+    QgsExpressionContext, QgsExpressionContextUtils
+)
+
+
+class FeatureCountCache(QObject):
+    """Per-layer cache of feature counts keyed by layer id and legend rule key.
+
+    Counts come from a QgsVectorLayerFeatureCounter running on the task manager,
+    so reading them never blocks the GUI. Entries are dropped when the layer's
+    data, renderer or subset string changes; the next read starts a new count.
+    Style-only changes (symbol colors, legend check states) keep the counts.
+    ``countsChanged`` is emitted with the layer id when counts arrive or expire.
+    """
+
+    countsChanged = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._counts = {}   # layer id -> {rule key: count}
+        self._pending = {}  # layer id -> running counter task
+        self._watched = {}  # layer id -> [(signal, slot), ...]
+
+    def counts(self, layer):
+        """Returns {rule key: count} for the layer, or None while it is being counted."""
+        layer_id = layer.id()
+        cached = self._counts.get(layer_id)
+        if cached is not None: return cached
+        if layer_id not in self._pending: self._start_count(layer)
+        return None
+
+    def invalidate(self, layer_id):
+        self._counts.pop(layer_id, None)
+        counter = self._pending.pop(layer_id, None)
+        if counter is not None:
+            try: counter.cancel()
+            except RuntimeError: pass
+        self.countsChanged.emit(layer_id)
+
+    def clear(self):
+        for layer_id in list(self._pending): self.invalidate(layer_id)
+        for connections in self._watched.values():
+            for signal, slot in connections:
+                try: signal.disconnect(slot)
+                except (TypeError, RuntimeError): pass
+        self._watched = {}
+        self._counts = {}
+
+    # --- Internals ---
+    def _watch(self, layer):
+        layer_id = layer.id()
+        if layer_id in self._watched: return
+        expire = lambda *args: self.invalidate(layer_id)
+        forget = lambda *args: self._forget(layer_id)
+        connections = [
+            (layer.dataChanged, expire),
+            (layer.rendererChanged, expire),
+            (layer.subsetStringChanged, expire),
+            (layer.willBeDeleted, forget),
+        ]
+        for signal, slot in connections: signal.connect(slot)
+        self._watched[layer_id] = connections
+
+    def _forget(self, layer_id):
+        self._counts.pop(layer_id, None)
+        self._pending.pop(layer_id, None)
+        self._watched.pop(layer_id, None)
+
+    def _start_count(self, layer):
+        self._watch(layer)
+        context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
+        counter = QgsVectorLayerFeatureCounter(layer, context)
+        layer_id = layer.id()
+        self._pending[layer_id] = counter
+        counter.symbolsCounted.connect(lambda: self._on_counted(layer_id, counter))
+        counter.taskTerminated.connect(lambda: self._on_terminated(layer_id, counter))
+        QgsApplication.taskManager().addTask(counter)
+
+    def _on_counted(self, layer_id, counter):
+        if self._pending.get(layer_id) is not counter: return # Stale (invalidated meanwhile)
+        del self._pending[layer_id]
+        self._counts[layer_id] = dict(counter.symbolFeatureCountMap())
+        self.countsChanged.emit(layer_id)
+
+    def _on_terminated(self, layer_id, counter):
+        if self._pending.get(layer_id) is counter: del self._pending[layer_id]
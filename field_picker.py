@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : field_picker
+#  DESCRIPTION : Per-layer choice of the attributes written by the exporters
+# ==============================================================================
+
+from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtWidgets import (
+    QDialog, QVBoxLayout, QHBoxLayout, QLabel, QListWidget, QListWidgetItem,
+    QPushButton, QDialogButtonBox
+)
+
+# Layer custom property (saved with the project) holding the chosen field names
+EXPORT_FIELDS_PROPERTY = "embed_legend/export_fields"
+
+
+def export_field_names(layer):
+    """Field names chosen for popups / MID columns, or None when every field is exported."""
+    value = layer.customProperty(EXPORT_FIELDS_PROPERTY, None)
+    if value is None or value == "": return None
+    if isinstance(value, str): value = [value]
+    names = set(value)
+    # Ignore a stale choice that no longer matches any field of the layer
+    return names if names & set(layer.fields().names()) else None
+
+
+def set_export_field_names(layer, names):
+    if names is None: layer.removeCustomProperty(EXPORT_FIELDS_PROPERTY)
+    else: layer.setCustomProperty(EXPORT_FIELDS_PROPERTY, list(names))
+
+
+class ExportFieldsDialog(QDialog):
+    """Checkable list of the layer fields; at least one field must stay checked."""
+
+    def __init__(self, layer, title, hint, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(title)
+        chosen = export_field_names(layer)
+
+        layout = QVBoxLayout(self)
+        info = QLabel(hint)
+        info.setWordWrap(True)
+        layout.addWidget(info)
+
+        self.list_widget = QListWidget()
+        for name in layer.fields().names():
+            item = QListWidgetItem(name)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if chosen is None or name in chosen else Qt.Unchecked)
+            self.list_widget.addItem(item)
+        layout.addWidget(self.list_widget)
+
+        row = QHBoxLayout()
+        btn_all = QPushButton("All")
+        btn_all.clicked.connect(lambda: self.set_all(Qt.Checked))
+        btn_none = QPushButton("None")
+        btn_none.clicked.connect(lambda: self.set_all(Qt.Unchecked))
+        row.addWidget(btn_all)
+        row.addWidget(btn_none)
+        row.addStretch()
+        layout.addLayout(row)
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+        layout.addWidget(self.buttons)
+        self.list_widget.itemChanged.connect(self.update_ok)
+
+    def set_all(self, state):
+        for i in range(self.list_widget.count()): self.list_widget.item(i).setCheckState(state)
+
+    def update_ok(self, *args):
+        self.buttons.button(QDialogButtonBox.Ok).setEnabled(bool(self.checked_names()))
+
+    def checked_names(self):
+        items = (self.list_widget.item(i) for i in range(self.list_widget.count()))
+        return [item.text() for item in items if item.checkState() == Qt.Checked]
+
+    def selected_fields(self):
+        """Chosen names, or None when every field is checked."""
+        names = self.checked_names()
+        return None if len(names) == self.list_widget.count() else names
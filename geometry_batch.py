@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : geometry_batch
+#  DESCRIPTION : Batched (bulk) coordinate transformation for the export engines
+# ==============================================================================
+
+import struct
+import sys
+from array import array
+
+from qgis.core import QgsGeometry, QgsLineString, QgsPointXY, QgsWkbTypes
+
+# Features gathered before one bulk transform call
+DEFAULT_BATCH_SIZE = 1024
+
+_NATIVE = '<' if sys.byteorder == 'little' else '>'
+
+
+def _read_coords(buf, offset, count, dims, endian, xs, ys):
+    """Appends ``count`` WKB vertices to xs/ys (Z/M dropped); returns the new offset."""
+    size = count * dims * 8
+    block = array('d')
+    block.frombytes(buf[offset:offset + size])
+    if endian != _NATIVE: block.byteswap()
+    xs.extend(block[0::dims])
+    ys.extend(block[1::dims])
+    return offset + size
+
+
+def read_wkb(buf, offset, xs, ys, parts):
+    """Flattens a WKB geometry into the xs/ys arrays without per-vertex objects.
+
+    ``parts`` receives one list per part holding ``(start, end)`` ranges into
+    xs/ys for each ring (a point is a one-vertex ring). Returns the offset of
+    the byte following the geometry.
+    """
+    endian = '<' if buf[offset] == 1 else '>'
+    wkb_type = struct.unpack_from(endian + 'I', buf, offset + 1)[0]
+    offset += 5
+
+    # ISO (1000/2000/3000) and legacy 2.5D flag encodings
+    has_z = bool(wkb_type & 0x80000000)
+    has_m = bool(wkb_type & 0x40000000)
+    wkb_type &= 0x0FFFFFFF
+    base, dim_code = wkb_type % 1000, wkb_type // 1000
+    has_z = has_z or dim_code in (1, 3)
+    has_m = has_m or dim_code in (2, 3)
+    dims = 2 + has_z + has_m
+
+    if base == 1:
+        start = len(xs)
+        offset = _read_coords(buf, offset, 1, dims, endian, xs, ys)
+        parts.append([(start, start + 1)])
+    elif base == 2:
+        count = struct.unpack_from(endian + 'I', buf, offset)[0]
+        start = len(xs)
+        offset = _read_coords(buf, offset + 4, count, dims, endian, xs, ys)
+        parts.append([(start, start + count)])
+    elif base == 3:
+        n_rings = struct.unpack_from(endian + 'I', buf, offset)[0]
+        offset += 4
+        rings = []
+        for _ in range(n_rings):
+            count = struct.unpack_from(endian + 'I', buf, offset)[0]
+            start = len(xs)
+            offset = _read_coords(buf, offset + 4, count, dims, endian, xs, ys)
+            rings.append((start, start + count))
+        parts.append(rings)
+    elif base in (4, 5, 6, 7):
+        n_geoms = struct.unpack_from(endian + 'I', buf, offset)[0]
+        offset += 4
+        for _ in range(n_geoms):
+            offset = read_wkb(buf, offset, xs, ys, parts)
+    else:
+        raise ValueError(f"Unsupported WKB type {wkb_type}")
+    return offset
+
+
+class BatchRecord:
+    """One queued feature: its geometry type, ring ranges and engine payload."""
+    __slots__ = ("feature", "geom_type", "parts", "anchor", "payload")
+
+    def __init__(self, feature, geom_type, parts, anchor, payload):
+        self.feature = feature
+        self.geom_type = geom_type
+        self.parts = parts      # [[(start, end), ...], ...] or None (no geometry)
+        self.anchor = anchor    # index of the centroid vertex, or -1
+        self.payload = payload
+
+
+class GeometryBatch:
+    """Gathers the vertices of many features and transforms them in one call.
+
+    Vertices are read from WKB into contiguous ``array('d')`` buffers, pushed
+    through a single QgsLineString.transform (one bulk PROJ call in C++) and
+    formatted straight from the arrays. When the transform is a no-op (layer
+    already in EPSG:4326) the transform step is skipped entirely.
+
+    ``tolerance`` (layer units) simplifies lines and polygons on the way in
+    with GEOS' topology-preserving simplifier; ``precision`` (decimals) rounds
+    the transformed vertices and drops the consecutive duplicates it creates.
+    """
+
+    def __init__(self, transform, size=DEFAULT_BATCH_SIZE, precision=None, tolerance=0.0):
+        self.transform = transform
+        self.precision = precision
+        self.tolerance = tolerance
+        self.identity = (
+            transform is None or transform.isShortCircuited()
+            or transform.sourceCrs() == transform.destinationCrs()
+        )
+        self.size = size
+        self.records = []
+        self.xs = array('d')
+        self.ys = array('d')
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, feature, geom=None, payload=None, anchor=False):
+        """Queues a feature; returns True once the batch is full.
+
+        ``geom`` None (or an unreadable geometry) queues a record without
+        coordinates so engines that must keep row order (MIF/MID) stay aligned.
+        With ``anchor`` the geometry centroid is queued as an extra vertex.
+        """
+        parts, anchor_idx, geom_type = None, -1, None
+        if geom is not None and not geom.isEmpty():
+            if QgsWkbTypes.isCurvedType(geom.wkbType()):
+                geom = QgsGeometry(geom.constGet().segmentize())
+            if self.tolerance > 0 and QgsWkbTypes.geometryType(geom.wkbType()) != QgsWkbTypes.PointGeometry:
+                simplified = geom.simplify(self.tolerance)
+                if simplified and not simplified.isEmpty(): geom = simplified
+            mark = len(self.xs)
+            try:
+                parts = []
+                read_wkb(bytes(geom.asWkb()), 0, self.xs, self.ys, parts)
+                geom_type = QgsWkbTypes.geometryType(geom.wkbType())
+                if anchor:
+                    c = geom.centroid().asPoint()
+                    anchor_idx = len(self.xs)
+                    self.xs.append(c.x()); self.ys.append(c.y())
+            except (struct.error, ValueError, IndexError):
+                del self.xs[mark:]; del self.ys[mark:]
+                parts, anchor_idx = None, -1
+        self.records.append(BatchRecord(feature, geom_type, parts, anchor_idx, payload))
+        return len(self.records) >= self.size
+
+    def transform_all(self):
+        """Transforms every queued vertex to the destination CRS in place (then applies ``precision``)."""
+        if not self.identity and self.xs:
+            try:
+                line = QgsLineString(list(self.xs), list(self.ys))
+                line.transform(self.transform)
+                wkb = bytes(line.asWkb())
+            except Exception:
+                self._transform_each()
+            else:
+                coords = array('d')
+                coords.frombytes(wkb[9:]) # byte order + type + vertex count
+                if wkb[0] != (1 if _NATIVE == '<' else 0): coords.byteswap()
+                self.xs = coords[0::2]
+                self.ys = coords[1::2]
+        if self.precision is not None and self.xs: self.quantize(self.precision)
+
+    def quantize(self, decimals):
+        """Rounds every vertex and drops consecutive duplicates inside each ring.
+
+        Ring ranges and anchors are remapped to the compacted arrays. A ring
+        that would fall below its minimum size (4 for polygons, 2 for lines)
+        keeps all of its rounded vertices instead.
+        """
+        xs = [round(v, decimals) for v in self.xs]
+        ys = [round(v, decimals) for v in self.ys]
+        new_x, new_y = array('d'), array('d')
+        for rec in self.records:
+            if rec.parts is None: continue
+            minimum = 4 if rec.geom_type == QgsWkbTypes.PolygonGeometry else 2
+            parts = []
+            for part in rec.parts:
+                rings = []
+                for start, end in part:
+                    first = len(new_x)
+                    if end - start > 1:
+                        px = py = None
+                        for i in range(start, end):
+                            x, y = xs[i], ys[i]
+                            if x != px or y != py:
+                                new_x.append(x); new_y.append(y)
+                                px, py = x, y
+                        if len(new_x) - first < minimum:
+                            del new_x[first:]; del new_y[first:]
+                    if len(new_x) == first:
+                        new_x.extend(xs[start:end]); new_y.extend(ys[start:end])
+                    rings.append((first, len(new_x)))
+                parts.append(rings)
+            rec.parts = parts
+            if rec.anchor >= 0:
+                a = rec.anchor
+                rec.anchor = len(new_x)
+                new_x.append(xs[a]); new_y.append(ys[a])
+        self.xs, self.ys = new_x, new_y
+
+    def _transform_each(self):
+        # A failing vertex would abort the bulk call: keep the old per-vertex behaviour
+        tr = self.transform
+        for i in range(len(self.xs)):
+            try:
+                p = tr.transform(QgsPointXY(self.xs[i], self.ys[i]))
+                self.xs[i] = p.x(); self.ys[i] = p.y()
+            except Exception:
+                pass
+
+    def clear(self):
+        self.records = []
+        self.xs = array('d')
+        self.ys = array('d')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : kml_regions
+#  DESCRIPTION : Spatial tile pyramid for regionated (level-of-detail) KMZ output
+# ==============================================================================
+
+import math
+from array import array
+
+# Defaults for the regionated export
+DEFAULT_TILE_FEATURES = 5000
+MIN_LOD_PIXELS = 128
+MAX_TILE_DEPTH = 16
+
+
+class RegionTile:
+    """One node of the tile pyramid: a lat/lon box, its own features and child tiles."""
+    __slots__ = ("tile_id", "depth", "bbox", "fids", "children")
+
+    def __init__(self, tile_id, depth, bbox):
+        self.tile_id = tile_id
+        self.depth = depth
+        self.bbox = bbox # (west, south, east, north)
+        self.fids = array('q')
+        self.children = []
+
+    @property
+    def href(self):
+        return f"{self.tile_id}.kml"
+
+
+def build_tile_pyramid(fids, xs, ys, max_features=DEFAULT_TILE_FEATURES, max_depth=MAX_TILE_DEPTH):
+    """Splits feature anchors (EPSG:4326) into a quadtree of RegionTiles.
+
+    Every node keeps at most ``max_features`` features, picked one per grid
+    cell so a zoomed-out tile shows an even spatial sample; the rest is pushed
+    down into its four quadrants. Each feature ends up in exactly one tile.
+    Returns the tiles with every parent listed before its children (root first).
+    """
+    if not len(fids): return []
+    west, east = min(xs), max(xs)
+    south, north = min(ys), max(ys)
+    pad = 1e-6
+    root = RegionTile(0, 0, (west - pad, south - pad, east + pad, north + pad))
+    tiles = [root]
+    stack = [(root, array('q', range(len(fids))))]
+    grid = max(1, int(math.ceil(math.sqrt(max_features))))
+
+    while stack:
+        tile, members = stack.pop()
+        if len(members) <= max_features or tile.depth >= max_depth:
+            tile.fids.extend(fids[i] for i in members)
+            continue
+
+        w, s, e, n = tile.bbox
+        cw = (e - w) / grid or 1e-12
+        ch = (n - s) / grid or 1e-12
+        taken = set()
+        rest = array('q')
+        for i in members:
+            if len(taken) < max_features:
+                cell = (int((xs[i] - w) / cw), int((ys[i] - s) / ch))
+                if cell not in taken:
+                    taken.add(cell)
+                    tile.fids.append(fids[i])
+                    continue
+            rest.append(i)
+
+        # Quadrants: SW, SE, NW, NE
+        mx, my = (w + e) / 2.0, (s + n) / 2.0
+        quads = [array('q'), array('q'), array('q'), array('q')]
+        for i in rest:
+            quads[(2 if ys[i] >= my else 0) + (1 if xs[i] >= mx else 0)].append(i)
+        boxes = [(w, s, mx, my), (mx, s, e, my), (w, my, mx, n), (mx, my, e, n)]
+        for box, quad in zip(boxes, quads):
+            if not quad: continue
+            child = RegionTile(len(tiles), tile.depth + 1, box)
+            tiles.append(child)
+            tile.children.append(child)
+            stack.append((child, quad))
+    return tiles
+
+
+def region_xml(bbox, min_lod=MIN_LOD_PIXELS):
+    w, s, e, n = bbox
+    return (
+        f'<Region><LatLonAltBox><north>{n}</north><south>{s}</south><east>{e}</east><west>{w}</west></LatLonAltBox>'
+        f'<Lod><minLodPixels>{min_lod}</minLodPixels><maxLodPixels>-1</maxLodPixels></Lod></Region>'
+    )
+
+
+def network_link_xml(tile, href, min_lod=MIN_LOD_PIXELS):
+    return (
+        f'<NetworkLink><name>{tile.tile_id}</name>{region_xml(tile.bbox, min_lod)}'
+        f'<Link><href>{href}</href><viewRefreshMode>onRegion</viewRefreshMode></Link></NetworkLink>\n'
+    )
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : kmz_writer
+#  DESCRIPTION : Streaming KMZ writer used by the KMZ export engine
+# ==============================================================================
+
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+from .export_profile import NULL_PROFILER
+
+KML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+    '<Document>\n'
+)
+KML_FOOTER = '</Document></kml>\n'
+
+LEGEND_OVERLAY = (
+    '<ScreenOverlay><name>Legend</name><Icon><href>legend.png</href></Icon>'
+    '<overlayXY x="0" y="1" xunits="fraction" yunits="fraction"/>'
+    '<screenXY x="0.01" y="0.99" xunits="fraction" yunits="fraction"/></ScreenOverlay>\n'
+)
+
+POINT_ICON = "http://maps.google.com/mapfiles/kml/shapes/shaded_dot.png"
+LABEL_STYLE_ID = "site_label"
+
+
+def kml_color(color, alpha="ff"):
+    """Converts a QColor into KML aabbggrr notation."""
+    return f"{alpha}{color.blue():02x}{color.green():02x}{color.red():02x}"
+
+
+def style_body(kind, color, balloon=""):
+    """Returns the inner XML of a <Style> for a geometry kind ('point', 'line', 'poly')."""
+    if kind == "point":
+        return f'<IconStyle><color>{kml_color(color)}</color><scale>0.7</scale><Icon><href>{POINT_ICON}</href></Icon></IconStyle>{balloon}'
+    if kind == "poly":
+        return (f'<LineStyle><color>{kml_color(color)}</color><width>1</width></LineStyle>'
+                f'<PolyStyle><color>{kml_color(color, "bf")}</color><fill>1</fill><outline>1</outline></PolyStyle>{balloon}')
+    return f'<LineStyle><color>{kml_color(color)}</color><width>2</width></LineStyle>{balloon}'
+
+
+def label_style():
+    """Shared style of the site label placemarks (icon hidden, yellow text)."""
+    return (f'<Style id="{LABEL_STYLE_ID}"><IconStyle><scale>0</scale></IconStyle>'
+            '<LabelStyle><scale>0.9</scale><color>ff00ffff</color></LabelStyle></Style>\n')
+
+
+def html_table(field_names, attributes):
+    """Legacy popup: an inline HTML table with every field name repeated per feature."""
+    desc_table = "<table border='1' width='300'>"
+    for idx, val in enumerate(attributes):
+        val_str = str(val) if val is not None else "-"
+        desc_table += f"<tr><td>{field_names[idx]}</td><td>{val_str}</td></tr>"
+    desc_table += "</table>"
+    return f'<description><![CDATA[{desc_table}]]></description>'
+
+
+class KmlSchema:
+    """Attribute encoding through one <Schema> and a shared <BalloonStyle> template.
+
+    Field names are written once in the Document header. Each placemark only
+    carries its values as <ExtendedData><SchemaData>, keyed by short column ids
+    (f0, f1, ...) which the balloon template resolves with $[schema/field].
+    """
+
+    def __init__(self, field_names, name="attrs"):
+        self.name = name
+        self.field_names = list(field_names)
+        self.ids = [f"f{i}" for i in range(len(self.field_names))]
+        # Per-field prefixes are precomputed so the hot loop only escapes values
+        self._prefixes = [f'<SimpleData name="{fid}">' for fid in self.ids]
+        self._open = f'<ExtendedData><SchemaData schemaUrl="#{name}">'
+
+    def header(self):
+        fields = "".join(
+            f'<SimpleField name="{fid}" type="string"><displayName>{escape(fname)}</displayName></SimpleField>'
+            for fid, fname in zip(self.ids, self.field_names)
+        )
+        return f'<Schema name={quoteattr(self.name)} id={quoteattr(self.name)}>{fields}</Schema>\n'
+
+    def balloon(self):
+        rows = "".join(
+            f"<tr><td>{escape(fname)}</td><td>$[{self.name}/{fid}]</td></tr>"
+            for fid, fname in zip(self.ids, self.field_names)
+        )
+        return f"<BalloonStyle><text><![CDATA[<table border='1' width='300'>{rows}</table>]]></text></BalloonStyle>"
+
+    def extended_data(self, attributes):
+        values = "".join(
+            pre + escape(str(val)) + "</SimpleData>"
+            for pre, val in zip(self._prefixes, attributes) if val is not None
+        )
+        return f"{self._open}{values}</SchemaData></ExtendedData>"
+
+
+class KmlStyleTable:
+    """Shared document styles: one <Style id> per legend class and geometry kind.
+
+    Placemarks reference these with <styleUrl>, so the style XML is written once
+    in the Document header instead of once per feature. Classes are looked up by
+    their KML color string; colors that are not in the table (e.g. symbols from
+    the symbolForFeature fallback) return None and the caller falls back to an
+    inline <Style>.
+    """
+
+    def __init__(self, balloon="", prefix=""):
+        self.balloon = balloon
+        self.prefix = prefix # Keeps ids unique when several layers share a document
+        self._ids = {}
+        self._styles = []
+
+    @classmethod
+    def from_classes(cls, classes, kind, balloon="", prefix=""):
+        """Builds the table from ThematicClass objects (one per legend class)."""
+        table = cls(balloon, prefix)
+        for thematic_class in classes: table.add(thematic_class.color, kind)
+        return table
+
+    def add(self, color, kind):
+        key = (kml_color(color), kind)
+        if key not in self._ids:
+            style_id = f"{self.prefix}cls{len(self._styles)}_{kind}"
+            self._ids[key] = style_id
+            self._styles.append(f'<Style id="{style_id}">{style_body(kind, color, self.balloon)}</Style>\n')
+        return self._ids[key]
+
+    def style_id(self, kml, kind):
+        return self._ids.get((kml, kind))
+
+    def write(self, kmz, with_labels=False):
+        for style in self._styles: kmz.write(style)
+        if with_labels: kmz.write(label_style())
+
+
+class KmlSpool:
+    """Disk-backed buffer for KML text produced on a worker thread.
+
+    Offers the same ``write`` interface as KmzStreamWriter, so the placemark
+    code can target either. Sections are delimited with ``tell`` and copied
+    into the archive later with ``KmzStreamWriter.copy``, which lets several
+    layers be serialized in parallel and still be merged in order.
+    """
+
+    def __init__(self, chunk_size=1 << 20):
+        self.chunk_size = chunk_size
+        self._file = tempfile.TemporaryFile()
+        self._buffer = []
+        self._pending = 0
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._pending += len(text)
+        if self._pending >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer: self._file.write("".join(self._buffer).encode("utf-8"))
+        self._buffer = []
+        self._pending = 0
+
+    def copy(self, spool, start=0, end=None):
+        """Appends a section of another spool."""
+        self.flush()
+        for data in spool.read_chunks(start, end): self._file.write(data)
+
+    def tell(self):
+        """Byte offset of the next write (pending text included)."""
+        self.flush()
+        return self._file.tell()
+
+    def read_chunks(self, start=0, end=None):
+        """Yields the encoded bytes between two ``tell`` offsets."""
+        self.flush()
+        if end is None: end = self._file.seek(0, 2)
+        self._file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = self._file.read(min(self.chunk_size, remaining))
+            if not data: break
+            remaining -= len(data)
+            yield data
+        self._file.seek(0, 2)
+
+    def close(self):
+        self._file.close()
+
+
+class KmzStreamWriter:
+    """Writes KML text in chunks straight into zip entries of a KMZ archive.
+
+    Placemarks are buffered until ``chunk_size`` characters are pending and then
+    encoded into the open zip entry, so memory stays flat no matter how many
+    features are exported. Only one entry can be streamed at a time: resources
+    (legend image) are added between ``end`` and the next ``begin``. Google
+    Earth opens the first .kml entry, so doc.kml must be begun first.
+    Encoding and deflating are timed as the ``zip`` phase of ``profiler``.
+    """
+
+    def __init__(self, path, chunk_size=1 << 20, profiler=NULL_PROFILER):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.profiler = profiler
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self._stream = None
+        self._buffer = []
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def add_resource(self, arcname, data):
+        """Stores a binary resource (e.g. legend.png) next to doc.kml."""
+        if self._stream is not None:
+            raise RuntimeError("Resources cannot be added while a KML entry is being streamed.")
+        self._zip.writestr(arcname, data)
+
+    def begin(self, arcname="doc.kml"):
+        """Opens a KML entry (doc.kml by default) and writes the document header."""
+        self._stream = self._zip.open(arcname, 'w', force_zip64=True)
+        self.write(KML_HEADER)
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._pending += len(text)
+        if self._pending >= self.chunk_size:
+            self.flush()
+
+    def copy(self, spool, start=0, end=None):
+        """Appends a section of a KmlSpool to the open entry."""
+        self.flush()
+        with self.profiler.phase("zip"):
+            for data in spool.read_chunks(start, end):
+                self._stream.write(data)
+                self.profiler.count("kml_bytes", len(data))
+
+    def flush(self):
+        if self._buffer and self._stream is not None:
+            with self.profiler.phase("zip"):
+                data = "".join(self._buffer).encode("utf-8")
+                self._stream.write(data)
+            self.profiler.count("kml_bytes", len(data))
+        self._buffer = []
+        self._pending = 0
+
+    def end(self, with_legend=False):
+        """Writes the document footer (and legend overlay) and closes the entry."""
+        if with_legend: self.write(LEGEND_OVERLAY)
+        self.write(KML_FOOTER)
+        self.flush()
+        self._stream.close()
+        self._stream = None
+
+    def close(self):
+        if self._stream is not None:
+            self.flush()
+            self._stream.close()
+            self._stream = None
+        self._zip.close()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : legend_image
+#  DESCRIPTION : Offscreen legend PNG (KMZ screen overlay) drawn from the layer
+#                renderers, cached per renderer/style hash
+# ==============================================================================
+
+import hashlib
+from collections import OrderedDict
+
+from qgis.PyQt.QtCore import Qt, QByteArray, QBuffer, QIODevice, QRectF, QSize
+from qgis.PyQt.QtGui import QColor, QFont, QFontMetricsF, QImage, QPainter, QPen
+from qgis.PyQt.QtXml import QDomDocument
+from qgis.core import QgsReadWriteContext
+
+DEFAULT_LEGEND_DPI = 96
+BASE_DPI = 96.0
+# Layout in pixels at BASE_DPI (same metrics as the panel rows)
+ROW_HEIGHT = 22
+ICON_SIZE = 16
+PADDING = 8
+ICON_GAP = 6
+# Legend images kept by LegendImageCache
+CACHE_LIMIT = 16
+
+
+class LegendStyle:
+    """The panel appearance an image is drawn with (fonts, colors, mode, count/percent suffixes)."""
+
+    def __init__(self, font=None, text_color=None, bg_color=None, border_color=None, style_mode="minimalist",
+                 show_count=True, show_percent=True):
+        self.font = QFont(font) if font is not None else QFont("Segoe UI", 9)
+        self.text_color = QColor(text_color) if text_color is not None else QColor("#2f3542")
+        self.bg_color = QColor(bg_color) if bg_color is not None else QColor(255, 255, 255)
+        self.border_color = QColor(border_color) if border_color is not None else QColor(200, 200, 200)
+        self.style_mode = style_mode
+        self.show_count = show_count
+        self.show_percent = show_percent
+
+    def key(self):
+        return (
+            self.font.toString(), self.text_color.name(QColor.HexArgb), self.bg_color.name(QColor.HexArgb),
+            self.border_color.name(QColor.HexArgb), self.style_mode, self.show_count, self.show_percent
+        )
+
+
+class LegendSection:
+    """Legend classes of one layer, taken on the main thread (symbol clones, no live layer).
+
+    Only classes checked in the legend are kept, as only those are exported.
+    ``style_hash`` digests the renderer XML (symbols, labels, check states).
+    """
+
+    def __init__(self, layer):
+        self.layer_id = layer.id()
+        self.name = layer.name()
+        self.items = [] # (rule key, label, symbol)
+        renderer = layer.renderer()
+        if renderer is None:
+            self.style_hash = ""
+            return
+        for item in renderer.legendSymbolItems():
+            if not item.symbol(): continue
+            if item.isCheckable() and not renderer.legendSymbolItemChecked(item.ruleKey()): continue
+            self.items.append((item.ruleKey(), item.label(), item.symbol().clone()))
+        try:
+            doc = QDomDocument()
+            doc.appendChild(renderer.save(doc, QgsReadWriteContext()))
+            style = doc.toString()
+        except Exception:
+            style = renderer.dump()
+        self.style_hash = hashlib.sha1(style.encode("utf-8")).hexdigest()
+
+
+def legend_rows(sections, style, counts=None):
+    """[(text, symbol or None for a layer separator), ...] with the panel's count/percent suffixes."""
+    rows = []
+    for section in sections:
+        if len(sections) > 1: rows.append((f"◆ {section.name}", None))
+        layer_counts = (counts or {}).get(section.layer_id)
+        total = sum(layer_counts.get(key, 0) for key, label, symbol in section.items) if layer_counts else 0
+        for key, label, symbol in section.items:
+            text = label
+            cnt = layer_counts.get(key) if layer_counts else None
+            if style.show_count and cnt is not None: text += f" [{cnt}]"
+            if style.show_percent and total > 0: text += f" ({((cnt or 0) / total) * 100:.1f}%)"
+            rows.append((text, symbol))
+    return rows
+
+
+def render_legend_png(sections, style, dpi=DEFAULT_LEGEND_DPI, counts=None):
+    """Draws the legend into a PNG (bytes) at ``dpi``; None when there is nothing to draw.
+
+    Works without any widget (QImage + QPainter), so it can run on a worker
+    thread or under qgis_process. Point sizes follow the image DPI, pixel
+    metrics are scaled from the panel's 96 DPI layout.
+    """
+    rows = legend_rows(sections, style, counts)
+    if not rows: return None
+    scale = dpi / BASE_DPI
+    dots_per_metre = int(round(dpi / 0.0254))
+
+    probe = QImage(1, 1, QImage.Format_ARGB32_Premultiplied)
+    probe.setDotsPerMeterX(dots_per_metre)
+    probe.setDotsPerMeterY(dots_per_metre)
+    font_sep = QFont(style.font)
+    font_sep.setBold(True)
+    metrics, metrics_sep = QFontMetricsF(style.font, probe), QFontMetricsF(font_sep, probe)
+    text_width = max((metrics_sep if symbol is None else metrics).horizontalAdvance(text) for text, symbol in rows)
+    row_h, icon, pad, gap = ROW_HEIGHT * scale, ICON_SIZE * scale, PADDING * scale, ICON_GAP * scale
+    width = int(round(2 * pad + icon + gap + text_width + 2))
+    height = int(round(2 * pad + row_h * len(rows)))
+
+    image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+    image.setDotsPerMeterX(dots_per_metre)
+    image.setDotsPerMeterY(dots_per_metre)
+    image.fill(Qt.transparent)
+    painter = QPainter(image)
+    try:
+        painter.setRenderHint(QPainter.Antialiasing, True)
+        painter.setRenderHint(QPainter.TextAntialiasing, True)
+        frame = QRectF(0.5, 0.5, width - 1.0, height - 1.0)
+        if style.style_mode == "standard":
+            painter.setPen(QPen(style.border_color, 1))
+            painter.setBrush(style.bg_color)
+            painter.drawRect(frame)
+        else:
+            painter.setPen(QPen(QColor("#333333"), 1))
+            painter.setBrush(QColor(255, 255, 255, 220))
+            painter.drawRoundedRect(frame, 4 * scale, 4 * scale)
+
+        y = pad
+        for text, symbol in rows:
+            if symbol is None:
+                if style.style_mode == "standard":
+                    painter.fillRect(QRectF(1, y, width - 2, row_h), QColor("#dfe6e9"))
+                    painter.setPen(QColor("#2d3436"))
+                else:
+                    painter.setPen(QColor("#000000"))
+                painter.setFont(font_sep)
+                painter.drawText(QRectF(pad, y, width - 2 * pad, row_h), Qt.AlignVCenter | Qt.AlignLeft, text)
+            else:
+                painter.save()
+                painter.translate(pad, y + (row_h - icon) / 2.0)
+                symbol.drawPreviewIcon(painter, QSize(int(round(icon)), int(round(icon))))
+                painter.restore()
+                painter.setPen(style.text_color)
+                painter.setFont(style.font)
+                painter.drawText(
+                    QRectF(pad + icon + gap, y, width - 2 * pad - icon - gap, row_h), Qt.AlignVCenter | Qt.AlignLeft, text
+                )
+            y += row_h
+    finally:
+        painter.end()
+
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    image.save(buf, "PNG")
+    buf.close()
+    return bytes(data)
+
+
+class LegendImageCache:
+    """LRU of legend PNGs keyed by the renderer hashes, counts, style and DPI.
+
+    Repeated exports with the same styling reuse the image instead of
+    drawing it again; any renderer, check state, count or style change gives
+    a new key.
+    """
+
+    def __init__(self, limit=CACHE_LIMIT):
+        self.limit = limit
+        self._images = OrderedDict()
+
+    @staticmethod
+    def cache_key(sections, style, dpi, counts=None):
+        parts = []
+        for section in sections:
+            layer_counts = (counts or {}).get(section.layer_id)
+            parts.append((
+                section.layer_id, section.name, section.style_hash,
+                tuple(sorted((str(k), v) for k, v in layer_counts.items())) if layer_counts else None
+            ))
+        return (tuple(parts), style.key(), int(dpi))
+
+    def png(self, sections, style, dpi=DEFAULT_LEGEND_DPI, counts=None):
+        key = self.cache_key(sections, style, dpi, counts)
+        if key in self._images:
+            self._images.move_to_end(key)
+            return self._images[key]
+        data = render_legend_png(sections, style, dpi, counts)
+        self._images[key] = data
+        while len(self._images) > self.limit: self._images.popitem(last=False)
+        return data
+
+    def clear(self):
+        self._images = OrderedDict()
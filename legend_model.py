@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : legend_model
+#  DESCRIPTION : Virtualized (lazy-fetching) list model behind the legend panel
+# ==============================================================================
+
+from bisect import bisect_right
+
+from qgis.PyQt.QtCore import Qt, QAbstractListModel, QModelIndex
+from qgis.PyQt.QtGui import QColor, QFont, QFontMetrics, QIcon
+
+# Rows exposed to the view per fetchMore() call
+FETCH_BATCH = 256
+
+
+class LegendEntry:
+    """State of one legend row, keyed by (layer id, rule key)."""
+    __slots__ = ("key", "text", "checked", "node", "layer", "rule_key", "style_key")
+
+    def __init__(self, key, text, checked, node, layer, rule_key, style_key):
+        self.key = key
+        self.text = text
+        self.checked = checked
+        self.node = node
+        self.layer = layer
+        self.rule_key = rule_key
+        self.style_key = style_key
+
+    @property
+    def is_separator(self):
+        return self.key[1] is None
+
+
+class LegendLayerRows:
+    """Legend rows of one layer for one refresh; a row's LegendEntry is built only when the model needs it.
+
+    Structure, labels and style key come from the layer's cached
+    LegendLayerState, so creating the rows makes no per-class call; only the
+    check state is read from the legend node, when the row is fetched or
+    painted.
+    """
+
+    def __init__(self, layer, state, counts=None, show_count=False, show_percent=False, separator=False):
+        self.layer = layer
+        self.state = state
+        self.counts = counts
+        self.show_count = show_count
+        self.show_percent = show_percent
+        self.separator = separator
+        self.keys = state.separated_keys() if separator else state.keys
+        self.total = state.total(counts) if counts and show_percent else 0
+
+    def text(self, i):
+        if self.separator:
+            if i == 0: return f"◆ {self.layer.name()}"
+            i -= 1
+        txt = self.state.label(i)
+        cnt = self.counts.get(self.state.rule_keys[i]) if self.counts else None
+        if self.show_count and cnt is not None: txt += f" [{cnt}]"
+        if self.show_percent and self.total > 0: txt += f" ({((cnt or 0)/self.total)*100:.1f}%)"
+        return txt
+
+    def entry(self, i):
+        key = self.keys[i]
+        if key[1] is None:
+            return LegendEntry(key, self.text(i), True, None, self.layer, None, None)
+        node = self.state.nodes[i - 1 if self.separator else i]
+        is_checked = node.data(Qt.CheckStateRole) == Qt.Checked
+        return LegendEntry(key, self.text(i), is_checked, node, self.layer, key[1], self.state.style_key)
+
+
+class LegendListModel(QAbstractListModel):
+    """List model for the floating legend, cheap even with thousands of classes.
+
+    The model is fed LegendLayerRows and builds a row's LegendEntry the first
+    time the row is fetched or painted; with an unchanged row structure (the
+    cached key lists of the layers) a refresh only re-reads the rows already
+    built, about one page whatever the number of classes. Rows are handed to the QListView in
+    batches through canFetchMore/fetchMore, icons are resolved only when a row
+    is painted, and a refresh with the same row keys only emits dataChanged
+    for built rows whose text/check/style changed. Text widths are cached per
+    row and re-measured only when the text changes.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._sections = []
+        self._starts = []   # first source row of each section
+        self._keys = []     # (layer id, rule key) per source row
+        self._built = {}    # source row -> LegendEntry
+        self._visible = None # source rows shown while filtering (None: all)
+        self._rows = None   # key -> visible row, built on first use
+        self._loaded = 0
+        self._filter = ""
+        self._icons = {}
+        self._widths = {}   # key -> (text, width)
+        self.set_appearance(QFont("Segoe UI", 9), QColor("#2f3542"), "minimalist")
+
+    # --- Appearance ---
+    def set_appearance(self, font, text_color, style_mode):
+        self.font = QFont(font)
+        self.font_strike = QFont(font)
+        self.font_strike.setStrikeOut(True)
+        self.font_sep = QFont(font)
+        self.font_sep.setBold(True)
+        self.text_color = QColor(text_color)
+        self.style_mode = style_mode
+        self._widths = {}
+        if self._loaded:
+            self.dataChanged.emit(self.index(0), self.index(max(0, self._loaded - 1)))
+
+    # --- Qt model interface ---
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._loaded
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._loaded < self.visible_count()
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid(): return
+        n = min(FETCH_BATCH, self.visible_count() - self._loaded)
+        if n <= 0: return
+        self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + n - 1)
+        self._loaded += n
+        self.endInsertRows()
+
+    def flags(self, index):
+        if not index.isValid(): return Qt.NoItemFlags
+        if self._keys[self._source_row(index.row())][1] is None: return Qt.NoItemFlags # Non-selectable
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self._loaded: return None
+        entry = self._entry(self._source_row(index.row()))
+        if role == Qt.DisplayRole:
+            return entry.text
+        if role == Qt.FontRole:
+            if entry.is_separator: return self.font_sep
+            return self.font if entry.checked else self.font_strike
+        if role == Qt.ForegroundRole:
+            if entry.is_separator:
+                return QColor("#2d3436") if self.style_mode == "standard" else QColor("#000000")
+            return self.text_color if entry.checked else QColor("gray")
+        if role == Qt.BackgroundRole:
+            if entry.is_separator and self.style_mode == "standard": return QColor("#dfe6e9")
+            return None
+        if role == Qt.DecorationRole:
+            if entry.is_separator or entry.node is None: return None
+            icon_key = (entry.key, entry.style_key)
+            icon = self._icons.get(icon_key)
+            if icon is None:
+                icon = QIcon(entry.node.data(Qt.DecorationRole))
+                self._icons[icon_key] = icon
+            return icon
+        if role == Qt.UserRole:
+            return entry.layer
+        if role == Qt.UserRole + 1:
+            return entry.rule_key
+        return None
+
+    # --- Rows ---
+    def _source_row(self, row):
+        return row if self._visible is None else self._visible[row]
+
+    def _entry(self, src):
+        entry = self._built.get(src)
+        if entry is None:
+            k = bisect_right(self._starts, src) - 1
+            entry = self._built[src] = self._sections[k].entry(src - self._starts[k])
+        return entry
+
+    def _row_index(self):
+        if self._rows is None:
+            if self._visible is None: self._rows = {key: i for i, key in enumerate(self._keys)}
+            else: self._rows = {self._keys[src]: i for i, src in enumerate(self._visible)}
+        return self._rows
+
+    # --- Updates ---
+    def visible_count(self):
+        return len(self._keys) if self._visible is None else len(self._visible)
+
+    def set_sections(self, sections):
+        """Applies a new legend; resets only if the row structure changed."""
+        same = len(sections) == len(self._sections) and all(a.keys is b.keys for a, b in zip(sections, self._sections))
+        if same:
+            keys, starts = self._keys, self._starts
+        else:
+            keys, starts = [], []
+            for section in sections:
+                starts.append(len(keys))
+                keys.extend(section.keys)
+            same = keys == self._keys
+        old_built = self._built
+        self._sections, self._starts, self._keys, self._built = sections, starts, keys, {}
+        if same:
+            if not self._filter:
+                # Only rows built for the view can be on screen; the others are read fresh when fetched
+                for src, old in old_built.items():
+                    if src >= self._loaded: continue
+                    new = self._entry(src)
+                    if new.text != old.text or new.checked != old.checked or new.style_key != old.style_key:
+                        self.dataChanged.emit(self.index(src), self.index(src))
+                return
+        else:
+            self._icons = {}
+            live = set(keys)
+            self._widths = {k: w for k, w in self._widths.items() if k in live}
+        self._apply_filter()
+
+    def set_checked(self, layer_id, states):
+        """Updates the check state of some rows of one layer, repainting only those rows."""
+        rows = self._row_index()
+        for rule_key, checked in states:
+            row = rows.get((layer_id, rule_key))
+            if row is None: continue
+            entry = self._built.get(self._source_row(row))
+            if entry is None: continue # Not built yet: read from the node when needed
+            entry.checked = checked
+            if row < self._loaded: self.dataChanged.emit(self.index(row), self.index(row))
+
+    def set_filter(self, text):
+        self._filter = (text or "").strip().lower()
+        self._apply_filter()
+
+    def _apply_filter(self):
+        self.beginResetModel()
+        if not self._filter:
+            self._visible = None
+        else:
+            # Keep matching rows, plus the separators of layers that still have rows
+            # (texts come from the cached labels, no entry is built)
+            visible = []
+            for start, section in zip(self._starts, self._sections):
+                pending_sep = None
+                for i, key in enumerate(section.keys):
+                    if key[1] is None:
+                        pending_sep = start + i
+                    elif self._filter in section.text(i).lower():
+                        if pending_sep is not None:
+                            visible.append(pending_sep)
+                            pending_sep = None
+                        visible.append(start + i)
+            self._visible = visible
+        self._rows = None
+        self._loaded = min(FETCH_BATCH, self.visible_count())
+        self.endResetModel()
+
+    def max_text_width(self):
+        """Widest text of the rows handed to the view; a row is measured again only when its text changes."""
+        fm = fm_sep = None
+        widest = 0
+        for row in range(self._loaded):
+            entry = self._entry(self._source_row(row))
+            cached = self._widths.get(entry.key)
+            if cached is not None and cached[0] == entry.text:
+                w = cached[1]
+            else:
+                if entry.is_separator:
+                    fm_sep = fm_sep or QFontMetrics(self.font_sep)
+                    w = fm_sep.horizontalAdvance(entry.text) + 30
+                else:
+                    fm = fm or QFontMetrics(self.font)
+                    w = fm.horizontalAdvance(entry.text)
+                self._widths[entry.key] = (entry.text, w)
+            if w > widest: widest = w
+        return widest
+
+
+class LegendLayerState:
+    """Legend of one layer as last read: nodes, renderer items, rule keys and style key.
+
+    Labels, the rule key -> node lookup and the count total are derived on
+    first use.
+    """
+
+    def __init__(self, layer, nodes):
+        renderer = layer.renderer()
+        self.layer_id = layer_id = layer.id()
+        self.nodes = nodes
+        self.items = renderer.legendSymbolItems() if renderer else []
+        self.rule_keys = [self.items[i].ruleKey() for i in range(min(len(nodes), len(self.items)))]
+        self.keys = [(layer_id, k) for k in self.rule_keys]
+        self.style_key = hash(renderer.dump()) if renderer else None
+        self._separated = None
+        self._labels = None
+        self._by_key = None
+        self._counts = None
+        self._total = 0
+
+    def label(self, i):
+        if self._labels is None:
+            self._labels = [self.nodes[j].userLabel() or self.items[j].label() for j in range(len(self.rule_keys))]
+        return self._labels[i]
+
+    def separated_keys(self):
+        """Row keys with the layer separator in front (multi-layer legend)."""
+        if self._separated is None: self._separated = [(self.layer_id, None)] + self.keys
+        return self._separated
+
+    def by_key(self):
+        if self._by_key is None: self._by_key = {node.data(Qt.UserRole): node for node in self.nodes}
+        return self._by_key
+
+    def total(self, counts):
+        """Sum of the class counts, recomputed only when the counts dictionary is replaced."""
+        if counts is not self._counts:
+            self._counts = counts
+            self._total = sum(counts.get(k, 0) for k in self.rule_keys) if counts else 0
+        return self._total
+
+
+class LegendNodeIndex:
+    """Per-layer LegendLayerState (legend nodes, renderer items, rule keys, style key).
+
+    Read once and dropped when the layer's legend or renderer changes (the
+    layer tree model recreates its legend nodes then), so neither a refresh
+    nor a click walks the classes of an unchanged layer. ``version`` counts
+    those changes plus style changes (check states, symbols): the panel
+    compares versions instead of reading the legend to skip idle refreshes.
+    """
+
+    def __init__(self):
+        self._nodes = {}    # layer id -> LegendLayerState
+        self._watched = {}  # layer id -> [(signal, slot), ...]
+        self._tree_watched = {} # layer id -> (tree layer, slot)
+        self._versions = {} # layer id -> legend/style change counter
+
+    def state(self, layer, tree_model, tree_layer):
+        """Returns the layer's LegendLayerState, reading it again if it was dropped."""
+        state = self._nodes.get(layer.id())
+        if state is None:
+            self._watch(layer, tree_layer)
+            state = self._nodes[layer.id()] = LegendLayerState(layer, tree_model.layerLegendNodes(tree_layer))
+        return state
+
+    def nodes(self, layer, tree_model, tree_layer):
+        """Returns {rule key: node} for the layer."""
+        return self.state(layer, tree_model, tree_layer).by_key()
+
+    def version(self, layer_id):
+        return self._versions.get(layer_id, 0)
+
+    def touch(self, layer_id):
+        self._versions[layer_id] = self._versions.get(layer_id, 0) + 1
+
+    def invalidate(self, layer_id):
+        self._nodes.pop(layer_id, None)
+        self.touch(layer_id)
+
+    def clear(self):
+        for connections in self._watched.values():
+            for signal, slot in connections:
+                try: signal.disconnect(slot)
+                except (TypeError, RuntimeError): pass
+        for tree_layer, slot in self._tree_watched.values():
+            try: tree_layer.customPropertyChanged.disconnect(slot)
+            except (TypeError, RuntimeError): pass
+        self._watched = {}
+        self._tree_watched = {}
+        self._nodes = {}
+        self._versions = {}
+
+    def _watch(self, layer, tree_layer):
+        layer_id = layer.id()
+        expire = lambda *args: self.invalidate(layer_id)
+        # User labels are tree layer properties: editing one recreates the nodes without a layer signal
+        watched = self._tree_watched.get(layer_id)
+        if watched is None or watched[0] is not tree_layer:
+            if watched is not None:
+                try: watched[0].customPropertyChanged.disconnect(watched[1])
+                except (TypeError, RuntimeError): pass
+            tree_layer.customPropertyChanged.connect(expire)
+            self._tree_watched[layer_id] = (tree_layer, expire)
+        if layer_id in self._watched: return
+        touch = lambda *args: self.touch(layer_id)
+        forget = lambda *args: self._forget(layer_id)
+        connections = [
+            (layer.legendChanged, expire),
+            (layer.rendererChanged, expire),
+            (layer.styleChanged, touch),
+            (layer.willBeDeleted, forget),
+        ]
+        for signal, slot in connections: signal.connect(slot)
+        self._watched[layer_id] = connections
+
+    def _forget(self, layer_id):
+        self._nodes.pop(layer_id, None)
+        self._watched.pop(layer_id, None)
+        self._tree_watched.pop(layer_id, None)
+        self._versions.pop(layer_id, None)
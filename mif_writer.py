@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : mif_writer
+#  DESCRIPTION : Block-buffered MapInfo MIF/MID writer with cached thematic clauses
+# ==============================================================================
+
+import csv
+import shutil
+import tempfile
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import QgsWkbTypes
+
+MIF_HEADER = "Version 300\nCharset \"WindowsLatin1\"\nDelimiter \",\"\nCoordSys Earth Projection 1, 104\n"
+
+
+def mif_columns(fields):
+    """Returns the MIF 'Columns' block for a QgsFields object."""
+    lines = [f"Columns {len(fields)}\n"]
+    for field in fields:
+        col_name = "".join(x for x in field.name() if x.isalnum() or x == "_")[:10]
+        if not col_name: col_name = f"Col_{fields.indexOf(field)}"
+        f_type = "Char(254)"
+        if field.isNumeric():
+            if field.type() == QVariant.Int: f_type = "Integer"
+            elif field.type() == QVariant.Double: f_type = "Float"
+        lines.append(f"  {col_name} {f_type}\n")
+    return "".join(lines)
+
+
+class MifBlockWriter:
+    """Writes MIF objects and MID rows one block at a time to a pair of open files.
+
+    A whole GeometryBatch is formatted into a list of strings and flushed with a
+    single ``write`` (MIF) and a single ``writerows`` (MID). The Symbol/Pen/Brush
+    clause text is built once per (geometry type, color) and reused.
+    ``columns`` lists the attribute indexes written to the MID (None: all).
+    """
+
+    def __init__(self, f_mif, f_mid, columns=None):
+        self.f_mif = f_mif
+        self.f_mid = f_mid
+        self.writer = csv.writer(self.f_mid, quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self._clauses = {}
+        self.columns = columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.f_mif.close()
+        self.f_mid.close()
+
+    def clause(self, geom_type, color_int):
+        key = (geom_type, color_int)
+        text = self._clauses.get(key)
+        if text is None:
+            if geom_type == QgsWkbTypes.PointGeometry:
+                text = f'    Symbol (108, {color_int}, 8, "Wingdings", 0, 0)\n'
+            elif geom_type == QgsWkbTypes.LineGeometry:
+                text = f"    Pen (2, 2, {color_int})\n"
+            else:
+                text = f"    Pen (1, 2, {color_int})\n    Brush (2, {color_int})\n"
+            self._clauses[key] = text
+        return text
+
+    def write_batch(self, batch):
+        """Formats every record of a (transformed) GeometryBatch and writes it in one go."""
+        xs, ys = batch.xs, batch.ys
+        out = []
+        rows = []
+
+        def vertices(start, end, indent=""):
+            return "".join([f"{indent}{x} {y}\n" for x, y in zip(xs[start:end], ys[start:end])])
+
+        columns = self.columns
+        for rec in batch.records:
+            attrs = rec.feature.attributes()
+            if columns is not None: attrs = [attrs[i] for i in columns]
+            rows.append([str(a) if a != None else "" for a in attrs])
+            try:
+                if rec.parts is None: out.append("None\n"); continue
+                color_int = rec.payload.mif_color if rec.payload else 0
+                obj = []
+
+                # Geometry Handling
+                if rec.geom_type == QgsWkbTypes.PointGeometry:
+                    start = rec.parts[0][0][0]
+                    obj.append(f"Point {xs[start]} {ys[start]}\n")
+                elif rec.geom_type == QgsWkbTypes.LineGeometry:
+                    sections = [part[0] for part in rec.parts]
+                    if len(sections) == 1:
+                        start, end = sections[0]
+                        obj.append(f"Pline {end - start}\n")
+                        obj.append(vertices(start, end))
+                    else:
+                        # Multipart lines: one object, one section per part
+                        obj.append(f"Pline Multiple {len(sections)}\n")
+                        for start, end in sections:
+                            obj.append(f"  {end - start}\n")
+                            obj.append(vertices(start, end))
+                elif rec.geom_type == QgsWkbTypes.PolygonGeometry:
+                    all_rings = [ring for part in rec.parts for ring in part]
+                    obj.append(f"Region {len(all_rings)}\n")
+                    for start, end in all_rings:
+                        obj.append(f"  {end - start}\n")
+                        obj.append(vertices(start, end, "    "))
+                else:
+                    out.append("None\n"); continue
+                obj.append(self.clause(rec.geom_type, color_int))
+                out.extend(obj)
+            except Exception:
+                out.append("None\n")
+
+        self.writer.writerows(rows)
+        self.f_mif.write("".join(out))
+
+
+class MifWriter(MifBlockWriter):
+    """The output MIF/MID pair: header and Columns block, then the data blocks."""
+
+    def __init__(self, mif_path, mid_path, fields, columns=None):
+        f_mif = open(mif_path, 'w', encoding='latin-1', errors='replace', buffering=1 << 20)
+        try:
+            f_mid = open(mid_path, 'w', encoding='latin-1', errors='replace', newline='', buffering=1 << 20)
+        except OSError:
+            f_mif.close()
+            raise
+        super().__init__(f_mif, f_mid, columns)
+        self.f_mif.write(MIF_HEADER)
+        self.f_mif.write(mif_columns(fields))
+        self.f_mif.write("Data\n\n")
+
+    def append(self, chunk):
+        """Concatenates the output of a MifChunk (objects and rows stay aligned)."""
+        for src, dst in ((chunk.f_mif, self.f_mif), (chunk.f_mid, self.f_mid)):
+            src.seek(0)
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+
+class MifChunk(MifBlockWriter):
+    """MIF objects and MID rows of one chunk, held in temp files until ``MifWriter.append``."""
+
+    def __init__(self, columns=None):
+        super().__init__(
+            tempfile.TemporaryFile('w+', encoding='latin-1', errors='replace'),
+            tempfile.TemporaryFile('w+', encoding='latin-1', errors='replace', newline=''),
+            columns
+        )
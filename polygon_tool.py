@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : polygon_tool
+#  DESCRIPTION : Map tool to draw the custom polygon used as export scope
+# ==============================================================================
+
+from qgis.PyQt.QtCore import Qt, pyqtSignal
+from qgis.PyQt.QtGui import QColor
+from qgis.core import QgsWkbTypes, QgsGeometry, QgsPointXY
+from qgis.gui import QgsMapTool, QgsRubberBand
+
+
+class PolygonCaptureTool(QgsMapTool):
+    """Left click adds a vertex, right click (or Enter) closes the polygon, Esc cancels.
+
+    ``captured`` carries the polygon in the canvas CRS; ``canceled`` is emitted
+    when the user aborts. Either way the caller restores the previous tool.
+    """
+
+    captured = pyqtSignal(QgsGeometry)
+    canceled = pyqtSignal()
+
+    def __init__(self, canvas):
+        super().__init__(canvas)
+        self.points = []
+        self.band = QgsRubberBand(canvas, QgsWkbTypes.PolygonGeometry)
+        self.band.setColor(QColor(52, 152, 219, 160))
+        self.band.setFillColor(QColor(52, 152, 219, 50))
+        self.band.setWidth(2)
+        self.setCursor(Qt.CrossCursor)
+
+    def canvasPressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.points.append(QgsPointXY(self.toMapCoordinates(event.pos())))
+            self.redraw()
+        elif event.button() == Qt.RightButton:
+            self.finish()
+
+    def canvasMoveEvent(self, event):
+        if self.points: self.redraw(QgsPointXY(self.toMapCoordinates(event.pos())))
+
+    def keyPressEvent(self, event):
+        if event.key() in (Qt.Key_Return, Qt.Key_Enter): self.finish()
+        elif event.key() == Qt.Key_Escape:
+            self.reset()
+            self.canceled.emit()
+
+    def redraw(self, hover=None):
+        points = self.points + ([hover] if hover else [])
+        self.band.setToGeometry(QgsGeometry.fromPolygonXY([points]) if len(points) > 2 else QgsGeometry.fromPolylineXY(points), None)
+
+    def finish(self):
+        if len(self.points) < 3:
+            self.reset()
+            self.canceled.emit()
+            return
+        geom = QgsGeometry.fromPolygonXY([self.points + [self.points[0]]]).makeValid()
+        self.reset()
+        self.captured.emit(geom)
+
+    def reset(self):
+        self.points = []
+        self.band.reset(QgsWkbTypes.PolygonGeometry)
+
+    def deactivate(self):
+        self.reset()
+        super().deactivate()
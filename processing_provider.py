@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : processing_provider
+#  DESCRIPTION : Processing algorithms (thematic KMZ / MIF / GPKG export) for batch runs
+#                and qgis_process, without the legend panel or any dialog
+# ==============================================================================
+
+import os
+
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (
+    QgsProcessing, QgsProcessingProvider, QgsProcessingAlgorithm, QgsProcessingException,
+    QgsProcessingParameterDefinition, QgsProcessingParameterMultipleLayers, QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterFileDestination, QgsProcessingParameterEnum, QgsProcessingParameterNumber,
+    QgsProcessingParameterBoolean, QgsProcessingParameterExtent, QgsGeometry, QgsVectorLayer,
+    QgsVectorLayerFeatureCounter, QgsExpressionContext, QgsExpressionContextUtils
+)
+
+from .export_tasks import KmzExportTask, MifExportTask, OgrExportTask
+from .export_chunks import default_workers
+from .export_scope import ExportScope, SCOPE_FULL, SCOPE_EXTENT, SCOPE_SELECTED
+from .export_profile import ExportProfiler, REPORT_SUFFIX
+from .site_labels import DEFAULT_LABEL_SPACING
+from .legend_image import LegendSection, LegendStyle, render_legend_png, DEFAULT_LEGEND_DPI
+
+PROVIDER_ID = "embedlegend"
+
+# Enum parameter index -> export scope kind
+SCOPE_CHOICES = [(SCOPE_FULL, "Whole layer"), (SCOPE_EXTENT, "Features inside the extent"), (SCOPE_SELECTED, "Selected features")]
+
+
+class EmbedLegendProvider(QgsProcessingProvider):
+    def loadAlgorithms(self):
+        self.addAlgorithm(KmzExportAlgorithm())
+        self.addAlgorithm(MifExportAlgorithm())
+        self.addAlgorithm(OgrExportAlgorithm())
+
+    def id(self):
+        return PROVIDER_ID
+
+    def name(self):
+        return "Embed Legend"
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(__file__), "icon.png"))
+
+
+# ==============================================================================
+#  BASE ALGORITHM
+# ==============================================================================
+class ThematicExportAlgorithm(QgsProcessingAlgorithm):
+    """Runs an export task synchronously inside the algorithm.
+
+    The task (and so every LayerSnapshot) is built in ``prepareAlgorithm``,
+    on the main thread, exactly as the panel does before handing a task to
+    the task manager; ``processAlgorithm`` then runs its body on the
+    Processing thread and maps progress and cancel onto the feedback.
+    Classes unchecked in a layer's legend are skipped, as in the panel.
+    """
+
+    OUTPUT = "OUTPUT"
+    SCOPE = "SCOPE"
+    EXTENT = "EXTENT"
+    PRECISION = "PRECISION"
+    SIMPLIFY = "SIMPLIFY"
+    THREADS = "THREADS"
+    TIMING_REPORT = "TIMING_REPORT"
+
+    def __init__(self):
+        super().__init__()
+        self.task = None
+
+    def group(self):
+        return "Thematic export"
+
+    def groupId(self):
+        return "thematicexport"
+
+    def createInstance(self):
+        return self.__class__()
+
+    def add_common_parameters(self, geometry_options=True):
+        self.addParameter(QgsProcessingParameterEnum(
+            self.SCOPE, "Export scope", options=[label for kind, label in SCOPE_CHOICES], defaultValue=0
+        ))
+        self.addParameter(QgsProcessingParameterExtent(self.EXTENT, "Extent (scope 'inside the extent')", optional=True))
+        advanced = [
+            QgsProcessingParameterNumber(
+                self.PRECISION, "Coordinate decimals (-1 = full precision)", QgsProcessingParameterNumber.Integer,
+                defaultValue=6, minValue=-1, maxValue=12
+            ),
+            QgsProcessingParameterNumber(
+                self.SIMPLIFY, "Simplify tolerance (m, 0 = off)", QgsProcessingParameterNumber.Double,
+                defaultValue=0.0, minValue=0.0
+            ),
+        ] if geometry_options else []
+        advanced += [
+            QgsProcessingParameterNumber(
+                self.THREADS, "Worker threads", QgsProcessingParameterNumber.Integer,
+                defaultValue=default_workers(), minValue=1
+            ),
+            QgsProcessingParameterBoolean(self.TIMING_REPORT, "Write a timing report (<output>.timing.json)", defaultValue=False),
+        ]
+        for param in advanced:
+            param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+            self.addParameter(param)
+
+    def common_options(self, parameters, context, path):
+        """(workers, scope, precision, simplify, profiler) from the shared parameters."""
+        kind = SCOPE_CHOICES[self.parameterAsEnum(parameters, self.SCOPE, context)][0]
+        scope = None
+        if kind == SCOPE_SELECTED:
+            scope = ExportScope(SCOPE_SELECTED)
+        elif kind == SCOPE_EXTENT:
+            rect = self.parameterAsExtent(parameters, self.EXTENT, context)
+            if rect is None or rect.isNull(): raise QgsProcessingException("An extent is required for the 'inside the extent' scope.")
+            crs = self.parameterAsExtentCrs(parameters, self.EXTENT, context)
+            scope = ExportScope(SCOPE_EXTENT, QgsGeometry.fromRect(rect), crs if crs.isValid() else None)
+
+        precision, simplify = -1, 0.0
+        if self.parameterDefinition(self.PRECISION) is not None:
+            precision = self.parameterAsInt(parameters, self.PRECISION, context)
+            simplify = self.parameterAsDouble(parameters, self.SIMPLIFY, context)
+        workers = self.parameterAsInt(parameters, self.THREADS, context) or default_workers()
+        profiler = None
+        if self.parameterAsBoolean(parameters, self.TIMING_REPORT, context): profiler = ExportProfiler(path + REPORT_SUFFIX)
+        return workers, scope, (precision if precision >= 0 else None), simplify, profiler
+
+    def run_task(self, feedback):
+        task = self.task
+        task.progressChanged.connect(lambda progress: feedback.setProgress(progress))
+        task.status.connect(lambda text: feedback.setProgressText(text))
+        task.run()
+        if task.exception is not None: raise QgsProcessingException(str(task.exception))
+        if feedback.isCanceled(): return {}
+        return {self.OUTPUT: task.path}
+
+    def watch_cancel(self, feedback):
+        # Connected on the main thread, where the Cancel button emits
+        if feedback is not None: feedback.canceled.connect(lambda: self.task.cancel())
+
+
+# ==============================================================================
+#  ALGORITHMS
+# ==============================================================================
+class KmzExportAlgorithm(ThematicExportAlgorithm):
+    INPUT = "INPUT"
+    ATTRIBUTES = "ATTRIBUTES"
+    TILE_SIZE = "TILE_SIZE"
+    LABEL_SPACING = "LABEL_SPACING"
+    SIMPLIFY_BY_ZOOM = "SIMPLIFY_BY_ZOOM"
+    LEGEND = "LEGEND"
+    LEGEND_DPI = "LEGEND_DPI"
+    LEGEND_COUNTS = "LEGEND_COUNTS"
+
+    ATTRIBUTE_MODES = ["table", "schema"]
+
+    def name(self):
+        return "exportthematickmz"
+
+    def displayName(self):
+        return "Export thematic KMZ"
+
+    def shortHelpString(self):
+        return (
+            "Exports one or more vector layers to a Google Earth KMZ with their renderer colors "
+            "(one folder per layer). Sector layers with a site id column get one decluttered label per site. "
+            "A tile size above 0 writes a regionated KMZ. The legend overlay is drawn offscreen from the "
+            "renderers (optionally with per-class counts, which costs one extra pass over the features)."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterMultipleLayers(self.INPUT, "Layers", QgsProcessing.TypeVectorAnyGeometry))
+        self.addParameter(QgsProcessingParameterEnum(
+            self.ATTRIBUTES, "Popup attributes", options=["HTML table", "Schema (ExtendedData)"], defaultValue=0
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.TILE_SIZE, "Features per regionated tile (0 = single document)", QgsProcessingParameterNumber.Integer,
+            defaultValue=0, minValue=0
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.LABEL_SPACING, "Minimum site label spacing (m)", QgsProcessingParameterNumber.Integer,
+            defaultValue=DEFAULT_LABEL_SPACING, minValue=0
+        ))
+        self.add_common_parameters()
+        self.addParameter(QgsProcessingParameterBoolean(self.LEGEND, "Embed the legend image", defaultValue=True))
+        advanced = [
+            QgsProcessingParameterBoolean(self.SIMPLIFY_BY_ZOOM, "Zoom-dependent simplify (regionated)", defaultValue=False),
+            QgsProcessingParameterNumber(
+                self.LEGEND_DPI, "Legend image DPI", QgsProcessingParameterNumber.Integer,
+                defaultValue=DEFAULT_LEGEND_DPI, minValue=48, maxValue=600
+            ),
+            QgsProcessingParameterBoolean(self.LEGEND_COUNTS, "Feature counts and percentages in the legend", defaultValue=False),
+        ]
+        for param in advanced:
+            param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+            self.addParameter(param)
+        self.addParameter(QgsProcessingParameterFileDestination(self.OUTPUT, "KMZ file", "Google Earth (*.kmz)"))
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        layers = [l for l in self.parameterAsLayerList(parameters, self.INPUT, context) if isinstance(l, QgsVectorLayer)]
+        if not layers: raise QgsProcessingException("No vector layer to export.")
+        path = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+        workers, scope, precision, simplify, profiler = self.common_options(parameters, context, path)
+        self.task = KmzExportTask(
+            layers, path, None, self.ATTRIBUTE_MODES[self.parameterAsEnum(parameters, self.ATTRIBUTES, context)],
+            self.parameterAsInt(parameters, self.TILE_SIZE, context), workers, scope,
+            self.parameterAsInt(parameters, self.LABEL_SPACING, context), precision, simplify,
+            self.parameterAsBoolean(parameters, self.SIMPLIFY_BY_ZOOM, context), profiler
+        )
+        # Legend classes (symbol clones) and counters are taken here, on the main thread
+        self.legend_sections, self.counters = [], []
+        if self.parameterAsBoolean(parameters, self.LEGEND, context):
+            self.legend_sections = [LegendSection(layer) for layer in layers]
+            self.legend_dpi = self.parameterAsInt(parameters, self.LEGEND_DPI, context)
+            if self.parameterAsBoolean(parameters, self.LEGEND_COUNTS, context):
+                self.counters = [
+                    (layer.id(), QgsVectorLayerFeatureCounter(
+                        layer, QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
+                    ))
+                    for layer in layers
+                ]
+        self.watch_cancel(feedback)
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        if self.legend_sections:
+            counts = {}
+            for layer_id, counter in self.counters:
+                if feedback.isCanceled(): return {}
+                counter.run()
+                counts[layer_id] = dict(counter.symbolFeatureCountMap())
+            show = bool(self.counters)
+            style = LegendStyle(show_count=show, show_percent=show)
+            self.task.legend_png = render_legend_png(self.legend_sections, style, self.legend_dpi, counts)
+        return self.run_task(feedback)
+
+
+class MifExportAlgorithm(ThematicExportAlgorithm):
+    INPUT = "INPUT"
+
+    def name(self):
+        return "exportthematicmif"
+
+    def displayName(self):
+        return "Export thematic MIF/MID"
+
+    def shortHelpString(self):
+        return (
+            "Exports a vector layer to a MapInfo MIF/MID pair with its renderer colors hardcoded per object. "
+            "The MID file is written next to the MIF file."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterVectorLayer(self.INPUT, "Layer", [QgsProcessing.TypeVectorAnyGeometry]))
+        self.add_common_parameters()
+        self.addParameter(QgsProcessingParameterFileDestination(self.OUTPUT, "MIF file", "MapInfo Interchange (*.mif)"))
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        if layer is None: raise QgsProcessingException("No vector layer to export.")
+        mif_path = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+        mid_path = os.path.splitext(mif_path)[0] + ".mid"
+        workers, scope, precision, simplify, profiler = self.common_options(parameters, context, mif_path)
+        self.task = MifExportTask(layer, mif_path, mid_path, workers, scope, precision, simplify, profiler)
+        self.watch_cancel(feedback)
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        return self.run_task(feedback)
+
+
+class OgrExportAlgorithm(ThematicExportAlgorithm):
+    INPUT = "INPUT"
+    SPATIAL_INDEX = "SPATIAL_INDEX"
+
+    def name(self):
+        return "exportthematicogr"
+
+    def displayName(self):
+        return "Export thematic GeoPackage / FlatGeobuf"
+
+    def shortHelpString(self):
+        return (
+            "Writes a vector layer to GeoPackage or FlatGeobuf (from the file extension) with its resolved "
+            "renderer class baked into theme_key, theme_label, theme_color and theme_alpha columns. "
+            "Features the renderer does not draw are skipped."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterVectorLayer(self.INPUT, "Layer", [QgsProcessing.TypeVectorAnyGeometry]))
+        self.addParameter(QgsProcessingParameterBoolean(self.SPATIAL_INDEX, "Create a spatial index", defaultValue=True))
+        self.add_common_parameters(geometry_options=False)
+        self.addParameter(QgsProcessingParameterFileDestination(
+            self.OUTPUT, "Output file", "GeoPackage (*.gpkg);;FlatGeobuf (*.fgb)"
+        ))
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        if layer is None: raise QgsProcessingException("No vector layer to export.")
+        path = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+        workers, scope, precision, simplify, profiler = self.common_options(parameters, context, path)
+        self.task = OgrExportTask(
+            layer, path, workers, scope, self.parameterAsBoolean(parameters, self.SPATIAL_INDEX, context), profiler
+        )
+        self.watch_cancel(feedback)
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        return self.run_task(feedback)
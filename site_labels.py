@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : site_labels
+#  DESCRIPTION : One label per site (mean of its sector anchors), decluttered
+# ==============================================================================
+
+import math
+import threading
+from xml.sax.saxutils import escape
+
+from .kmz_writer import LABEL_STYLE_ID
+
+# Minimum distance (metres) between two site labels; 0 keeps every label
+DEFAULT_LABEL_SPACING = 250
+
+_M_PER_DEG_LAT = 110574.0
+_M_PER_DEG_LON = 111320.0
+
+
+class SiteLabelIndex:
+    """Groups sector anchors (EPSG:4326) per site id in a single pass.
+
+    ``add`` is called once per sector while placemarks are written (from any
+    chunk thread); ``labels`` then places one label per site on the mean of
+    its sector anchors and drops labels closer than ``min_distance`` metres to
+    one already placed. Sites with more sectors are placed first.
+    """
+
+    def __init__(self):
+        self._sites = {} # site id -> [sum x, sum y, sectors]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sites)
+
+    def add(self, site_id, x, y):
+        with self._lock:
+            entry = self._sites.get(site_id)
+            if entry is None: self._sites[site_id] = [x, y, 1]
+            else:
+                entry[0] += x; entry[1] += y; entry[2] += 1
+
+    def labels(self, min_distance=0):
+        """Returns [(site id, lon, lat), ...] after decluttering."""
+        sites = sorted(
+            ((sid, sx / n, sy / n, n) for sid, (sx, sy, n) in self._sites.items()),
+            key=lambda s: (-s[3], s[0])
+        )
+        if min_distance <= 0: return [(sid, x, y) for sid, x, y, n in sites]
+
+        # Grid hash on a local metric approximation: only the 3x3 neighbouring cells are checked
+        limit = min_distance * min_distance
+        grid = {}
+        placed = []
+        for sid, x, y, n in sites:
+            px = x * _M_PER_DEG_LON * math.cos(math.radians(y))
+            py = y * _M_PER_DEG_LAT
+            ci, cj = int(math.floor(px / min_distance)), int(math.floor(py / min_distance))
+            clash = False
+            for i in (ci - 1, ci, ci + 1):
+                for j in (cj - 1, cj, cj + 1):
+                    for qx, qy in grid.get((i, j), ()):
+                        if (qx - px) ** 2 + (qy - py) ** 2 < limit: clash = True; break
+                    if clash: break
+                if clash: break
+            if clash: continue
+            grid.setdefault((ci, cj), []).append((px, py))
+            placed.append((sid, x, y))
+        return placed
+
+    def write_folder(self, out, min_distance=0, name="Site Labels"):
+        """Writes the labels as their own toggleable <Folder>."""
+        out.write(f'<Folder><name>{escape(name)}</name>\n')
+        for sid, x, y in self.labels(min_distance):
+            out.write(
+                f'<Placemark><name>{escape(sid)}</name><styleUrl>#{LABEL_STYLE_ID}</styleUrl>'
+                f'<Point><coordinates>{x},{y},0</coordinates></Point></Placemark>\n'
+            )
+        out.write('</Folder>\n')
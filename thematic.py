@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  MODULE      : thematic
+#  DESCRIPTION : Per-export lookup from legend key to precomputed export colors
+# ==============================================================================
+
+from bisect import bisect_left
+
+from qgis.PyQt.QtGui import QColor
+from qgis.core import QgsExpression
+
+from .kmz_writer import kml_color
+
+# Memo entries kept per export before the value cache is reset
+MEMO_LIMIT = 200000
+# Functions whose value changes between features with the same field values
+VOLATILE_FUNCTIONS = {"rand", "randf", "now", "uuid", "$id", "$currentfeature", "sqlite_fetch_and_increment"}
+
+
+def memo_safe_expression(text, fields):
+    """True when a class expression depends only on the feature's field values.
+
+    A plain field name is always safe; an expression is refused if it needs
+    the geometry, reads any variable (``@row_number``, ``@feature``, ...) or
+    calls a volatile function, since the memo key would not capture it.
+    """
+    if not text or fields.lookupField(text) >= 0: return True
+    exp = QgsExpression(text)
+    if exp.hasParserError() or exp.needsGeometry() or exp.referencedVariables(): return False
+    return not {name.lower() for name in exp.referencedFunctions()} & VOLATILE_FUNCTIONS
+
+
+class ThematicClass:
+    """Precomputed export colors for one renderer legend class."""
+    __slots__ = ("key", "label", "color", "kml_color", "mif_color")
+
+    def __init__(self, key, label, color):
+        self.key = key
+        self.label = label
+        self.color = QColor(color)
+        self.kml_color = kml_color(color)
+        self.mif_color = (color.red() * 65536) + (color.green() * 256) + color.blue()
+
+
+class ThematicResolver:
+    """Resolves a feature to its ThematicClass with (mostly) a dictionary hit.
+
+    The lookup is built once per export from ``legendSymbolItems()``. Depending
+    on the renderer the hot path is:
+
+    * single symbol      -> a constant class
+    * graduated on field -> bisect over the class ranges
+    * categorized / rule-based whose classes depend on field values only -> memo
+      keyed by the values of the renderer's referenced attributes; a miss is
+      resolved once through ``legendKeysForFeature``
+    * anything else      -> the original ``symbolForFeature`` path, with classes
+      cached per symbol color
+
+    Classes unchecked in the legend resolve to None on every path, so they
+    are not exported even when no subset filter could be built for them.
+
+    Must be created after ``renderer.startRender`` and used on the same thread.
+    """
+
+    def __init__(self, renderer, context, fields):
+        self.renderer = renderer
+        self.context = context
+        self.classes = {}
+        self._order = {}
+        self._memo = {}
+        self._by_color = {}
+
+        for idx, item in enumerate(renderer.legendSymbolItems()):
+            sym = item.symbol()
+            if not sym: continue
+            self.classes[item.ruleKey()] = ThematicClass(item.ruleKey(), item.label(), sym.color())
+            self._order[item.ruleKey()] = idx
+        self._checked = {key for key in self.classes if renderer.legendSymbolItemChecked(key)}
+
+        r_type = renderer.type()
+        self.resolve = self._resolve_symbol
+        if not self.classes:
+            return
+        if r_type == "singleSymbol":
+            self._single = next(iter(self.classes.values()))
+            self.resolve = self._resolve_single
+        elif r_type == "graduatedSymbol" and self._init_ranges(fields):
+            self.resolve = self._resolve_range
+        elif r_type in ("categorizedSymbol", "graduatedSymbol", "RuleRenderer"):
+            if self._init_memo(fields): self.resolve = self._resolve_memo
+            else: self.resolve = self._resolve_keys
+
+    # --- Setup ---
+    def _init_ranges(self, fields):
+        idx = fields.lookupField(self.renderer.classAttribute())
+        if idx < 0: return False
+        keys = list(self.classes.keys())
+        ranges = self.renderer.ranges()
+        if len(ranges) != len(keys): return False
+        # Sorted by upper bound; the first range whose upper >= value is the candidate
+        bounds = sorted(
+            (r.upperValue(), r.lowerValue(), keys[i], r.renderState()) for i, r in enumerate(ranges)
+        )
+        self._attr_idx = idx
+        self._uppers = [b[0] for b in bounds]
+        self._ranges = bounds
+        return True
+
+    def _init_memo(self, fields):
+        try:
+            if self.renderer.filterNeedsGeometry(): return False
+        except AttributeError:
+            pass
+        for text in self._class_expressions():
+            if not memo_safe_expression(text, fields): return False
+        indices = []
+        for name in self.renderer.usedAttributes(self.context):
+            idx = fields.lookupField(name)
+            if idx < 0: return False
+            indices.append(idx)
+        self._memo_idx = sorted(indices)
+        return True
+
+    def _class_expressions(self):
+        """Class attribute / rule filters the renderer classifies features with."""
+        if hasattr(self.renderer, "classAttribute"): return [self.renderer.classAttribute()]
+        if hasattr(self.renderer, "rootRule"):
+            return [rule.filterExpression() for rule in self.renderer.rootRule().descendants()]
+        return []
+
+    # --- Resolution paths ---
+    def _resolve_single(self, feat):
+        return self._single
+
+    def _resolve_range(self, feat):
+        value = feat.attribute(self._attr_idx)
+        if value is None: return None
+        try: value = float(value)
+        except (TypeError, ValueError): return None
+        pos = bisect_left(self._uppers, value)
+        if pos >= len(self._ranges): return None
+        upper, lower, key, active = self._ranges[pos]
+        if value < lower or not active: return None
+        return self.classes[key]
+
+    def _resolve_memo(self, feat):
+        attrs = feat.attributes()
+        memo_key = tuple(attrs[i] for i in self._memo_idx)
+        try:
+            return self._memo[memo_key]
+        except KeyError:
+            pass
+        except TypeError: # Unhashable attribute value (e.g. list/map fields)
+            return self._resolve_keys(feat)
+        cls = self._resolve_keys(feat)
+        if len(self._memo) >= MEMO_LIMIT: self._memo.clear()
+        self._memo[memo_key] = cls
+        return cls
+
+    def _resolve_keys(self, feat):
+        self.context.expressionContext().setFeature(feat)
+        keys = self.renderer.legendKeysForFeature(feat, self.context)
+        known = [k for k in keys if k in self._checked]
+        if not known: return None
+        return self.classes[min(known, key=self._order.get)]
+
+    def _resolve_symbol(self, feat):
+        self.context.expressionContext().setFeature(feat)
+        keys = self.renderer.legendKeysForFeature(feat, self.context)
+        if keys and not any(self.renderer.legendSymbolItemChecked(k) for k in keys): return None
+        sym = self.renderer.symbolForFeature(feat, self.context)
+        if not sym: return None
+        color = sym.color()
+        rgba = color.rgba()
+        cls = self._by_color.get(rgba)
+        if cls is None:
+            cls = ThematicClass(None, "", color)
+            self._by_color[rgba] = cls
+        return cls